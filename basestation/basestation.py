@@ -3,7 +3,18 @@ import socket
 import time
 import os
 
-from utils.utils import Packet, MessageType, SensorType
+from utils.utils import Packet, MessageType, SensorType, SENSOR_NAMES, SENSOR_FIELDS, HEADER, BYTE, multiSensorResponseSize
+from utils.utils import multiSensorSummarySize
+from utils.utils import BACKLOG_REQUEST, SLOT_SYNC, BACKLOG_FRAME_SIZE, NO_SEQUENCE, LINK_ADR, LINK_QUALITY
+from utils.airtime import RadioProfile
+from utils.tdma import SlotSchedule, SLOT_GUARD, BACKLOG_DUTY_CYCLE
+from utils.inflight import InFlightTable
+from utils.rtt import RttEstimator
+from utils.backoff import ListenBeforeTalk
+from utils.adr import LinkAdr, link_snr
+from utils.clock import monotonic
+from utils.sink import FileSink, BUFFERED
+from utils.tsstore import TimeSeriesStore
 
 
 ''' A wireless sensor network basestation
@@ -13,17 +24,93 @@ from utils.utils import Packet, MessageType, SensorType
 LORA_FREQUENCY = 869000000
 lora = LoRa(mode=LoRa.LORA, frequency=LORA_FREQUENCY, public=False)
 ALL_SENSORS = [SensorType.TEMP, SensorType.HUMID, SensorType.AIR_QUAL, SensorType.PRESS]
+# the LoPy's default modem settings: SF7, 125 kHz, 4/5, 8 symbol preamble
+RADIO_PROFILE = RadioProfile()
+# give each node an uplink slot on join instead of polling it
+SLOTTED_MODE = True
+# in polled mode, time between polls of the same node and how often a lost poll is retried
+POLL_PERIOD = 10
+MAX_POLL_RETRIES = 2
+# wait before asking a node for its backlog again after it did not answer
+BACKLOG_RETRY = POLL_PERIOD
+# listen before talk: only send once no activity above LBT_RSSI_THRESHOLD dBm is
+# heard on the channel, backing off for a random, growing time while there is
+LISTEN_BEFORE_TALK = False
+LBT_RSSI_THRESHOLD = -90
+# slotted uplinks are not acknowledged, so a node is sent an empty backlog
+# acknowledgement after an uplink at least this often, well within the 60 s
+# it waits before taking contact to be lost
+CONTACT_INTERVAL = 20
+# adaptive data rate: move nodes with a strong link to a lower spreading factor
+# and TX power than RADIO_PROFILE's, which stays the one joins and slots use
+ADAPTIVE_DATA_RATE = False
+
+# sensor data is appended to node_<id>/<sensor>.csv, buffering up to
+# SINK_MAX_ROWS rows or SINK_MAX_AGE seconds between writes to flash
+SINK_OPEN_FILES = 8
+SINK_MAX_ROWS = 32
+SINK_MAX_AGE = 60
+SINK_DURABILITY = BUFFERED
+# also keep readings in a binary time-series store under this directory, or None
+STORE_ROOT = None
+# frames the basestation listens for
+UPLINK_TYPES = (MessageType.MULTI_SENSOR_RESPONSE, MessageType.MULTI_SENSOR_SUMMARY,
+                MessageType.JOIN_REQUEST, MessageType.BACKLOG_DATA, MessageType.LINK_ADR)
+SENSOR_HEADERS = {
+    SensorType.TEMP: 'timestamp, temperature(deg C), latitude, longitude',
+    SensorType.HUMID: 'timestamp, humidity (%), latitude, longitude',
+    SensorType.AIR_QUAL: 'timestamp, eCO2 (ppm), TVOC (ppb), latitude, longitude',
+    SensorType.PRESS: 'timestamp, pressure (hPa), latitude, longitude',
+}
 
 def log_print(msg):
     print(msg)
 
+def readings_size(sensors):
+    # nodes may send a window summary or the latest readings
+    return max(multiSensorResponseSize(sensors), multiSensorSummarySize(sensors))
+
+def summary_header(sensor):
+    stats = [field + ' ' + stat for field in SENSOR_FIELDS[sensor] for stat in ('min', 'max')]
+    return 'timestamp, window (s), readings, ' + ', '.join(stats)
+
 class Node():
     ''' A node on the network that operates a number of sensors
     '''
-    def __init__(self, id, frequency=LORA_FREQUENCY, sensors_available=ALL_SENSORS):
+    def __init__(self, id, frequency=LORA_FREQUENCY, sensors_available=ALL_SENSORS, devices=1, heartbeat=0):
         self.id = id
         self.frequency = frequency
         self.sensors_available = sensors_available
+        # Thingys behind the node, polled in turn by sub-address
+        self.devices = devices
+        self.next_device = 0
+        self.next_poll = 0
+        self.retries = 0
+        # a node reporting by exception only sends changed readings, and is
+        # silent for up to heartbeat seconds while nothing changes
+        self.heartbeat = heartbeat
+        self.last_heard = time.time()
+        # readings the node logged while out of contact, uploaded on request
+        self.backlog = False
+        self.backlog_ack = NO_SEQUENCE
+        self.ack_due = False
+        self.next_backlog = 0
+        # when the node is next due a frame showing that it is still heard
+        self.next_contact = 0
+        # response timeouts follow the measured round trip time to this node
+        self.rtt = RttEstimator.forFrames(RADIO_PROFILE, HEADER.size + BYTE.size,
+                                          readings_size(sensors_available))
+        # spreading factor and TX power the node has been moved to
+        self.link = LinkAdr(RADIO_PROFILE.sf)
+
+    def silent(self, now):
+        ''' True if the node is reporting by exception and has been heard from
+            recently enough that its silence means its readings are unchanged
+        '''
+        return self.heartbeat > 0 and now - self.last_heard <= self.heartbeat
+
+    def advance_device(self):
+        self.next_device = (self.next_device + 1) % self.devices
 
 class Basestation():
     ''' The basestation (master) designed to run on a LoPy
@@ -34,103 +121,353 @@ class Basestation():
         ]
         self.id = 0
         self.available_data = {}
+        self.in_flight = InFlightTable()
+        self.sink = FileSink(SINK_OPEN_FILES, SINK_MAX_ROWS, SINK_MAX_AGE, SINK_DURABILITY)
+        self.store = TimeSeriesStore(STORE_ROOT) if STORE_ROOT else None
+        self.schedule = None
+        if SLOTTED_MODE:
+            self.schedule = SlotSchedule.forProfile(RADIO_PROFILE, readings_size(ALL_SENSORS))
+            # backlogs are uploaded in free slots, so a request and its response must fit one
+            self.backlog_frame_size = self.fit_backlog_frame(self.schedule.slot_length - SLOT_GUARD / 2)
+        else:
+            self.backlog_frame_size = BACKLOG_FRAME_SIZE
+        # spreading factor the radio is listening on
+        self.sf = None
+        self.lbt = None
+        if LISTEN_BEFORE_TALK:
+            self.lbt = ListenBeforeTalk.forProfile(RADIO_PROFILE, readings_size(ALL_SENSORS))
+
+    def backlog_request_size(self):
+        # slotted nodes are sent the time to their next slot with each request
+        return HEADER.size + BACKLOG_REQUEST.size + (SLOT_SYNC.size if self.schedule is not None else 0)
+
+    def slot_offset(self, node, now, size):
+        # time from the end of a size byte frame sent now to the node's next slot
+        if self.schedule is None or node.id not in self.schedule.slots:
+            return None
+        end = now + node.link.profile(RADIO_PROFILE).airtime(size)
+        return self.schedule.slotStart(self.schedule.slots[node.id], end) - end
+
+    def fit_backlog_frame(self, budget):
+        # largest backlog frame that can be requested and sent within time
+        request_time = RADIO_PROFILE.airtime(self.backlog_request_size())
+        size = BACKLOG_FRAME_SIZE
+        while size > 0 and request_time + RADIO_PROFILE.airtime(size) > budget:
+            size -= 1
+        return size
 
     def open_socket(self):
         self.s = socket.socket(socket.AF_LORA, socket.SOCK_RAW)
         self.s.setsockopt(socket.SOL_LORA, socket.SO_DR, 5)
+        self.tune(None)
+
+    def tune(self, node):
+        # the radio receives one spreading factor at a time: the node's while an
+        # exchange with it is under way or its slot is open, the base one otherwise
+        self.set_sf(RADIO_PROFILE.sf if node is None else node.link.sf)
+
+    def set_sf(self, sf):
+        if sf != self.sf:
+            lora.sf(sf)
+            self.sf = sf
+
+    def listening_node(self, now):
+        # a node's slot comes before any exchange still under way with another,
+        # unless that exchange is on another spreading factor
+        if self.schedule is not None:
+            owner = self.get_node(self.schedule.slotAt(now)[0])
+            if owner is not None and not self.awaiting_other_sf(owner.link.sf):
+                return owner
+        # the earliest reply due keeps its spreading factor until it is answered or expires
+        request = self.in_flight.oldest()
+        if request is not None:
+            return self.get_node(request.node_id)
+        return None
+
+    def awaiting_other_sf(self, sf):
+        # a reply is still due on a spreading factor other than sf
+        for request in self.in_flight.requests.values():
+            node = self.get_node(request.node_id)
+            if node is not None and node.link.sf != sf:
+                return True
+        return False
+
+    def adapt_link(self, node, now, until=None):
+        ''' Send node a LINK_ADR if its settings should change or their lease
+            is due for renewal, as long as the answer can arrive by until.
+            Returns the airtime of the exchange, 0 if nothing was sent.
+        '''
+        if not ADAPTIVE_DATA_RATE or (node.id, MessageType.LINK_ADR) in self.in_flight:
+            return 0
+        settings = node.link.decide()
+        if settings is None and node.link.renewalDue(now):
+            settings = node.link.settings()
+        if settings is None or self.awaiting_other_sf(settings[0]):
+            return 0
+        exchange_time = (RADIO_PROFILE.airtime(HEADER.size + LINK_ADR.size) +
+                         RADIO_PROFILE.airtime(HEADER.size + LINK_ADR.size + LINK_QUALITY.size))
+        deadline = None
+        if until is not None:
+            deadline = until - exchange_time - SLOT_GUARD
+            if now > deadline:
+                return 0
+        if settings != node.link.settings():
+            log_print('Moving node %d from %s to SF%d, TX power -%d dB (margin %.1f dB)' %
+                      ((node.id, node.link) + settings + (node.link.margin(),)))
+        pkt = Packet.create_link_adr_request(node.id, settings[0], settings[1])
+        self.tune(node)
+        if not self.send(Packet.encode_packet(pkt), deadline):
+            return 0
+        node.next_contact = now + CONTACT_INTERVAL
+        # the node answers with the new settings
+        node.link.command(settings)
+        self.tune(node)
+        self.in_flight.add(node.id, MessageType.LINK_ADR, now, now + node.rtt.timeout())
+        return exchange_time
+
+    def link_adr_answer(self, pkt):
+        request = self.in_flight.match(pkt.src_id, MessageType.LINK_ADR)
+        node = self.get_node(pkt.src_id)
+        answer = Packet.decode_link_adr(pkt.payload)
+        if request is None or node is None or answer is None or answer[2] is None:
+            log_print('Unexpected link ADR answer from node %d' % pkt.src_id)
+            return
+        changed = node.link.previous != node.link.settings()
+        node.link.onAnswer(link_snr(answer[2], answer[3], RADIO_PROFILE.bw), monotonic())
+        if changed:
+            log_print('Node %d moved to %s' % (node.id, node.link))
+            # the node holds new settings on a short lease until another frame reaches it on them
+            node.next_contact = 0
+
+    def link_adr_expired(self, request):
+        node = self.get_node(request.node_id)
+        if node is None:
+            return
+        send_on = node.link.onUnanswered()
+        if send_on is None:
+            log_print('Node %d did not answer its link ADR request, keeping %s' % (node.id, node.link))
+            return
+        log_print('Node %d did not answer its link ADR request, sending it again on SF%d' % (node.id, send_on[0]))
+        pkt = Packet.create_link_adr_request(node.id, node.link.sf, node.link.power_reduction)
+        self.set_sf(send_on[0])
+        sent = self.send(Packet.encode_packet(pkt))
+        # the node answers on the new settings, whichever it was reached on
+        self.tune(node)
+        if not sent:
+            self.link_adr_expired(request)
+            return
+        now = monotonic()
+        self.in_flight.add(node.id, MessageType.LINK_ADR, now, now + node.rtt.timeout())
+
+    def link_missed(self, node):
+        # an uplink the node should have sent did not arrive
+        if node.link.onMissed():
+            log_print('Lost node %d, returning it to the base settings' % node.id)
+
+    def send(self, pkt, deadline=None):
+        ''' Send an encoded packet, returning False if listen before talk gave up
+            on it, or would have had to start it after deadline
+        '''
+        if self.lbt is not None and not self.clear_channel(deadline):
+            log_print('Channel busy, dropped a %d byte frame' % len(pkt))
+            return False
+        # set blocking to avoid receiving whilst sending
+        self.s.setblocking(True)
+        self.s.send(bytes(pkt))
+        self.s.setblocking(False)
+        return True
+
+    def clear_channel(self, deadline=None):
+        attempt = 0
+        while not lora.ischannel_free(LBT_RSSI_THRESHOLD):
+            delay = self.lbt.onBusy(attempt)
+            if delay is None:
+                return False
+            if deadline is not None and monotonic() + delay > deadline:
+                self.lbt.onDeadline(delay)
+                return False
+            time.sleep(delay)
+            attempt += 1
+        self.lbt.onClear(attempt)
+        return True
+
+    def sensor_name(self, sensor, device):
+        # the first Thingy of a node keeps the single device file names
+        if device == 0:
+            return SENSOR_NAMES[sensor]
+        return SENSOR_NAMES[sensor] + '_' + str(device)
+
+    def sensor_file(self, id, sensor, device=0):
+        return "node_" + str(id) + '/' + self.sensor_name(sensor, device) + '.csv'
+
+    def summary_file(self, id, sensor, device=0):
+        return "node_" + str(id) + '/' + self.sensor_name(sensor, device) + '_summary.csv'
+
+    def store_id(self, id, device):
+        return id if device == 0 else '%d_%d' % (id, device)
 
-    def setup_files(self, id, node_sensors):
+    def setup_files(self, id, node_sensors, devices=1):
         filename = ("node_" + str(id))
         if not filename in os.listdir():
             os.mkdir(filename)
-            if 0 in node_sensors:
-                sensorfile = (filename + '/' + str(SensorType(0)))
-                with open(sensorfile, 'w') as f:
-                    f.write('timestamp, temperature(deg C), latitude, longitude\n')
-            if 1 in node_sensors:
-                sensorfile = (filename + '/' + str(SensorType(1)))
-                with open(sensorfile, 'w') as f:
-                    f.write('timestamp, humidity (%), latitude, longitude\n')
-            if 2 in node_sensors:
-                sensorfile = (filename + '/' + str(SensorType(2)))
-                with open(sensorfile, 'w') as f:
-                    f.write('timestamp, eCO2 (ppm), TVOC (ppb), latitude, longitude\n')
-            if 3 in node_sensors:
-                sensorfile = (filename + '/' + str(SensorType(3)))
-                with open(sensorfile, 'w') as f:
-                    f.write('timestamp, pressure (hPa), latitude, longitude\n')
-
+        # headers are written by the sink when it creates each file
+        for device in range(devices):
+            for sensor in node_sensors:
+                self.sink.setHeader(self.sensor_file(id, sensor, device), SENSOR_HEADERS[sensor])
+                self.sink.setHeader(self.summary_file(id, sensor, device), summary_header(sensor))
 
     def join_request(self, pkt):
 
         id = pkt.src_id
-        ids = map(lambda n: n.id, self.nodes)
-        if id in ids:
-            log_print('Node join failed, ID %d already known' % id)
+        node_sensors = Packet.decodeAvailableSensors(pkt.payload)
+        if node_sensors is None:
+            log_print('Node join failed, could not decode available sensors')
             return False
-
-        # Add node to list
-        node_sensors = self.decode_available_sensors(pkt.payload)
-        node = Node(id,sensors_available=node_sensors)
+        # a known node joins again after losing its JOIN_ACK or contact with us,
+        # and is acknowledged again with the same slot
+        known = self.get_node(id)
+        if known is not None:
+            log_print('Node %d joined again' % id)
+            self.nodes.remove(known)
+        node = Node(id,sensors_available=node_sensors, devices=Packet.decodeDeviceCount(pkt.payload),
+                    heartbeat=Packet.decodeHeartbeat(pkt.payload))
+        node.backlog = Packet.decodeBacklogPending(pkt.payload)
+        if known is not None:
+            node.backlog_ack = known.backlog_ack
         self.nodes.append(node)
-        response = Packet.createJoinResponsePacket(id)
+        offset = None
+        if self.schedule is not None:
+            offset = self.schedule.assign(id, monotonic())
+            if offset is None:
+                log_print('No free uplink slot for node %d, polling it instead' % id)
+        if offset is None:
+            response = Packet.createJoinResponsePacket(id)
+        else:
+            response = Packet.createJoinResponsePacket(id, offset, self.schedule.period)
         response = Packet.encode_packet(response)
-        self.s.setblocking(True)
-        self.s.send(bytes(response))
-        self.s.setblocking(False)
-        #self.setup_files(id, node_sensors)
+        if not self.send(response):
+            # the node retries its join
+            return False
+        self.setup_files(id, node_sensors, node.devices)
         print("Sent join acknowledgement")
         return True
 
-    def decode_available_sensors(self, data):
-        if len(data) < 3:
-            log_print('Cannot decode available data with less than 3 bytes')
-            return False
-
-        available = []
-
-        if data[0] == 1:
-            available.append(SensorType.TEMP)
-
-        if data[1] == 1:
-            available.append(SensorType.HUMID)
-
-        if data[2] == 1:
-            available.append(SensorType.AIR_QUAL)
-
-        if data[3] == 1:
-            available.append(SensorType.PRESS)
-
-        return available
-
-    def record_sensor_data(self, data, node, sensor):
-        # first byte of the payload is the sensor type
-        id = node.id
-        # rest of the payload is the data
-        # store
-        current_time = str(time.time())
-        sensorfile = ("node_" + str(id) + '/' + str(SensorType(sensor)))
-        if sensor == 0:
-            with open(sensorfile, 'w') as f:
-                f.write(current_time + ', ' +  data['temp'] + ', ' + data['latitude'] + ', ' + data['longitude'] +  '\n')
-        if sensor == 1:
-            with open(sensorfile, 'w') as f:
-                f.write(current_time + ', ' +  data['humid'] + ', ' + data['latitude'] + ', ' + data['longitude'] +  '\n')
-        if sensor == 2:
-            with open(sensorfile, 'w') as f:
-                f.write(current_time + ', ' +  data['co2'] + ', ' + data['tvoc'] + ', ' + data['latitude'] + ', ' + data['longitude'] +  '\n')
-        if sensor == 3:
-            with open(sensorfile, 'w') as f:
-                f.write(current_time + ', ' +  data['press'] + ', ' + data['latitude'] + ', ' + data['longitude'] +  '\n')
+    def decode_readings(self, pkt):
+        if pkt.type == MessageType.MULTI_SENSOR_SUMMARY:
+            return Packet.decode_multi_sensor_summary(pkt.payload)
+        return Packet.decode_multi_sensor_data(pkt.payload)
+
+    def record_sensor_data(self, data, node):
+        # one row per sensor in the response, all sharing its position. A
+        # summary's means are stored as the reading, and its spread alongside
+        current_time = time.time()
+        node.backlog = data['backlog']
+        node.last_heard = current_time
+        device = data['device']
+        for sensor in data['sensors']:
+            self.record_reading(node, device, sensor, current_time, data, current_time)
+            if 'window' in data:
+                stats = [str(data[field + stat]) for field in SENSOR_FIELDS[sensor] for stat in ('_min', '_max')]
+                row = '%s, %s, %d, %s' % (current_time, data['window'], data['counts'][sensor], ', '.join(stats))
+                self.sink.write(self.summary_file(node.id, sensor, device), row, current_time)
+
+    def record_reading(self, node, device, sensor, timestamp, data, now):
+        position = str(data['latitude']) + ', ' + str(data['longitude'])
+        values = [str(data[field]) for field in SENSOR_FIELDS[sensor]]
+        row = str(timestamp) + ', ' + ', '.join(values) + ', ' + position
+        self.sink.write(self.sensor_file(node.id, sensor, device), row, now)
+        if self.store is not None:
+            self.store.appendReading(self.store_id(node.id, device), sensor, timestamp, data)
+
+    def backlog_node(self, now):
+        # a node that has a backlog to upload or a backlog frame to acknowledge
+        for node in self.nodes:
+            if not (node.backlog or node.ack_due) or now < node.next_backlog:
+                continue
+            if (node.id, MessageType.BACKLOG_DATA) in self.in_flight:
+                continue
+            if self.awaiting_other_sf(node.link.sf):
+                continue
+            return node
+        return None
+
+    def send_backlog_request(self, node, now, deadline=None):
+        # acknowledge the last frame, and ask for the next if there is more
+        max_size = self.backlog_frame_size if node.backlog else 0
+        offset = self.slot_offset(node, now, self.backlog_request_size())
+        pkt = Packet.create_backlog_request(node.id, node.backlog_ack, max_size, offset)
+        pkt = Packet.encode_packet(pkt)
+        self.tune(node)
+        if self.send(pkt, deadline):
+            node.next_contact = now + CONTACT_INTERVAL
+        node.ack_due = False
+        if max_size:
+            deadline = now + node.rtt.timeout() + RADIO_PROFILE.airtime(max_size)
+            self.in_flight.add(node.id, MessageType.BACKLOG_DATA, now, deadline)
+        return max_size
+
+    def confirm_contact(self, node, now, until):
+        # an empty backlog acknowledgement, sent in the rest of the node's
+        # slot if it has not been sent anything for a while
+        if now < node.next_contact or (node.id, MessageType.BACKLOG_DATA) in self.in_flight:
+            return
+        size = self.backlog_request_size()
+        deadline = until - RADIO_PROFILE.airtime(size) - SLOT_GUARD
+        if now > deadline:
+            return
+        pkt = Packet.create_backlog_request(node.id, node.backlog_ack, 0, self.slot_offset(node, now, size))
+        self.tune(node)
+        if self.send(Packet.encode_packet(pkt), deadline):
+            node.next_contact = now + CONTACT_INTERVAL
+            node.ack_due = False
+
+    def backlog_data(self, pkt):
+        now = time.time()
+        self.in_flight.match(pkt.src_id, pkt.type)
+        node = self.get_node(pkt.src_id)
+        data = Packet.decode_backlog_data(pkt.payload)
+        if node is None or data is None:
+            log_print('Dropped a backlog frame from node %d' % pkt.src_id)
+            return
+        # a frame is sent again when its acknowledgement is lost, so only store it once
+        if data['sequence'] != node.backlog_ack:
+            for reading in data['readings']:
+                self.record_reading(node, data['device'], data['sensor'], reading['timestamp'], reading, now)
+            log_print('Received %d backlog readings from node %d' % (len(data['readings']), node.id))
+        node.backlog_ack = data['sequence']
+        node.backlog = data['more']
+        node.ack_due = not data['more']
+        # keep the node's uploads within its share of the duty cycle
+        node.next_backlog = monotonic() + RADIO_PROFILE.airtime(HEADER.size + len(pkt.payload)) / BACKLOG_DUTY_CYCLE
+
+    def backlog_expired(self, request):
+        log_print('Node %d did not send its backlog' % request.node_id)
+        node = self.get_node(request.node_id)
+        if node is not None:
+            node.next_backlog = monotonic() + BACKLOG_RETRY
+
+    def get_node(self, id):
+        for node in self.nodes:
+            if node.id == id:
+                return node
+        return None
 
     def waitForPacket(self, id, msg_type, timeout):
-        end = time.time() + timeout
-        while time.time() < end:
+        # msg_type may be a single type or a tuple of accepted types
+        msg_types = msg_type if isinstance(msg_type, tuple) else (msg_type,)
+        end = monotonic() + timeout
+        while monotonic() < end:
             rx = self.s.recv(256)
             if rx:
                 pkt = Packet.decode_packet(rx)
+                if pkt is None:
+                    continue
+                node = self.get_node(pkt.src_id)
+                if node is not None:
+                    stats = lora.stats()
+                    node.link.onUplink(link_snr(stats.snr, stats.rssi, RADIO_PROFILE.bw))
                 if pkt.src_id == id or id == None:
-                    if pkt.type == msg_type and pkt.dest_id == 0:
+                    if pkt.type in msg_types and pkt.dest_id == 0:
                         return pkt
 
 
@@ -141,45 +478,199 @@ class Basestation():
         # nodes must join within 60 seconds of basestation activation
         print("Looking for connections...")
         self.s.setblocking(False)
-        t_end = time.time() + 12
-        while time.time() < t_end:
+        t_end = monotonic() + 12
+        while monotonic() < t_end:
             pkt = self.waitForPacket(None, MessageType.JOIN_REQUEST, 5)
             if pkt:
                 print("Device found!")
                 self.join_request(pkt)
+        try:
+            if self.schedule is not None:
+                self.run_slotted()
+            else:
+                self.run_polled()
+        finally:
+            if self.lbt is not None:
+                log_print('Listen before talk: ' + self.lbt.summary())
+            # write out anything still buffered
+            self.sink.close()
+            if self.store is not None:
+                self.store.close()
+
+    def run_slotted(self):
+        print("Listening for slotted uplinks...")
+        backlog_slot = None
+        request_time = RADIO_PROFILE.airtime(self.backlog_request_size())
+        exchange_time = request_time + RADIO_PROFILE.airtime(self.backlog_frame_size)
+        while True:
+            now = monotonic()
+            # backlogs are requested at the start of a slot no node uses
+            if backlog_slot is not None and now >= backlog_slot:
+                node = self.backlog_node(now)
+                deadline = backlog_slot + self.schedule.slot_length - exchange_time
+                if node is not None and now <= deadline:
+                    log_print('Requesting backlog of node %d' % node.id)
+                    self.send_backlog_request(node, now, deadline)
+                backlog_slot = None
+            if backlog_slot is None and self.backlog_frame_size and self.backlog_node(now) is not None:
+                backlog_slot = self.schedule.nextFreeSlot(now)
+
+            # listen until the next slot closes, accepting late joins as well
+            wake = self.schedule.nextDeadline(now)
+            for deadline in (backlog_slot, self.in_flight.nextDeadline()):
+                if deadline is not None:
+                    wake = min(wake, deadline)
+            if ADAPTIVE_DATA_RATE:
+                # listen on the spreading factor of the node whose slot is open
+                self.tune(self.listening_node(now))
+                wake = min(wake, self.schedule.slotAt(now)[1])
+            pkt = self.waitForPacket(None, UPLINK_TYPES, max(wake - now, 0))
+            if pkt and pkt.type == MessageType.JOIN_REQUEST:
+                self.join_request(pkt)
+            elif pkt and pkt.type == MessageType.BACKLOG_DATA:
+                self.backlog_data(pkt)
+            elif pkt and pkt.type == MessageType.LINK_ADR:
+                self.link_adr_answer(pkt)
+            elif pkt:
+                if not self.schedule.onReceive(pkt.src_id, monotonic()):
+                    log_print('Uplink from node %d outside of its slot' % pkt.src_id)
+                data = self.decode_readings(pkt)
+                print(data)
+                node = self.get_node(pkt.src_id)
+                if data and node is not None:
+                    self.record_sensor_data(data, node)
+                    # the node listens after its uplink, so link changes go out in the rest of its slot
+                    now = monotonic()
+                    owner, slot_end = self.schedule.slotAt(now)
+                    if owner == node.id and not self.adapt_link(node, now, slot_end):
+                        self.confirm_contact(node, now, slot_end)
+            self.sink.tick()
+            if self.store is not None:
+                self.store.tick()
+
+            now = monotonic()
+            for id in self.schedule.check(now):
+                node = self.get_node(id)
+                if node is not None and node.silent(time.time()):
+                    continue
+                log_print('Missed slot of node %d (%d in a row)' % (id, self.schedule.missed[id]))
+                if node is not None:
+                    self.link_missed(node)
+            for request in self.in_flight.expire(monotonic()):
+                if request.msg_type == MessageType.LINK_ADR:
+                    self.link_adr_expired(request)
+                else:
+                    self.backlog_expired(request)
+
+    def send_poll(self, node, now):
+        pkt = Packet.create_multi_sensor_request(node.id, node.sensors_available, node.next_device)
+        pkt = Packet.encode_packet(pkt)
+        self.tune(node)
+        self.send(pkt)
+        self.in_flight.add(node.id, MessageType.MULTI_SENSOR_RESPONSE, now, now + node.rtt.timeout(), node.retries)
+        # each of the node's Thingys is polled once a period
+        node.next_poll = now + POLL_PERIOD / node.devices
+
+    def run_polled(self):
         print("Polling for data...")
+        # requests go out back to back, leaving just enough room on the channel
+        # for each response, and responses are matched as they arrive
+        next_send = 0
         # main control loop
         while True:
-
-            # cycle through the sensors and find equipped nodes for each
-            for sensor_type in ALL_SENSORS:
-                print('Getting ', sensor_type , ' data...')
-                time.sleep(2)
+            now = monotonic()
+            if now >= next_send:
                 for node in self.nodes:
-                    # check if the node supports the sensor type
-                    time.sleep(3)
+                    if not node.sensors_available or now < node.next_poll:
+                        continue
+                    if (node.id, MessageType.MULTI_SENSOR_RESPONSE) in self.in_flight:
+                        continue
+                    # a node on another spreading factor waits for the replies still due
+                    if self.awaiting_other_sf(node.link.sf):
+                        continue
                     print('Polling node with id = ', node.id , '...')
+                    self.send_poll(node, now)
+                    # nodes moved to a lower spreading factor take less of the channel
+                    profile = node.link.profile(RADIO_PROFILE)
+                    request_time = profile.airtime(HEADER.size + BYTE.size)
+                    response_time = profile.airtime(readings_size(node.sensors_available))
+                    next_send = now + request_time + response_time + SLOT_GUARD
+                    break
+            # backlogs are uploaded when no poll is due
+            if now >= next_send:
+                node = self.backlog_node(now)
+                if node is not None:
+                    log_print('Requesting backlog of node %d' % node.id)
+                    max_size = self.send_backlog_request(node, now)
+                    profile = node.link.profile(RADIO_PROFILE)
+                    response_time = profile.airtime(max_size) if max_size else 0
+                    next_send = now + profile.airtime(HEADER.size + BACKLOG_REQUEST.size) + response_time + SLOT_GUARD
+
+            # listen until the next request is due or the next one times out
+            # nodes held back by replies due on another spreading factor wait for those
+            due = [n.next_poll for n in self.nodes if n.sensors_available
+                   and (n.id, MessageType.MULTI_SENSOR_RESPONSE) not in self.in_flight
+                   and not self.awaiting_other_sf(n.link.sf)]
+            due += [n.next_backlog for n in self.nodes if (n.backlog or n.ack_due)
+                    and (n.id, MessageType.BACKLOG_DATA) not in self.in_flight
+                    and not self.awaiting_other_sf(n.link.sf)]
+            wake = max(min(due), next_send) if due else now + POLL_PERIOD
+            deadline = self.in_flight.nextDeadline()
+            if deadline is not None:
+                wake = min(wake, deadline)
+            # listen for the nodes asked, or for joins once nothing is awaited
+            self.tune(self.listening_node(now))
+            pkt = self.waitForPacket(None, UPLINK_TYPES, max(wake - monotonic(), 0.01))
+            if pkt and pkt.type == MessageType.JOIN_REQUEST:
+                self.join_request(pkt)
+            elif pkt and pkt.type == MessageType.BACKLOG_DATA:
+                self.backlog_data(pkt)
+            elif pkt and pkt.type == MessageType.LINK_ADR:
+                self.link_adr_answer(pkt)
+            elif pkt:
+                # polls are answered with either kind of readings frame
+                request = self.in_flight.match(pkt.src_id, MessageType.MULTI_SENSOR_RESPONSE)
+                node = self.get_node(pkt.src_id)
+                if request is None:
+                    log_print('Unexpected response from node %d' % pkt.src_id)
+                elif node is not None:
+                    # only time responses to polls that were sent once
+                    now = monotonic()
+                    if request.context == 0:
+                        node.rtt.sample(now - request.sent_at)
+                    node.retries = 0
+                    node.advance_device()
+                    exchange_time = self.adapt_link(node, now)
+                    if exchange_time:
+                        next_send = max(next_send, now + exchange_time + SLOT_GUARD)
+                data = self.decode_readings(pkt)
+                print(data)
+                if data and node is not None:
+                    self.record_sensor_data(data, node)
+            self.sink.tick()
+            if self.store is not None:
+                self.store.tick()
+
+            for request in self.in_flight.expire(monotonic()):
+                if request.msg_type == MessageType.BACKLOG_DATA:
+                    self.backlog_expired(request)
+                    continue
+                if request.msg_type == MessageType.LINK_ADR:
+                    self.link_adr_expired(request)
+                    continue
+                log_print('Node %d did not respond' % request.node_id)
+                node = self.get_node(request.node_id)
+                if node is None:
+                    continue
+                node.rtt.onTimeout()
+                self.link_missed(node)
+                if node.retries < MAX_POLL_RETRIES:
+                    node.retries += 1
+                    node.next_poll = monotonic()
+                else:
+                    node.retries = 0
+                    node.advance_device()
 
-                    if sensor_type in node.sensors_available:
-                        print("Sensor available!")
-                        # create packet
-                        pkt = Packet.create_sensor_request(node.id, sensor_type)
-
-                        pkt = Packet.encode_packet(pkt)
-                        # set blocking to avoid receiving whilst sending
-                        self.s.setblocking(True)
-                        self.s.send(bytes(pkt))
-                        self.s.setblocking(False)
-                        # wait for response before doing anything else
-                        pkt = self.waitForPacket(node.id, MessageType.SENSOR_RESPONSE, 10)
-                        # process response
-                        if pkt:
-                            print(pkt.payload)
-                            data = Packet.decode_sensor_data(pkt.payload)
-                            print(data)
-                            #self.record_sensor_data(data, node, sensor)
-
-                            #log_print('Received a packet of type %d but expected Sensor Response (%d)' % (pkt.type, MessageType.SENSOR_RESPONSE))
 def main():
 
     base = Basestation([])
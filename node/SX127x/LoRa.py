@@ -26,6 +26,22 @@ from .constants import *
 from .board_config import BOARD
 
 
+# Configuration registers that only change when they are written. With register shadowing on, reads of these are
+# served from a write-through copy, while volatile registers (IRQ flags, RSSI, FIFO pointers, mode, LNA gain under AGC)
+# are always read from the chip.
+SHADOWED_REGISTERS = frozenset([
+    REG.LORA.FR_MSB, REG.LORA.FR_MID, REG.LORA.FR_LSB, REG.LORA.PA_CONFIG, REG.LORA.PA_RAMP, REG.LORA.OCP,
+    REG.LORA.FIFO_TX_BASE_ADDR, REG.LORA.FIFO_RX_BASE_ADDR, REG.LORA.IRQ_FLAGS_MASK, REG.LORA.MODEM_CONFIG_1,
+    REG.LORA.MODEM_CONFIG_2, REG.LORA.SYMB_TIMEOUT_LSB, REG.LORA.PREAMBLE_MSB, REG.LORA.PREAMBLE_MSB + 1,
+    REG.LORA.PAYLOAD_LENGTH, REG.LORA.MAX_PAYLOAD_LENGTH, REG.LORA.HOP_PERIOD, REG.LORA.MODEM_CONFIG_3,
+    REG.LORA.PPM_CORRECTION, REG.LORA.DETECT_OPTIMIZE, REG.LORA.INVERT_IQ, REG.LORA.DETECTION_THRESH,
+    REG.LORA.SYNC_WORD, REG.LORA.DIO_MAPPING_1, REG.LORA.DIO_MAPPING_2, REG.LORA.TCXO, REG.LORA.PA_DAC,
+])
+
+# The LongRangeMode bit of RegOpMode. Most registers mean something else in FSK mode.
+LONG_RANGE_MODE = 0x80
+
+
 ################################################## Some utility functions ##############################################
 
 def set_bit(value, index, new_bit):
@@ -53,7 +69,7 @@ def getter(register_address):
     """
     def decorator(func):
         def wrapper(self):
-            return func(self, self.spi.xfer([register_address, 0])[1])
+            return func(self, self.read_shadowed(register_address)[0])
         return wrapper
     return decorator
 
@@ -67,11 +83,126 @@ def setter(register_address):
     """
     def decorator(func):
         def wrapper(self, val):
-            return self.spi.xfer([register_address | 0x80, func(self, val)])[1]
+            return self.write_shadowed(register_address, [func(self, val)])[0]
         return wrapper
     return decorator
 
 
+def decode_irq_flags(v):
+    """ Split the value of RegIrqFlags or RegIrqFlagsMask into its flags
+    :param v: Register value
+    :return: Dict of flag name -> 0/1
+    :rtype: dict
+    """
+    return dict(
+            rx_timeout     = v >> 7 & 0x01,
+            rx_done        = v >> 6 & 0x01,
+            crc_error      = v >> 5 & 0x01,
+            valid_header   = v >> 4 & 0x01,
+            tx_done        = v >> 3 & 0x01,
+            cad_done       = v >> 2 & 0x01,
+            fhss_change_ch = v >> 1 & 0x01,
+            cad_detected   = v >> 0 & 0x01,
+        )
+
+
+def decode_pa_config(v, convert_dBm=False):
+    pa_select    = v >> 7
+    max_power    = v >> 4 & 0b111
+    output_power = v & 0b1111
+    if convert_dBm:
+        max_power = max_power * .6 + 10.8
+        output_power = max_power - (15 - output_power)
+    return dict(
+            pa_select    = pa_select,
+            max_power    = max_power,
+            output_power = output_power
+        )
+
+
+def decode_ocp(v, convert_mA=False):
+    ocp_on = v >> 5 & 0x01
+    ocp_trim = v & 0b11111
+    if convert_mA:
+        if ocp_trim <= 15:
+            ocp_trim = 45. + 5. * ocp_trim
+        elif ocp_trim <= 27:
+            ocp_trim = -30. + 10. * ocp_trim
+        else:
+            assert ocp_trim <= 27
+    return dict(
+            ocp_on   = ocp_on,
+            ocp_trim = ocp_trim
+            )
+
+
+def decode_lna(v):
+    return dict(
+            lna_gain     = v >> 5,
+            lna_boost_lf = v >> 3 & 0b11,
+            lna_boost_hf = v & 0b11
+        )
+
+
+def decode_modem_status(status):
+    return dict(
+            rx_coding_rate    = status >> 5 & 0x03,
+            modem_clear       = status >> 4 & 0x01,
+            header_info_valid = status >> 3 & 0x01,
+            rx_ongoing        = status >> 2 & 0x01,
+            signal_sync       = status >> 1 & 0x01,
+            signal_detected   = status >> 0 & 0x01
+        )
+
+
+def decode_hop_channel(v):
+    return dict(
+            pll_timeout          = v >> 7,
+            crc_on_payload       = v >> 6 & 0x01,
+            fhss_present_channel = v >> 5 & 0b111111
+        )
+
+
+def decode_modem_config_1(val):
+    return dict(
+            bw = val >> 4 & 0x0F,
+            coding_rate = val >> 1 & 0x07,
+            implicit_header_mode = val & 0x01
+        )
+
+
+def decode_modem_config_2(val, include_symb_timout_lsb=False):
+    d = dict(
+            spreading_factor = val >> 4 & 0x0F,
+            tx_cont_mode = val >> 3 & 0x01,
+            rx_crc = val >> 2 & 0x01,
+        )
+    if include_symb_timout_lsb:
+        d['symb_timout_lsb'] = val & 0x03
+    return d
+
+
+def decode_modem_config_3(val):
+    return dict(
+            low_data_rate_optim = val >> 3 & 0x01,
+            agc_auto_on = val >> 2 & 0x01
+        )
+
+
+def decode_dio_mapping(mapping_1, mapping_2):
+    return [mapping_1>>6 & 0x03, mapping_1>>4 & 0x03, mapping_1>>2 & 0x03, mapping_1>>0 & 0x03,
+            mapping_2>>6 & 0x03, mapping_2>>4 & 0x03]
+
+
+def rssi_from_register(v):
+    return v - (164 if BOARD.low_band else 157)     # See datasheet 5.5.5. p. 87
+
+
+def snr_from_register(v):
+    # two's complement, in quarter dB
+    return (v - 256 if v > 127 else v) / 4.
+
+
 ############################################### Definition of the LoRa class ###########################################
 
 class LoRa(object):
@@ -83,16 +214,20 @@ class LoRa(object):
     backup_registers = []
     verbose = True
     dio_mapping = [None] * 6          # store the dio mapping here
+    shadow = None                     # register address -> value of the SHADOWED_REGISTERS, if shadowing is on
+    spi_saved = 0                     # SPI transactions served from the shadow
 
-    def __init__(self, verbose=True, do_calibration=True, calibration_freq=868):
+    def __init__(self, verbose=True, do_calibration=True, calibration_freq=868, shadow_registers=False):
         """ Init the object
         
         Send the device to sleep, read all registers, and do the calibration (if do_calibration=True)
         :param verbose: Set the verbosity True/False
         :param calibration_freq: call rx_chain_calibration with this parameter. Default is 868
         :param do_calibration: Call rx_chain_calibration, default is True.
+        :param shadow_registers: Serve reads of the configuration registers from a write-through shadow copy
         """
         self.verbose = verbose
+        self.shadow = {} if shadow_registers else None
         # set the callbacks for DIO0..5 IRQs.
         BOARD.add_events(self._dio0, self._dio1, self._dio2, self._dio3, self._dio4, self._dio5)
         # set mode to sleep and read all registers
@@ -222,6 +357,9 @@ class LoRa(object):
             return mode
         if self.verbose:
             sys.stderr.write("Mode <- %s\n" % MODE.lookup[mode])
+        # switching between LoRa and FSK changes the meaning of the registers
+        if self.shadow and (self.mode is None or (mode ^ self.mode) & LONG_RANGE_MODE):
+            self.shadow.clear()
         self.mode = mode
         return self.spi.xfer([REG.LORA.OP_MODE | 0x80, mode])[1]
 
@@ -258,10 +396,12 @@ class LoRa(object):
         :return: Payload
         :rtype: list[int]
         """
-        if not nocheck and not self.rx_is_good():
-            return None
-        rx_nb_bytes = self.get_rx_nb_bytes()
-        fifo_rx_current_addr = self.get_fifo_rx_current_addr()
+        # FifoRxCurrentAddr, IrqFlagsMask, IrqFlags and RxNbBytes are contiguous, so one burst reads them all
+        fifo_rx_current_addr, _, irq_flags, rx_nb_bytes = self.read_registers(REG.LORA.FIFO_RX_CURR_ADDR, 4)
+        if not nocheck:
+            flags = decode_irq_flags(irq_flags)
+            if any([flags[s] for s in ['valid_header', 'crc_error', 'rx_done', 'rx_timeout']]):
+                return None
         self.set_fifo_addr_ptr(fifo_rx_current_addr)
         payload = self.spi.xfer([REG.LORA.FIFO] + [0] * rx_nb_bytes)[1:]
         return payload
@@ -271,7 +411,7 @@ class LoRa(object):
         :return:    Frequency in MHz
         :rtype:     float
         """
-        msb, mid, lsb = self.spi.xfer([REG.LORA.FR_MSB, 0, 0, 0])[1:]
+        msb, mid, lsb = self.read_shadowed(REG.LORA.FR_MSB, 3)
         f = lsb + 256*(mid + 256*msb)
         return f / 16384.
 
@@ -289,21 +429,10 @@ class LoRa(object):
         mid = i // 256
         i -= mid * 256
         lsb = i
-        return self.spi.xfer([REG.LORA.FR_MSB | 0x80, msb, mid, lsb])
+        return self.write_shadowed(REG.LORA.FR_MSB, [msb, mid, lsb])
 
     def get_pa_config(self, convert_dBm=False):
-        v = self.spi.xfer([REG.LORA.PA_CONFIG, 0])[1]
-        pa_select    = v >> 7
-        max_power    = v >> 4 & 0b111
-        output_power = v & 0b1111
-        if convert_dBm:
-            max_power = max_power * .6 + 10.8
-            output_power = max_power - (15 - output_power)
-        return dict(
-                pa_select    = pa_select,
-                max_power    = max_power,
-                output_power = output_power
-            )
+        return decode_pa_config(self.read_shadowed(REG.LORA.PA_CONFIG)[0], convert_dBm)
 
     def set_pa_config(self, pa_select=None, max_power=None, output_power=None):
         """ Configure the PA
@@ -317,7 +446,7 @@ class LoRa(object):
         current = self.get_pa_config()
         loc = {s: current[s] if loc[s] is None else loc[s] for s in loc}
         val = (loc['pa_select'] << 7) | (loc['max_power'] << 4) | (loc['output_power'])
-        return self.spi.xfer([REG.LORA.PA_CONFIG | 0x80, val])[1]
+        return self.write_shadowed(REG.LORA.PA_CONFIG, [val])[0]
 
     @getter(REG.LORA.PA_RAMP)
     def get_pa_ramp(self, val):
@@ -328,38 +457,20 @@ class LoRa(object):
         return val & 0b1111
 
     def get_ocp(self, convert_mA=False):
-        v = self.spi.xfer([REG.LORA.OCP, 0])[1]
-        ocp_on = v >> 5 & 0x01
-        ocp_trim = v & 0b11111
-        if convert_mA:
-            if ocp_trim <= 15:
-                ocp_trim = 45. + 5. * ocp_trim
-            elif ocp_trim <= 27:
-                ocp_trim = -30. + 10. * ocp_trim
-            else:
-                assert ocp_trim <= 27
-        return dict(
-                ocp_on   = ocp_on,
-                ocp_trim = ocp_trim
-                )
+        return decode_ocp(self.read_shadowed(REG.LORA.OCP)[0], convert_mA)
 
     def set_ocp_trim(self, I_mA):
         assert(I_mA >= 45 and I_mA <= 240)
-        ocp_on = self.spi.xfer([REG.LORA.OCP, 0])[1] >> 5 & 0x01
+        ocp_on = self.read_shadowed(REG.LORA.OCP)[0] >> 5 & 0x01
         if I_mA <= 120:
             v = int(round((I_mA-45.)/5.))
         else:
             v = int(round((I_mA+30.)/10.))
         v = set_bit(v, 5, ocp_on)
-        return self.spi.xfer([REG.LORA.OCP | 0x80, v])[1]
+        return self.write_shadowed(REG.LORA.OCP, [v])[0]
 
     def get_lna(self):
-        v = self.spi.xfer([REG.LORA.LNA, 0])[1]
-        return dict(
-                lna_gain     = v >> 5,
-                lna_boost_lf = v >> 3 & 0b11,
-                lna_boost_hf = v & 0b11
-            )
+        return decode_lna(self.spi.xfer([REG.LORA.LNA, 0])[1])
 
     def set_lna(self, lna_gain=None, lna_boost_lf=None, lna_boost_hf=None):
         assert lna_boost_hf is None or lna_boost_hf == 0b00 or lna_boost_hf == 0b11
@@ -387,16 +498,16 @@ class LoRa(object):
         return self.spi.xfer([REG.LORA.FIFO_ADDR_PTR | 0x80, ptr])[1]
 
     def get_fifo_tx_base_addr(self):
-        return self.spi.xfer([REG.LORA.FIFO_TX_BASE_ADDR, 0])[1]
+        return self.read_shadowed(REG.LORA.FIFO_TX_BASE_ADDR)[0]
 
     def set_fifo_tx_base_addr(self, ptr):
-        return self.spi.xfer([REG.LORA.FIFO_TX_BASE_ADDR | 0x80, ptr])[1]
+        return self.write_shadowed(REG.LORA.FIFO_TX_BASE_ADDR, [ptr])[0]
 
     def get_fifo_rx_base_addr(self):
-        return self.spi.xfer([REG.LORA.FIFO_RX_BASE_ADDR, 0])[1]
+        return self.read_shadowed(REG.LORA.FIFO_RX_BASE_ADDR)[0]
 
     def set_fifo_rx_base_addr(self, ptr):
-        return self.spi.xfer([REG.LORA.FIFO_RX_BASE_ADDR | 0x80, ptr])[1]
+        return self.write_shadowed(REG.LORA.FIFO_RX_BASE_ADDR, [ptr])[0]
 
     def get_fifo_rx_current_addr(self):
         return self.spi.xfer([REG.LORA.FIFO_RX_CURR_ADDR, 0])[1]
@@ -405,42 +516,22 @@ class LoRa(object):
         return self.spi.xfer([REG.LORA.FIFO_RX_BYTE_ADDR, 0])[1]
 
     def get_irq_flags_mask(self):
-        v = self.spi.xfer([REG.LORA.IRQ_FLAGS_MASK, 0])[1]
-        return dict(
-                rx_timeout     = v >> 7 & 0x01,
-                rx_done        = v >> 6 & 0x01,
-                crc_error      = v >> 5 & 0x01,
-                valid_header   = v >> 4 & 0x01,
-                tx_done        = v >> 3 & 0x01,
-                cad_done       = v >> 2 & 0x01,
-                fhss_change_ch = v >> 1 & 0x01,
-                cad_detected   = v >> 0 & 0x01,
-            )
+        return decode_irq_flags(self.read_shadowed(REG.LORA.IRQ_FLAGS_MASK)[0])
 
     def set_irq_flags_mask(self,
                            rx_timeout=None, rx_done=None, crc_error=None, valid_header=None, tx_done=None,
                            cad_done=None, fhss_change_ch=None, cad_detected=None):
         loc = locals()
-        v = self.spi.xfer([REG.LORA.IRQ_FLAGS_MASK, 0])[1]
+        v = self.read_shadowed(REG.LORA.IRQ_FLAGS_MASK)[0]
         for i, s in enumerate(['cad_detected', 'fhss_change_ch', 'cad_done', 'tx_done', 'valid_header',
                                'crc_error', 'rx_done', 'rx_timeout']):
             this_bit = locals()[s]
             if this_bit is not None:
                 v = set_bit(v, i, this_bit)
-        return self.spi.xfer([REG.LORA.IRQ_FLAGS_MASK | 0x80, v])[1]
+        return self.write_shadowed(REG.LORA.IRQ_FLAGS_MASK, [v])[0]
 
     def get_irq_flags(self):
-        v = self.spi.xfer([REG.LORA.IRQ_FLAGS, 0])[1]
-        return dict(
-                rx_timeout     = v >> 7 & 0x01,
-                rx_done        = v >> 6 & 0x01,
-                crc_error      = v >> 5 & 0x01,
-                valid_header   = v >> 4 & 0x01,
-                tx_done        = v >> 3 & 0x01,
-                cad_done       = v >> 2 & 0x01,
-                fhss_change_ch = v >> 1 & 0x01,
-                cad_detected   = v >> 0 & 0x01,
-            )
+        return decode_irq_flags(self.spi.xfer([REG.LORA.IRQ_FLAGS, 0])[1])
 
     def set_irq_flags(self,
                       rx_timeout=None, rx_done=None, crc_error=None, valid_header=None, tx_done=None,
@@ -479,50 +570,39 @@ class LoRa(object):
         return lsb + 256 * msb
 
     def get_modem_status(self):
-        status = self.spi.xfer([REG.LORA.MODEM_STAT, 0])[1]
-        return dict(
-                rx_coding_rate    = status >> 5 & 0x03,
-                modem_clear       = status >> 4 & 0x01,
-                header_info_valid = status >> 3 & 0x01,
-                rx_ongoing        = status >> 2 & 0x01,
-                signal_sync       = status >> 1 & 0x01,
-                signal_detected   = status >> 0 & 0x01
-            )
+        return decode_modem_status(self.spi.xfer([REG.LORA.MODEM_STAT, 0])[1])
 
     def get_pkt_snr_value(self):
-        v = self.spi.xfer([REG.LORA.PKT_SNR_VALUE, 0])[1]
-        return float(256-v) / 4.
+        return snr_from_register(self.spi.xfer([REG.LORA.PKT_SNR_VALUE, 0])[1])
 
     def get_pkt_rssi_value(self):
-        v = self.spi.xfer([REG.LORA.PKT_RSSI_VALUE, 0])[1]
-        return v - (164 if BOARD.low_band else 157)     # See datasheet 5.5.5. p. 87
+        return rssi_from_register(self.spi.xfer([REG.LORA.PKT_RSSI_VALUE, 0])[1])
+
+    def get_pkt_link_quality(self):
+        """ Read the SNR and RSSI of the last packet in one SPI transfer
+        :return: (SNR in dB, RSSI in dBm). Below 0 dB SNR the RSSI is corrected by the SNR, see datasheet 5.5.5.
+        :rtype: tuple
+        """
+        snr_value, rssi_value = self.read_registers(REG.LORA.PKT_SNR_VALUE, 2)
+        snr = snr_from_register(snr_value)
+        rssi = rssi_from_register(rssi_value)
+        return snr, (rssi + snr if snr < 0 else rssi)
 
     def get_rssi_value(self):
-        v = self.spi.xfer([REG.LORA.RSSI_VALUE, 0])[1]
-        return v - (164 if BOARD.low_band else 157)     # See datasheet 5.5.5. p. 87
+        return rssi_from_register(self.spi.xfer([REG.LORA.RSSI_VALUE, 0])[1])
 
     def get_hop_channel(self):
-        v = self.spi.xfer([REG.LORA.HOP_CHANNEL, 0])[1]
-        return dict(
-                pll_timeout          = v >> 7,
-                crc_on_payload       = v >> 6 & 0x01,
-                fhss_present_channel = v >> 5 & 0b111111
-            )
+        return decode_hop_channel(self.spi.xfer([REG.LORA.HOP_CHANNEL, 0])[1])
 
     def get_modem_config_1(self):
-        val = self.spi.xfer([REG.LORA.MODEM_CONFIG_1, 0])[1]
-        return dict(
-                bw = val >> 4 & 0x0F,
-                coding_rate = val >> 1 & 0x07,
-                implicit_header_mode = val & 0x01
-            )
+        return decode_modem_config_1(self.read_shadowed(REG.LORA.MODEM_CONFIG_1)[0])
         
     def set_modem_config_1(self, bw=None, coding_rate=None, implicit_header_mode=None):
         loc = locals()
         current = self.get_modem_config_1()
         loc = {s: current[s] if loc[s] is None else loc[s] for s in loc}
         val = loc['implicit_header_mode'] | (loc['coding_rate'] << 1) | (loc['bw'] << 4)
-        return self.spi.xfer([REG.LORA.MODEM_CONFIG_1 | 0x80, val])[1]
+        return self.write_shadowed(REG.LORA.MODEM_CONFIG_1, [val])[0]
 
     def set_bw(self, bw):
         """ Set the bandwidth 0=7.8kHz ... 9=500kHz
@@ -542,15 +622,7 @@ class LoRa(object):
         self.set_modem_config_1(implicit_header_mode=implicit_header_mode)
         
     def get_modem_config_2(self, include_symb_timout_lsb=False):
-        val = self.spi.xfer([REG.LORA.MODEM_CONFIG_2, 0])[1]
-        d = dict(
-                spreading_factor = val >> 4 & 0x0F,
-                tx_cont_mode = val >> 3 & 0x01,
-                rx_crc = val >> 2 & 0x01,
-            )
-        if include_symb_timout_lsb:
-            d['symb_timout_lsb'] = val & 0x03
-        return d
+        return decode_modem_config_2(self.read_shadowed(REG.LORA.MODEM_CONFIG_2)[0], include_symb_timout_lsb)
         
     def set_modem_config_2(self, spreading_factor=None, tx_cont_mode=None, rx_crc=None):
         loc = locals()
@@ -558,7 +630,7 @@ class LoRa(object):
         current = self.get_modem_config_2(include_symb_timout_lsb=True)
         loc = {s: current[s] if loc[s] is None else loc[s] for s in loc}
         val = (loc['spreading_factor'] << 4) | (loc['tx_cont_mode'] << 3) | (loc['rx_crc'] << 2) | current['symb_timout_lsb']
-        return self.spi.xfer([REG.LORA.MODEM_CONFIG_2 | 0x80, val])[1]
+        return self.write_shadowed(REG.LORA.MODEM_CONFIG_2, [val])[0]
 
     def set_spreading_factor(self, spreading_factor):
         self.set_modem_config_2(spreading_factor=spreading_factor)
@@ -567,18 +639,14 @@ class LoRa(object):
         self.set_modem_config_2(rx_crc=rx_crc)
 
     def get_modem_config_3(self):
-        val = self.spi.xfer([REG.LORA.MODEM_CONFIG_3, 0])[1]
-        return dict(
-                low_data_rate_optim = val >> 3 & 0x01,
-                agc_auto_on = val >> 2 & 0x01
-            )
+        return decode_modem_config_3(self.read_shadowed(REG.LORA.MODEM_CONFIG_3)[0])
 
     def set_modem_config_3(self, low_data_rate_optim=None, agc_auto_on=None):
         loc = locals()
         current = self.get_modem_config_3()
         loc = {s: current[s] if loc[s] is None else loc[s] for s in loc}
         val = (loc['low_data_rate_optim'] << 3) | (loc['agc_auto_on'] << 2)
-        return self.spi.xfer([REG.LORA.MODEM_CONFIG_3 | 0x80, val])[1]
+        return self.write_shadowed(REG.LORA.MODEM_CONFIG_3, [val])[0]
 
     @setter(REG.LORA.INVERT_IQ)
     def set_invert_iq(self, invert):
@@ -609,27 +677,27 @@ class LoRa(object):
 
     def get_symb_timeout(self):
         SYMB_TIMEOUT_MSB = REG.LORA.MODEM_CONFIG_2
-        msb, lsb = self.spi.xfer([SYMB_TIMEOUT_MSB, 0, 0])[1:]    # the MSB bits are stored in REG.LORA.MODEM_CONFIG_2
+        msb, lsb = self.read_shadowed(SYMB_TIMEOUT_MSB, 2)    # the MSB bits are stored in REG.LORA.MODEM_CONFIG_2
         msb = msb & 0b11
         return lsb + 256 * msb
 
     def set_symb_timeout(self, timeout):
-        bkup_reg_modem_config_2 = self.spi.xfer([REG.LORA.MODEM_CONFIG_2, 0])[1]
+        bkup_reg_modem_config_2 = self.read_shadowed(REG.LORA.MODEM_CONFIG_2)[0]
         msb = timeout >> 8 & 0b11    # bits 8-9
         lsb = timeout - 256 * msb    # bits 0-7
         reg_modem_config_2 = bkup_reg_modem_config_2 & 0xFC | msb    # bits 2-7 of bkup_reg_modem_config_2 ORed with the two msb bits
-        old_msb = self.spi.xfer([REG.LORA.MODEM_CONFIG_2  | 0x80, reg_modem_config_2])[1] & 0x03
-        old_lsb = self.spi.xfer([REG.LORA.SYMB_TIMEOUT_LSB | 0x80, lsb])[1]
+        old_msb = self.write_shadowed(REG.LORA.MODEM_CONFIG_2, [reg_modem_config_2])[0] & 0x03
+        old_lsb = self.write_shadowed(REG.LORA.SYMB_TIMEOUT_LSB, [lsb])[0]
         return old_lsb + 256 * old_msb
 
     def get_preamble(self):
-        msb, lsb = self.spi.xfer([REG.LORA.PREAMBLE_MSB, 0, 0])[1:]
+        msb, lsb = self.read_shadowed(REG.LORA.PREAMBLE_MSB, 2)
         return lsb + 256 * msb
 
     def set_preamble(self, preamble):
         msb = preamble >> 8
         lsb = preamble - msb * 256
-        old_msb, old_lsb = self.spi.xfer([REG.LORA.PREAMBLE_MSB | 0x80, msb, lsb])[1:]
+        old_msb, old_lsb = self.write_shadowed(REG.LORA.PREAMBLE_MSB, [msb, lsb])
         return old_lsb + 256 * old_msb
         
     @getter(REG.LORA.PAYLOAD_LENGTH)
@@ -875,17 +943,93 @@ class LoRa(object):
         return result_list
 
     def get_register(self, register_address):
-        return self.spi.xfer([register_address & 0x7F, 0])[1]
+        return self.read_shadowed(register_address & 0x7F)[0]
 
     def set_register(self, register_address, val):
-        return self.spi.xfer([register_address | 0x80, val])[1]
+        return self.write_shadowed(register_address & 0x7F, [val])[0]
+
+    def read_registers(self, register_address, count):
+        """ Read count consecutive registers in one SPI transfer, relying on the chip's address auto-increment
+        :param register_address: Address of the first register
+        :param count: Number of registers
+        :return: Register values
+        :rtype: list[int]
+        """
+        return self.spi.xfer([register_address & 0x7F] + [0] * count)[1:]
+
+    def write_registers(self, register_address, values):
+        """ Write consecutive registers in one SPI transfer
+        :param register_address: Address of the first register
+        :param values: Register values
+        :return: Previous register values
+        :rtype: list[int]
+        """
+        return self.spi.xfer([register_address | 0x80] + list(values))[1:]
 
     def get_all_registers(self):
         # read all registers
-        reg = [0] + self.spi.xfer([1]+[0]*0x3E)[1:]
+        reg = [0] + self.read_registers(1, 0x3E)
         self.mode = reg[1]
+        if self.shadow is not None and self.mode & LONG_RANGE_MODE:
+            for register_address in SHADOWED_REGISTERS:
+                if register_address < len(reg):
+                    self.shadow[register_address] = reg[register_address]
         return reg
 
+    def shadowing(self):
+        """ True if register reads may be served from the shadow: it is on, and the chip is in LoRa mode """
+        return self.shadow is not None and self.mode is not None and self.mode & LONG_RANGE_MODE
+
+    def read_shadowed(self, register_address, count=1):
+        """ Read count consecutive registers, from the shadow if it holds all of them
+        :param register_address: Address of the first register
+        :param count: Number of registers
+        :return: Register values
+        :rtype: list[int]
+        """
+        shadow = self.shadow
+        addresses = range(register_address, register_address + count)
+        if self.shadowing() and all([a in shadow for a in addresses]):
+            self.spi_saved += 1
+            return [shadow[a] for a in addresses]
+        values = self.read_registers(register_address, count)
+        if self.shadowing():
+            for a, v in zip(addresses, values):
+                if a in SHADOWED_REGISTERS:
+                    shadow[a] = v
+        return values
+
+    def write_shadowed(self, register_address, values):
+        """ Write consecutive registers, keeping the shadow up to date
+        :param register_address: Address of the first register
+        :param values: Register values
+        :return: Previous register values
+        :rtype: list[int]
+        """
+        old = self.write_registers(register_address, values)
+        if self.shadowing():
+            for a, v in zip(range(register_address, register_address + len(values)), values):
+                if a in SHADOWED_REGISTERS:
+                    self.shadow[a] = v
+        return old
+
+    def verify_shadow(self, resync=False):
+        """ Compare the shadow with the chip, register by register
+        :param resync: Replace the shadowed values that differ with those read from the chip
+        :return: Dict of register address -> (shadowed value, chip value) for every register that differs
+        :rtype: dict
+        """
+        mismatches = {}
+        if not self.shadowing():
+            return mismatches
+        for register_address, value in sorted(self.shadow.items()):
+            actual = self.spi.xfer([register_address, 0])[1]
+            if actual != value:
+                mismatches[register_address] = (value, actual)
+                if resync:
+                    self.shadow[register_address] = actual
+        return mismatches
+
     def __del__(self):
         self.set_mode(MODE.SLEEP)
         if self.verbose:
@@ -895,16 +1039,22 @@ class LoRa(object):
         # don't use __str__ while in any mode other that SLEEP or STDBY
         assert(self.mode == MODE.SLEEP or self.mode == MODE.STDBY)
 
+        # two bursts read every register shown: 0x00-0x42 and 0x4B-0x4D
+        r = [0] + self.read_registers(1, REG.LORA.VERSION)
+        r += [0] * (REG.LORA.TCXO - len(r)) + self.read_registers(REG.LORA.TCXO, REG.LORA.PA_DAC - REG.LORA.TCXO + 1)
+
         onoff = lambda i: 'ON' if i else 'OFF'
-        f = self.get_freq()
-        cfg1 = self.get_modem_config_1()
-        cfg2 = self.get_modem_config_2()
-        cfg3 = self.get_modem_config_3()
-        pa_config = self.get_pa_config(convert_dBm=True)
-        ocp = self.get_ocp(convert_mA=True)
-        lna = self.get_lna()
+        f = (r[REG.LORA.FR_LSB] + 256 * (r[REG.LORA.FR_MID] + 256 * r[REG.LORA.FR_MSB])) / 16384.
+        cfg1 = decode_modem_config_1(r[REG.LORA.MODEM_CONFIG_1])
+        cfg2 = decode_modem_config_2(r[REG.LORA.MODEM_CONFIG_2])
+        cfg3 = decode_modem_config_3(r[REG.LORA.MODEM_CONFIG_3])
+        pa_config = decode_pa_config(r[REG.LORA.PA_CONFIG], convert_dBm=True)
+        ocp = decode_ocp(r[REG.LORA.OCP], convert_mA=True)
+        lna = decode_lna(r[REG.LORA.LNA])
+        pa_dac = r[REG.LORA.PA_DAC] & 0x07
+        word = lambda msb: r[msb + 1] + 256 * r[msb]
         s =  "SX127x LoRa registers:\n"
-        s += " mode               %s\n" % MODE.lookup[self.get_mode()]
+        s += " mode               %s\n" % MODE.lookup[r[REG.LORA.OP_MODE]]
         s += " freq               %f MHz\n" % f
         s += " coding_rate        %s\n" % CODING_RATE.lookup[cfg1['coding_rate']]
         s += " bw                 %s\n" % BW.lookup[cfg1['bw']]
@@ -912,23 +1062,23 @@ class LoRa(object):
         s += " implicit_hdr_mode  %s\n" % onoff(cfg1['implicit_header_mode'])
         s += " rx_payload_crc     %s\n" % onoff(cfg2['rx_crc'])
         s += " tx_cont_mode       %s\n" % onoff(cfg2['tx_cont_mode'])
-        s += " preamble           %d\n" % self.get_preamble()
+        s += " preamble           %d\n" % word(REG.LORA.PREAMBLE_MSB)
         s += " low_data_rate_opti %s\n" % onoff(cfg3['low_data_rate_optim'])
         s += " agc_auto_on        %s\n" % onoff(cfg3['agc_auto_on'])
-        s += " symb_timeout       %s\n" % self.get_symb_timeout()
-        s += " freq_hop_period    %s\n" % self.get_hop_period()
-        s += " hop_channel        %s\n" % self.get_hop_channel()
-        s += " payload_length     %s\n" % self.get_payload_length()
-        s += " max_payload_length %s\n" % self.get_max_payload_length()
-        s += " irq_flags_mask     %s\n" % self.get_irq_flags_mask()
-        s += " irq_flags          %s\n" % self.get_irq_flags()
-        s += " rx_nb_byte         %d\n" % self.get_rx_nb_bytes()
-        s += " rx_header_cnt      %d\n" % self.get_rx_header_cnt()
-        s += " rx_packet_cnt      %d\n" % self.get_rx_packet_cnt()
-        s += " pkt_snr_value      %f\n" % self.get_pkt_snr_value()
-        s += " pkt_rssi_value     %d\n" % self.get_pkt_rssi_value()
-        s += " rssi_value         %d\n" % self.get_rssi_value()
-        s += " fei                %d\n" % self.get_fei()
+        s += " symb_timeout       %s\n" % (r[REG.LORA.SYMB_TIMEOUT_LSB] + 256 * (r[REG.LORA.MODEM_CONFIG_2] & 0b11))
+        s += " freq_hop_period    %s\n" % r[REG.LORA.HOP_PERIOD]
+        s += " hop_channel        %s\n" % decode_hop_channel(r[REG.LORA.HOP_CHANNEL])
+        s += " payload_length     %s\n" % r[REG.LORA.PAYLOAD_LENGTH]
+        s += " max_payload_length %s\n" % r[REG.LORA.MAX_PAYLOAD_LENGTH]
+        s += " irq_flags_mask     %s\n" % decode_irq_flags(r[REG.LORA.IRQ_FLAGS_MASK])
+        s += " irq_flags          %s\n" % decode_irq_flags(r[REG.LORA.IRQ_FLAGS])
+        s += " rx_nb_byte         %d\n" % r[REG.LORA.RX_NB_BYTES]
+        s += " rx_header_cnt      %d\n" % word(REG.LORA.RX_HEADER_CNT_MSB)
+        s += " rx_packet_cnt      %d\n" % word(REG.LORA.RX_PACKET_CNT_MSB)
+        s += " pkt_snr_value      %f\n" % snr_from_register(r[REG.LORA.PKT_SNR_VALUE])
+        s += " pkt_rssi_value     %d\n" % rssi_from_register(r[REG.LORA.PKT_RSSI_VALUE])
+        s += " rssi_value         %d\n" % rssi_from_register(r[REG.LORA.RSSI_VALUE])
+        s += " fei                %d\n" % (r[REG.LORA.FEI_MSB + 2] + 256 * (r[REG.LORA.FEI_MSB + 1] + 256 * (r[REG.LORA.FEI_MSB] & 0x0F)))
         s += " pa_select          %s\n" % PA_SELECT.lookup[pa_config['pa_select']]
         s += " max_power          %f dBm\n" % pa_config['max_power']
         s += " output_power       %f dBm\n" % pa_config['output_power']
@@ -937,17 +1087,17 @@ class LoRa(object):
         s += " lna_gain           %s\n" % GAIN.lookup[lna['lna_gain']]
         s += " lna_boost_lf       %s\n" % bin(lna['lna_boost_lf'])
         s += " lna_boost_hf       %s\n" % bin(lna['lna_boost_hf'])
-        s += " detect_optimize    %#02x\n" % self.get_detect_optimize()
-        s += " detection_thresh   %#02x\n" % self.get_detection_threshold()
-        s += " sync_word          %#02x\n" % self.get_sync_word()
-        s += " dio_mapping 0..5   %s\n" % self.get_dio_mapping()
-        s += " tcxo               %s\n" % ['XTAL', 'TCXO'][self.get_tcxo()]
-        s += " pa_dac             %s\n" % ['default', 'PA_BOOST'][self.get_pa_dac()]
-        s += " fifo_addr_ptr      %#02x\n" % self.get_fifo_addr_ptr()
-        s += " fifo_tx_base_addr  %#02x\n" % self.get_fifo_tx_base_addr()
-        s += " fifo_rx_base_addr  %#02x\n" % self.get_fifo_rx_base_addr()
-        s += " fifo_rx_curr_addr  %#02x\n" % self.get_fifo_rx_current_addr()
-        s += " fifo_rx_byte_addr  %#02x\n" % self.get_fifo_rx_byte_addr()
-        s += " status             %s\n" % self.get_modem_status()
-        s += " version            %#02x\n" % self.get_version()
+        s += " detect_optimize    %#02x\n" % (r[REG.LORA.DETECT_OPTIMIZE] & 0b111)
+        s += " detection_thresh   %#02x\n" % r[REG.LORA.DETECTION_THRESH]
+        s += " sync_word          %#02x\n" % r[REG.LORA.SYNC_WORD]
+        s += " dio_mapping 0..5   %s\n" % decode_dio_mapping(r[REG.LORA.DIO_MAPPING_1], r[REG.LORA.DIO_MAPPING_2])
+        s += " tcxo               %s\n" % ['XTAL', 'TCXO'][r[REG.LORA.TCXO] >> 4 & 0x01]
+        s += " pa_dac             %s\n" % {0x04: 'default', 0x07: 'PA_BOOST'}.get(pa_dac, hex(pa_dac))
+        s += " fifo_addr_ptr      %#02x\n" % r[REG.LORA.FIFO_ADDR_PTR]
+        s += " fifo_tx_base_addr  %#02x\n" % r[REG.LORA.FIFO_TX_BASE_ADDR]
+        s += " fifo_rx_base_addr  %#02x\n" % r[REG.LORA.FIFO_RX_BASE_ADDR]
+        s += " fifo_rx_curr_addr  %#02x\n" % r[REG.LORA.FIFO_RX_CURR_ADDR]
+        s += " fifo_rx_byte_addr  %#02x\n" % r[REG.LORA.FIFO_RX_BYTE_ADDR]
+        s += " status             %s\n" % decode_modem_status(r[REG.LORA.MODEM_STAT])
+        s += " version            %#02x\n" % r[REG.LORA.VERSION]
         return s
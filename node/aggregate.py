@@ -0,0 +1,68 @@
+''' Running statistics of the readings taken between uplinks, so that a
+    response can summarise every reading instead of carrying one sample.
+    Each window holds a count, minimum, maximum and sum per value, so memory
+    does not grow with the number of readings.
+'''
+import threading
+
+class Window(object):
+    ''' Statistics of one sensor's readings, in wire units, since start
+    '''
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.minimum = None
+        self.maximum = None
+        self.total = None
+
+    def add(self, values):
+        if self.count == 0:
+            self.minimum = list(values)
+            self.maximum = list(values)
+            self.total = list(values)
+        else:
+            for i, value in enumerate(values):
+                if value < self.minimum[i]:
+                    self.minimum[i] = value
+                if value > self.maximum[i]:
+                    self.maximum[i] = value
+                self.total[i] += value
+        self.count += 1
+
+    def stats(self):
+        ''' (count, minimum, maximum, mean), as taken by Packet.createMultiSensorSummary '''
+        mean = tuple([int(round(float(total) / self.count)) for total in self.total])
+        return (self.count, tuple(self.minimum), tuple(self.maximum), mean)
+
+class WindowAggregator(object):
+    ''' The open window of each sensor of each Thingy. Readings are added from the BTLE
+        thread and windows taken from the LoRa side, so access is locked.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = {}
+
+    def add(self, sensorType, timestamp, values):
+        with self.lock:
+            window = self.windows.get(sensorType)
+            if window is None:
+                window = self.windows[sensorType] = Window(timestamp)
+            window.add(values)
+
+    def take(self, sensorTypes, now):
+        ''' Close the windows of the given sensors, starting new ones with the
+            next reading. Returns a dict of sensor type -> stats for the sensors
+            that had readings, and the length of the longest window in seconds.
+        '''
+        stats = {}
+        start = now
+        with self.lock:
+            for sensorType in sensorTypes:
+                window = self.windows.pop(sensorType, None)
+                if window is None or window.count == 0:
+                    continue
+                stats[sensorType] = window.stats()
+                start = min(start, window.start)
+        return stats, now - start
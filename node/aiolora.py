@@ -0,0 +1,87 @@
+''' asyncio interface to the SX127x radio, for Python 3.
+
+    LoRaUtil does the radio work in its DIO interrupt callbacks, on the GPIO
+    thread. This hands the RxDone and TxDone events over to an event loop
+    with call_soon_threadsafe, so that one thread can hold many
+    conversations without sleeping in polling loops:
+
+        radio = AsyncLoRa(LoRaUtil())
+        radio.listen()
+        sent = await radio.send(frame)
+        frame = await radio.recv(timeout=5)
+        async for frame in radio:
+            ...
+'''
+import asyncio
+
+from lora import RX_QUEUE_SIZE, TX_TIMEOUT_MARGIN
+
+class AsyncLoRa(object):
+    ''' Awaitable send and receive on a LoRaUtil. While attached, received
+        frames go to this object instead of LoRaUtil.recv.
+    '''
+
+    def __init__(self, radio, loop=None, rx_queue_size=RX_QUEUE_SIZE):
+        self.radio = radio
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.frames = asyncio.Queue(rx_queue_size)
+        self.dropped = 0
+        radio.frame_listener = self.onFrame
+
+    def close(self):
+        self.radio.frame_listener = None
+
+    def listen(self):
+        ''' Put the radio into continuous receive '''
+        self.radio.listen()
+
+    def onFrame(self, payload):
+        # called on the GPIO thread
+        self.loop.call_soon_threadsafe(self.deliver, payload)
+
+    def deliver(self, payload):
+        if self.frames.full():
+            # drop the oldest frame, as LoRaUtil does
+            self.frames.get_nowait()
+            self.dropped += 1
+        self.frames.put_nowait(payload)
+
+    async def send(self, frame):
+        ''' Queue a frame and wait for its TxDone. Returns False if the radio
+            gave up on it.
+        '''
+        future = self.loop.create_future()
+        request = self.radio.send(frame)
+        request.add_done_callback(lambda r: self.loop.call_soon_threadsafe(self.resolve, future, r))
+        # the transmit queue only moves on TxDone, so look out for a lost one
+        # for as long as this frame is waiting
+        timeout = self.radio.airtime(len(request.payload)) + TX_TIMEOUT_MARGIN
+        watchdog = [None]
+        def check():
+            self.radio.check_tx()
+            if not request.done.is_set():
+                watchdog[0] = self.loop.call_later(timeout, check)
+        watchdog[0] = self.loop.call_later(timeout, check)
+        try:
+            return await future
+        finally:
+            watchdog[0].cancel()
+
+    def resolve(self, future, request):
+        if not future.done():
+            future.set_result(request.ok)
+
+    async def recv(self, timeout=None):
+        ''' The next frame received, or False if none arrives within timeout seconds '''
+        if timeout is None:
+            return await self.frames.get()
+        try:
+            return await asyncio.wait_for(self.frames.get(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.frames.get()
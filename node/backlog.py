@@ -0,0 +1,176 @@
+''' Store-and-forward of the readings a node logs while the basestation
+    cannot hear it.
+
+    Readings always go to the data logs. While the node is out of contact
+    with the basestation, before it has joined or while requests stop
+    arriving, nothing else happens to them. When contact returns, the log
+    offsets written since the last contact are queued as a region per
+    log, one for each sensor of each Thingy, and uploaded oldest first in
+    BACKLOG_DATA frames whenever the basestation asks for them.
+
+    A region only shrinks once the basestation acknowledges the frame that
+    carried it, and the queue is saved next to each log, so readings survive
+    a restart. The queue is bounded by the logs' retention: readings pruned
+    from a log before they were uploaded are dropped.
+'''
+import os
+import threading
+
+from utils.utils import Packet, NO_SEQUENCE, BACKLOG_FRAME_SIZE, backlogFrameRecords
+from utils.tdma import BACKLOG_DUTY_CYCLE
+from datalog import parseRow
+
+# time without hearing from the basestation after which it is taken to be unreachable
+CONTACT_TIMEOUT = 60
+# how often the log offsets at the last contact are saved while in contact
+CHECKPOINT_INTERVAL = 60
+
+class Backlog(object):
+    ''' Regions of the data logs waiting to be uploaded, and the frame in flight
+    '''
+
+    def __init__(self, id, logs, profile, contact_timeout=CONTACT_TIMEOUT, duty_cycle=BACKLOG_DUTY_CYCLE):
+        self.id = id
+        self.logs = logs
+        self.profile = profile
+        self.contact_timeout = contact_timeout
+        self.duty_cycle = duty_cycle
+        self.lock = threading.Lock()
+        self.last_contact = None
+        self.checkpoint = 0
+        self.contact = {}       # (device, sensor) -> log end at the last contact
+        self.regions = {}       # (device, sensor) -> [[start, end], ...] log offsets to upload
+        self.sequence = 0
+        self.in_flight = None   # (sequence, (device, sensor), log offset after its rows, frame)
+        self.next_send = 0
+        self.sent = 0
+        self.dropped = 0
+        for key in logs:
+            self.load(key)
+
+    def path(self, key):
+        return os.path.join(self.logs[key].directory, 'backlog')
+
+    def load(self, key):
+        log = self.logs[key]
+        # without a saved queue, only readings from now on can be backed up
+        self.contact[key] = log.end()
+        self.regions[key] = []
+        try:
+            with open(self.path(key), 'r') as f:
+                lines = f.read().splitlines()
+            self.contact[key] = int(lines[0])
+            self.regions[key] = [[int(n) for n in line.split(',')] for line in lines[1:]]
+        except (IOError, IndexError, ValueError):
+            pass
+
+    def save(self, key):
+        name = self.path(key)
+        lines = [str(self.contact[key])] + ['%d,%d' % tuple(r) for r in self.regions[key]]
+        with open(name + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(name + '.tmp', name)
+
+    def inContact(self, now):
+        return self.last_contact is not None and now - self.last_contact <= self.contact_timeout
+
+    def onContact(self, now):
+        ''' Record that the basestation was heard from, queueing everything
+            logged since the last contact if it had been lost
+        '''
+        with self.lock:
+            lost = not self.inContact(now)
+            if lost:
+                for key, log in self.logs.items():
+                    if log.end() > self.contact[key]:
+                        self.regions[key].append([self.contact[key], log.end()])
+                        print('[BACKLOG] Queued %d bytes of device %d sensor %d readings' %
+                              ((log.end() - self.contact[key],) + key))
+            self.last_contact = now
+            for key, log in self.logs.items():
+                self.contact[key] = log.end()
+            if lost or now - self.checkpoint >= CHECKPOINT_INTERVAL:
+                for key in self.logs:
+                    self.save(key)
+                self.checkpoint = now
+
+    def pending(self, now):
+        ''' True if there are readings the basestation has not got '''
+        with self.lock:
+            if any(self.regions.values()):
+                return True
+            if self.inContact(now):
+                return False
+            return any([log.end() > self.contact[s] for s, log in self.logs.items()])
+
+    def nextFrame(self, now, max_size):
+        ''' The next BACKLOG_DATA frame of at most max_size bytes, or None if
+            there is nothing to send or the duty cycle budget is used up. The
+            previous frame is sent again until it is acknowledged.
+        '''
+        with self.lock:
+            if now < self.next_send:
+                return None
+            max_size = min(max_size, BACKLOG_FRAME_SIZE)
+            if self.in_flight is not None and len(self.in_flight[3]) > max_size:
+                self.in_flight = None
+            if self.in_flight is None:
+                self.in_flight = self.buildFrame(max_size)
+            if self.in_flight is None:
+                return None
+            frame = self.in_flight[3]
+            self.next_send = now + self.profile.airtime(len(frame)) / self.duty_cycle
+            self.sent += 1
+            return frame
+
+    def buildFrame(self, max_size):
+        for key in sorted(self.regions):
+            regions = self.regions[key]
+            log = self.logs[key]
+            # drop whatever the log has pruned since it was queued
+            while regions and regions[0][1] <= log.start():
+                self.dropped += regions[0][1] - regions[0][0]
+                regions.pop(0)
+            if regions and regions[0][0] < log.start():
+                self.dropped += log.start() - regions[0][0]
+                regions[0][0] = log.start()
+
+            while regions:
+                start, end = regions[0]
+                device, sensorType = key
+                count = backlogFrameRecords(sensorType, max_size)
+                if count == 0:
+                    return None
+                rows, after = log.readFrom(start, end, count)
+                data = []
+                for row in rows:
+                    try:
+                        data.append(parseRow(row))
+                    except ValueError:
+                        # a row cut short by a power loss
+                        pass
+                if data:
+                    more = after < end or sum([len(r) for r in self.regions.values()]) > 1
+                    pkt = Packet.createBacklogPacket(self.id, self.sequence, sensorType, data, more, device)
+                    return (self.sequence, key, after, Packet.encode_packet(pkt))
+                # nothing readable left in the region
+                regions[0][0] = after
+                if not rows or after >= end:
+                    regions.pop(0)
+        return None
+
+    def onAck(self, sequence):
+        ''' The basestation has the frame with this sequence number '''
+        with self.lock:
+            if self.in_flight is None or self.in_flight[0] != sequence:
+                return False
+            _, key, after, _ = self.in_flight
+            self.in_flight = None
+            self.sequence = (sequence + 1) % NO_SEQUENCE
+            regions = self.regions[key]
+            if regions:
+                regions[0][0] = after
+                if after >= regions[0][1]:
+                    regions.pop(0)
+            self.save(key)
+            return True
@@ -0,0 +1,290 @@
+''' Segmented, rotating log of sensor readings on the node.
+
+    Rows are appended to numbered CSV segments, each starting with the log's
+    header, with a small index next to them:
+
+        <directory>/index           one INDEX_ENTRY per segment
+        <directory>/<segment>.csv
+
+    A segment is closed once it holds max_segment_bytes or its first row is
+    max_segment_age seconds old. Each index entry holds the segment number,
+    the timestamp of its first row and its log offset: the number of bytes
+    written to the log before it. Log offsets keep counting up as old
+    segments are pruned, so they can be used as positions in the log.
+
+    Segments are deleted oldest first once the log holds more than max_bytes,
+    or once all their rows are older than max_age, so disk use stays bounded.
+'''
+import os
+import struct
+import threading
+
+from utils.utils import Packet, LEGACY_ROW_FIELDS
+
+INDEX_ENTRY = struct.Struct('<IdQ')     # segment | first timestamp | log offset
+
+MAX_SEGMENT_BYTES = 1024 * 1024
+MAX_SEGMENT_AGE = 24 * 60 * 60
+# retention, None for no limit
+MAX_LOG_BYTES = 64 * 1024 * 1024
+MAX_LOG_AGE = None
+
+# bytes read from the end of a segment at a time when looking for its last row
+TAIL_BLOCK_SIZE = 256
+
+def rowTimestamp(row):
+    return float(row.split(',', 1)[0])
+
+def parseRow(row):
+    ''' Split a row into its timestamp string, position in micro-degrees and
+        integer values
+    '''
+    tokens = row.split(',')
+    if len(tokens) >= LEGACY_ROW_FIELDS:
+        # convert from the strings, which keep the decimal minutes' leading zeros
+        tokens[1:7] = [Packet.encodeGps(tokens[1:4]), Packet.encodeGps(tokens[4:7])]
+    tokens[1:] = [int(t) for t in tokens[1:]]
+    return tokens
+
+def readLastRow(name):
+    ''' The last row of a segment, or None if it only holds the header '''
+    try:
+        f = open(name, 'rb')
+    except IOError:
+        return None
+    # read backwards from the end of the file until a whole line is found
+    with f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        block = TAIL_BLOCK_SIZE
+        while True:
+            start = max(size - block, 0)
+            f.seek(start)
+            lines = f.read(size - start).splitlines()
+            if start == 0 or len(lines) > 2:
+                break
+            block *= 2
+    # the first line is cut short, or is the header
+    if len(lines) < 2:
+        return None
+    return lines[-1].decode('ascii')
+
+def trimPartialRow(name):
+    ''' Cut a row left unfinished by a power loss from the end of a segment,
+        so the next row starts on a line of its own. Returns the segment's size.
+    '''
+    try:
+        f = open(name, 'r+b')
+    except IOError:
+        return 0
+    with f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        end = size
+        # read backwards from the end of the file until a newline is found
+        while end > 0:
+            start = max(end - TAIL_BLOCK_SIZE, 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+    return end
+
+class SegmentedLog(object):
+    ''' Append-only log of CSV rows, each starting with a timestamp, for one sensor.
+        Safe to append from one thread and read from others.
+    '''
+
+    def __init__(self, directory, header, max_segment_bytes=MAX_SEGMENT_BYTES, max_segment_age=MAX_SEGMENT_AGE,
+                 max_bytes=MAX_LOG_BYTES, max_age=MAX_LOG_AGE):
+        self.directory = directory
+        self.header = header
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.handle = None
+        self.size = 0       # bytes in the current segment
+        self.last = None    # last row appended
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index = self.readIndex()
+        if self.index:
+            self.size = trimPartialRow(self.segmentPath(self.index[-1][0]))
+        for segment, _, _ in reversed(self.index):
+            self.last = readLastRow(self.segmentPath(segment))
+            if self.last is not None:
+                break
+
+    def segmentPath(self, segment):
+        return os.path.join(self.directory, '%06d.csv' % segment)
+
+    def readIndex(self):
+        try:
+            with open(os.path.join(self.directory, 'index'), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return []
+        n = len(data) // INDEX_ENTRY.size
+        return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(n)]
+
+    def writeIndex(self):
+        name = os.path.join(self.directory, 'index')
+        with open(name + '.tmp', 'wb') as f:
+            for entry in self.index:
+                f.write(INDEX_ENTRY.pack(*entry))
+        os.rename(name + '.tmp', name)
+
+    def start(self):
+        ''' Log offset of the oldest segment still kept '''
+        if not self.index:
+            return 0
+        return self.index[0][2]
+
+    def end(self):
+        ''' Log offset just past the last row '''
+        if not self.index:
+            return 0
+        return self.index[-1][2] + self.size
+
+    def append(self, timestamp, row, flush=True):
+        ''' Append a row, which starts with its timestamp. Returns its log offset.
+            Without flush the row may wait in the file buffer until commit().
+        '''
+        with self.lock:
+            if (not self.index or self.size >= self.max_segment_bytes
+                    or timestamp - self.index[-1][1] >= self.max_segment_age):
+                self.roll(timestamp)
+            if self.handle is None:
+                self.handle = open(self.segmentPath(self.index[-1][0]), 'a')
+                if self.size == 0:
+                    self.handle.write(self.header + '\n')
+                    self.size = len(self.header) + 1
+            offset = self.end()
+            line = row + '\n'
+            self.handle.write(line)
+            if flush:
+                self.handle.flush()
+            self.size += len(line)
+            self.last = row
+            return offset
+
+    def roll(self, timestamp):
+        ''' Start a new segment, then apply the retention limits '''
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+        if self.index:
+            segment, _, offset = self.index[-1]
+            entry = (segment + 1, timestamp, offset + self.size)
+        else:
+            entry = (0, timestamp, 0)
+        self.index.append(entry)
+        with open(os.path.join(self.directory, 'index'), 'ab') as f:
+            f.write(INDEX_ENTRY.pack(*entry))
+        self.size = 0
+        self.prune(timestamp)
+
+    def prune(self, now):
+        removed = False
+        while len(self.index) > 1:
+            too_big = self.max_bytes is not None and self.end() - self.index[0][2] > self.max_bytes
+            # the next segment starts after every row in the first
+            too_old = self.max_age is not None and self.index[1][1] <= now - self.max_age
+            if not (too_big or too_old):
+                break
+            try:
+                os.remove(self.segmentPath(self.index[0][0]))
+            except OSError:
+                pass
+            del self.index[0]
+            removed = True
+        if removed:
+            self.writeIndex()
+
+    def latest(self):
+        ''' The last row in the log, or None if it is empty '''
+        return self.last
+
+    def read(self, start, end):
+        ''' Yield the rows with timestamps in [start, end), oldest first '''
+        with self.lock:
+            index = list(self.index)
+        for i, (segment, first, _) in enumerate(index):
+            if first >= end:
+                break
+            if i + 1 < len(index) and index[i + 1][1] <= start:
+                continue
+            try:
+                f = open(self.segmentPath(segment), 'r')
+            except IOError:
+                # pruned since the index was copied
+                continue
+            with f:
+                f.readline()
+                for line in f:
+                    # a row cut short by a power loss has no newline
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        timestamp = rowTimestamp(line)
+                    except ValueError:
+                        continue
+                    if timestamp >= end:
+                        return
+                    if timestamp >= start:
+                        yield line.rstrip('\n')
+
+    def readFrom(self, offset, end, max_rows):
+        ''' Read up to max_rows rows starting at a log offset and stopping
+            before end. Returns the rows and the log offset after the last one.
+        '''
+        with self.lock:
+            index = list(self.index)
+        rows = []
+        for i, (segment, _, segment_offset) in enumerate(index):
+            if i + 1 < len(index) and index[i + 1][2] <= offset:
+                continue
+            if segment_offset >= end or len(rows) >= max_rows:
+                break
+            try:
+                f = open(self.segmentPath(segment), 'r')
+            except IOError:
+                continue
+            with f:
+                if offset > segment_offset:
+                    f.seek(offset - segment_offset)
+                else:
+                    # skip the header
+                    offset = segment_offset + len(f.readline())
+                while len(rows) < max_rows and offset < end:
+                    line = f.readline()
+                    if not line.endswith('\n'):
+                        # the end of the segment, or a row cut short by a power loss
+                        if i + 1 < len(index):
+                            offset = index[i + 1][2]
+                        break
+                    rows.append(line.rstrip('\n'))
+                    offset += len(line)
+        return rows, offset
+
+    def commit(self, sync=False):
+        ''' Write out buffered rows, and with sync wait until they are on storage '''
+        with self.lock:
+            if self.handle is None:
+                return
+            self.handle.flush()
+            if sync:
+                os.fsync(self.handle.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
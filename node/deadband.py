@@ -0,0 +1,52 @@
+''' Report by exception: a sensor's reading is only sent once it has moved
+    by more than the sensor's deadband since it was last sent, or when the
+    sensor has been silent for too long. The basestation takes a silent
+    sensor to be unchanged.
+
+    Deadbands are given per sensor type as (ABSOLUTE, threshold) in the
+    fixed point units sent on the wire, or (RELATIVE, fraction) of the last
+    value sent. A sensor without a deadband is always sent.
+'''
+import threading
+
+ABSOLUTE = 0
+RELATIVE = 1
+
+class ReportFilter(object):
+    ''' The values last sent for each (device, sensor type), and when
+    '''
+
+    def __init__(self, deadbands, max_silence):
+        self.deadbands = deadbands
+        self.max_silence = max_silence
+        self.lock = threading.Lock()
+        self.sent = {}      # key -> (time sent, wire values)
+        self.suppressed = 0
+
+    def exceeds(self, sensorType, last, values):
+        kind, threshold = self.deadbands[sensorType]
+        for old, new in zip(last, values):
+            limit = threshold if kind == ABSOLUTE else abs(old) * threshold
+            if abs(new - old) > limit:
+                return True
+        return False
+
+    def changed(self, key, values, now):
+        ''' True if the reading should be sent. values are wire values, as
+            returned by Packet.encodeSensorValues.
+        '''
+        sensorType = key[1]
+        with self.lock:
+            if sensorType not in self.deadbands:
+                return True
+            last = self.sent.get(key)
+            if last is None or now - last[0] >= self.max_silence:
+                return True
+            if self.exceeds(sensorType, last[1], values):
+                return True
+            self.suppressed += 1
+            return False
+
+    def onSent(self, key, values, now):
+        with self.lock:
+            self.sent[key] = (now, tuple(values))
@@ -0,0 +1,71 @@
+''' Measures the struct based Thingy payload decoding against the original
+    hex string parsing of LoRaSenseDelegate. Run from the node directory with:
+
+        python decode_bench.py
+'''
+import binascii
+import math
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.utils import SensorType, ALL_SENSORS
+from thingydecode import decodeReading
+
+# notification payloads as sent by the Thingy
+PAYLOADS = {
+    SensorType.TEMP: bytearray([21, 37]),
+    SensorType.HUMID: bytearray([48]),
+    SensorType.AIR_QUAL: bytearray([0x9c, 0x01, 27, 0]),
+    SensorType.PRESS: bytearray([0xf5, 0x03, 0, 0, 25]),
+}
+NAMES = {SensorType.TEMP: 'TEMP', SensorType.HUMID: 'HUMID', SensorType.AIR_QUAL: 'AIR_QUAL', SensorType.PRESS: 'PRESS'}
+
+def splitFloatToStr(value):
+    value = float(value)
+    frac, whole = math.modf(value)
+    frac = frac * 100
+    return [str(int(whole)), str(int(frac))]
+
+def str_to_int(s):
+    i = int(s, 16)
+    if i >= 2**7:
+        i -= 2**8
+    return i
+
+def legacy_decode(sensorType, data):
+    ''' The original LoRaSenseDelegate decoding, kept here for comparison '''
+    if sensorType == SensorType.TEMP:
+        temp = binascii.b2a_hex(data)
+        return splitFloatToStr('{}.{}'.format(str_to_int(temp[:-2]), int(temp[-2:], 16)))
+    elif sensorType == SensorType.PRESS:
+        val = binascii.b2a_hex(data)
+        pressure_int = 0
+        for i in range(0, 4):
+            pressure_int += (int(val[i*2:(i*2)+2], 16) << 8*i)
+        return splitFloatToStr('{}.{}'.format(pressure_int, int(val[-2:], 16)))
+    elif sensorType == SensorType.HUMID:
+        return ['{}'.format(str_to_int(binascii.b2a_hex(data)))]
+    val = binascii.b2a_hex(data)
+    eco2 = int(val[:2], 16) + (int(val[2:4], 16) << 8)
+    tvoc = int(val[4:6], 16) + (int(val[6:8], 16) << 8)
+    return [str(eco2), str(tvoc)]
+
+def rate(stmt, number):
+    return number / min(timeit.repeat(stmt, repeat=3, number=number))
+
+def main(number=50000):
+    print('%-9s %16s %16s %12s %12s' % ('sensor', 'hex', 'struct', 'hex dec/s', 'struct dec/s'))
+    for sensorType in ALL_SENSORS:
+        data = bytes(PAYLOADS[sensorType])
+        legacy = legacy_decode(sensorType, data)
+        values = decodeReading(sensorType, data)
+        legacy_dec = rate(lambda: legacy_decode(sensorType, data), number)
+        dec = rate(lambda: decodeReading(sensorType, data), number)
+        print('%-9s %16s %16s %12d %12d' % (NAMES[sensorType], ','.join(legacy), ','.join([str(v) for v in values]),
+                                            legacy_dec, dec))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+''' Counters for the BTLE ingest path: how many notifications arrive and how
+    long handling each of them takes.
+'''
+import threading
+import time
+
+class IngestStats(object):
+    ''' Updated from the listener thread of every Thingy, so access is locked
+    '''
+
+    def __init__(self, report_interval, now=None):
+        self.lock = threading.Lock()
+        self.report_interval = report_interval
+        self.notifications = 0
+        # notifications, time spent handling them and the longest of them in this interval
+        self.count = 0
+        self.handled_time = 0.
+        self.max_latency = 0.
+        self.last_report = time.time() if now is None else now
+
+    def onNotification(self, latency):
+        with self.lock:
+            self.notifications += 1
+            self.count += 1
+            self.handled_time += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+
+    def meanLatency(self):
+        ''' Mean handling time in this interval '''
+        if self.count == 0:
+            return 0.
+        return self.handled_time / self.count
+
+    def report(self, now=None):
+        ''' Once every report interval, returns (notifications per second, mean
+            latency, max latency) since the last report and starts a new
+            interval. Returns None otherwise.
+        '''
+        now = time.time() if now is None else now
+        with self.lock:
+            elapsed = now - self.last_report
+            if elapsed < self.report_interval:
+                return None
+            result = (self.count / elapsed, self.meanLatency(), self.max_latency)
+            self.last_report = now
+            self.count = 0
+            self.handled_time = 0.
+            self.max_latency = 0.
+            return result
@@ -0,0 +1,106 @@
+''' Writes readings to the data logs on a thread of its own, so that slow
+    SD card writes do not hold up the BTLE notification callbacks.
+
+    Rows are handed over through a bounded queue and written in batches,
+    each committed once it holds max_rows rows or its first row has waited
+    max_age seconds. A full queue holds the caller back for up to a given
+    time, then drops the row; drops and the deepest the queue has been are
+    counted.
+'''
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from utils.sink import BUFFERED, SYNC
+
+WRITE_QUEUE_SIZE = 1024
+MAX_BATCH_ROWS = 32
+MAX_BATCH_AGE = 5.0
+
+class LogWriter(threading.Thread):
+    ''' Appends queued rows to a dict of (device, sensor type) -> SegmentedLog
+    '''
+
+    def __init__(self, logs, queue_size=WRITE_QUEUE_SIZE, max_rows=MAX_BATCH_ROWS, max_age=MAX_BATCH_AGE,
+                 durability=BUFFERED):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logs = logs
+        self.queue = queue.Queue(queue_size)
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.durability = durability
+        self.running = True
+        self.written = 0
+        self.batches = 0
+        # rows are submitted from the listener thread of every Thingy
+        self.submit_lock = threading.Lock()
+        self.dropped = 0
+        self.max_depth = 0
+
+    def submit(self, sensorType, timestamp, row, timeout=0):
+        ''' Queue a row for writing, waiting up to timeout seconds for room.
+            Returns False if it was dropped.
+        '''
+        try:
+            self.queue.put((sensorType, timestamp, row), timeout > 0, timeout)
+        except queue.Full:
+            with self.submit_lock:
+                self.dropped += 1
+            return False
+        with self.submit_lock:
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def run(self):
+        dropped = 0
+        while self.running or not self.queue.empty():
+            batch = self.collect()
+            if batch:
+                self.write(batch)
+            if self.dropped != dropped:
+                print('[WRITER] Queue full, dropped %d rows' % (self.dropped - dropped))
+                dropped = self.dropped
+
+    def collect(self):
+        # wait for a first row, then take more until the batch is full or old enough
+        try:
+            batch = [self.queue.get(timeout=self.max_age)]
+        except queue.Empty:
+            return []
+        end = time.time() + self.max_age
+        while len(batch) < self.max_rows:
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        touched = set()
+        for sensorType, timestamp, row in batch:
+            log = self.logs.get(sensorType)
+            if log is None:
+                continue
+            log.append(timestamp, row, flush=False)
+            touched.add(sensorType)
+        for sensorType in touched:
+            self.logs[sensorType].commit(self.durability == SYNC)
+        self.written += len(batch)
+        self.batches += 1
+
+    def stop(self):
+        ''' Write out everything queued and stop '''
+        self.running = False
+        if self.is_alive():
+            self.join()
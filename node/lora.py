@@ -24,50 +24,270 @@
 
 import threading
 import time
+from collections import deque
 from SX127x.LoRa import *
 from SX127x.LoRaArgumentParser import LoRaArgumentParser
 from SX127x.board_config import BOARD
+from utils.airtime import RadioProfile, needs_low_data_rate_optim
+from utils.backoff import ListenBeforeTalk
+from utils.clock import monotonic
 
 BOARD.setup()
 
+# frames held for recv(); once full, the oldest frame is dropped for each new one
+RX_QUEUE_SIZE = 32
+# RegDioMapping1 with DIO0 signalling RxDone (00) or TxDone (01)
+DIO_MAPPING_RX = 0x00
+DIO_MAPPING_TX = 0x40
+# and with DIO0 signalling CadDone (10), for listen-before-talk
+DIO_MAPPING_CAD = 0x80
+# a frame whose TxDone has not arrived this long after its airtime is given up on
+TX_TIMEOUT_MARGIN = 1.0
+# listen-before-talk backs off for about the airtime of a frame this long when the channel is busy
+LBT_FRAME_SIZE = 32
+
+class TxRequest(object):
+    """ Completion handle of a frame queued by LoRaUtil.send """
+
+    def __init__(self, payload, deadline=None):
+        self.payload = payload
+        # latest time the frame may start, after which it is dropped instead
+        self.deadline = deadline
+        self.done = threading.Event()
+        self.ok = False
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # channel checks that found the channel busy
+        self.attempts = 0
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        """ Wait for the frame to be sent. Returns True once it has been """
+        self.done.wait(timeout)
+        return self.ok
+
+    def add_done_callback(self, callback):
+        """ Call callback(request) once the frame has been sent or given up on. It is
+            called from the thread that completes the request, or at once if it has completed.
+        """
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def finish(self, ok):
+        self.ok = ok
+        self.finished_at = time.time()
+        with self.lock:
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def queue_delay(self):
+        return None if self.started_at is None else self.started_at - self.queued_at
+
+    def tx_time(self):
+        return None if self.finished_at is None or self.started_at is None else self.finished_at - self.started_at
+
 class LoRaUtil(LoRa):
-    def __init__(self, verbose=False, recv_timeout=10):
-        super(LoRaUtil, self).__init__()
-	self.init_lora(verbose)
-	self.rx_buffer = []
+    def __init__(self, verbose=False, recv_timeout=10, shadow_registers=True, rx_queue_size=RX_QUEUE_SIZE,
+                 listen_before_talk=False):
+        # received frames are queued from the GPIO interrupt thread, and a
+        # waiting recv() is woken as soon as one lands
+        self.rx_queue = deque(maxlen=rx_queue_size)
+        self.rx_ready = threading.Condition()
+        self.rx_dropped = 0
+        self.rx_high_water = 0
+        # if set, called with each received frame instead of queueing it for recv()
+        self.frame_listener = None
+        # SNR (dB) and RSSI (dBm) of the last frame received
+        self.pkt_snr = None
+        self.pkt_rssi = None
+        # frames are sent one at a time: the next one starts on TxDone of the
+        # last, and the radio goes back to RXCONT once the queue is empty
+        self.radio_lock = threading.RLock()
+        self.tx_queue = deque()
+        self.tx_current = None
+        # when the frame being sent must be done by, and the timer of a busy channel backoff
+        self.tx_deadline = None
+        self.tx_timer = None
+        self.tx_sent = 0
+        self.tx_failed = 0
+        self.tx_time = 0.
+        self.tx_max_queue_delay = 0.
+        # configuration registers are read on every packet, so they are served from a shadow copy
+        super(LoRaUtil, self).__init__(shadow_registers=shadow_registers)
+        self.init_lora(verbose)
         self.recv_timeout = recv_timeout
+        # run channel activity detection before each frame, and back off while the channel is busy
+        self.lbt = ListenBeforeTalk.forProfile(self.profile, LBT_FRAME_SIZE) if listen_before_talk else None
  
     def init_lora(self, verbose):
         parser = LoRaArgumentParser("LoRa util")
-	args = parser.parse_args(self)
+        args = parser.parse_args(self)
+        self.profile = RadioProfile.fromArgs(args)
+        # the settings the node joins with, which set_link adapts
+        self.base_profile = self.profile
         if verbose:
             print(self)
         else:
             print('[LoRa] Initialising with FREQUENCY=%f' % self.get_freq())
-	self.set_mode(MODE.STDBY)
-	self.set_pa_config(pa_select=1)
-	assert(self.get_agc_auto_on() == 1)
-	self.set_mode(MODE.SLEEP)
+        self.set_mode(MODE.STDBY)
+        self.set_pa_config(pa_select=1)
+        self.base_output_power = self.get_pa_config()['output_power']
+        self.set_low_data_rate_optim(needs_low_data_rate_optim(args.sf, args.bw))
+        assert(self.get_agc_auto_on() == 1)
+        self.set_mode(MODE.SLEEP)
         self.set_dio_mapping([0] * 6)
  
     def on_rx_done(self):
         BOARD.led_on()
         print("\n[LoRa] RxDone")
-        self.clear_irq_flags(RxDone=1)
-        payload = self.read_payload(nocheck=True)
-        self.rx_buffer.append(payload)
-        self.set_mode(MODE.SLEEP)
-        self.reset_ptr_rx()
+        with self.radio_lock:
+            self.clear_irq_flags(RxDone=1)
+            payload = self.read_payload(nocheck=True)
+            self.pkt_snr, self.pkt_rssi = self.get_pkt_link_quality()
+            self.queue_frame(payload)
+            if self.listening():
+                self.set_mode(MODE.SLEEP)
+                self.reset_ptr_rx()
+                self.set_mode(MODE.RXCONT)
         BOARD.led_off()
-        self.set_mode(MODE.RXCONT)
+
+    def queue_frame(self, payload):
+        listener = self.frame_listener
+        if listener is not None:
+            listener(payload)
+            return
+        with self.rx_ready:
+            if len(self.rx_queue) == self.rx_queue.maxlen:
+                # the deque drops the oldest frame to make room
+                self.rx_dropped += 1
+                print('[LoRa] Receive queue full, dropped the oldest frame (%d dropped)' % self.rx_dropped)
+            self.rx_queue.append(payload)
+            self.rx_high_water = max(self.rx_high_water, len(self.rx_queue))
+            self.rx_ready.notify()
 
     def on_tx_done(self):
-        print("\n[LoRa] Transmission successful")
-        print(self.get_irq_flags())
+        with self.radio_lock:
+            self.clear_irq_flags(TxDone=1)
+            request = self.tx_current
+            if request is None or request.started_at is None:
+                return
+            self.finish_tx(request, True)
+            print("\n[LoRa] Transmission successful (%d bytes in %.1f ms)" % (len(request.payload),
+                                                                           request.tx_time() * 1000))
+
+    def listening(self):
+        # called with the radio lock held: False while checking the channel or sending
+        return self.tx_current is None or self.tx_timer is not None
+
+    def receive_mode(self):
+        # called with the radio lock held
+        self.set_dio_mapping_1(DIO_MAPPING_RX)
+        self.reset_ptr_rx()
+        self.set_mode(MODE.RXCONT)
+
+    def finish_tx(self, request, ok):
+        # called with the radio lock held
+        self.tx_current = None
+        self.tx_deadline = None
+        request.finish(ok)
+        if ok:
+            self.tx_sent += 1
+            self.tx_time += request.tx_time()
+        else:
+            self.tx_failed += 1
+        if self.tx_queue:
+            self.start_tx()
+        else:
+            # nothing more to send, so listen again
+            self.receive_mode()
+
+    def start_tx(self):
+        # called with the radio lock held, when no frame is being sent
+        request = self.tx_queue.popleft()
+        self.tx_current = request
+        if request.deadline is not None and monotonic() > request.deadline:
+            print('[LoRa] Missed the deadline of a %d byte frame, dropping it' % len(request.payload))
+            self.finish_tx(request, False)
+        elif self.lbt is None:
+            self.transmit(request)
+        else:
+            self.start_cad()
+
+    def transmit(self, request):
+        # called with the radio lock held
+        self.set_dio_mapping_1(DIO_MAPPING_TX)
+        self.write_payload(request.payload)
+        request.started_at = time.time()
+        self.tx_deadline = request.started_at + self.airtime(len(request.payload)) + TX_TIMEOUT_MARGIN
+        self.tx_max_queue_delay = max(self.tx_max_queue_delay, request.queue_delay())
+        self.set_mode(MODE.TX)
+
+    def start_cad(self):
+        # called with the radio lock held. CAD runs from standby and ends in it
+        self.tx_timer = None
+        self.set_mode(MODE.STDBY)
+        self.set_dio_mapping_1(DIO_MAPPING_CAD)
+        self.tx_deadline = time.time() + TX_TIMEOUT_MARGIN
+        self.set_mode(MODE.CAD)
+
+    def retry_cad(self, request):
+        # backoff timer thread
+        with self.radio_lock:
+            if self.tx_current is request and self.tx_timer is not None:
+                self.start_cad()
+
+    def check_tx(self, now=None):
+        """ Give up on the frame being sent if its TxDone is overdue, so the queue does not stall """
+        now = time.time() if now is None else now
+        with self.radio_lock:
+            request = self.tx_current
+            if request is None or self.tx_deadline is None:
+                return
+            if now > self.tx_deadline:
+                print('[LoRa] No %s for a %d byte frame, giving up on it' %
+                      ('TxDone' if request.started_at is not None else 'CadDone', len(request.payload)))
+                self.set_mode(MODE.STDBY)
+                self.finish_tx(request, False)
 
     def on_cad_done(self):
-        print("\non_CadDone")
-        print(self.get_irq_flags())
+        with self.radio_lock:
+            flags = self.get_irq_flags()
+            self.clear_irq_flags(CadDone=1, CadDetected=1)
+            request = self.tx_current
+            if request is None or request.started_at is not None or self.tx_timer is not None:
+                return
+            if not flags['cad_detected']:
+                self.lbt.onClear(request.attempts)
+                self.transmit(request)
+                return
+            delay = self.lbt.onBusy(request.attempts)
+            request.attempts += 1
+            if delay is None:
+                print('[LoRa] Channel busy %d times, giving up on a %d byte frame' %
+                      (request.attempts, len(request.payload)))
+                self.finish_tx(request, False)
+                return
+            if request.deadline is not None and monotonic() + delay > request.deadline:
+                # backing off would push the frame past its deadline, e.g. out of its slot
+                print('[LoRa] Channel busy, dropping a %d byte frame rather than miss its deadline' %
+                      len(request.payload))
+                self.lbt.onDeadline(delay)
+                self.finish_tx(request, False)
+                return
+            print('[LoRa] Channel busy, backing off for %.0f ms' % (delay * 1000))
+            # keep listening while backing off, the activity may be a frame for us
+            self.tx_deadline = None
+            self.tx_timer = threading.Timer(delay, self.retry_cad, (request,))
+            self.tx_timer.daemon = True
+            self.receive_mode()
+            self.tx_timer.start()
 
     def on_rx_timeout(self):
         print("\non_RxTimeout")
@@ -85,31 +305,79 @@ class LoRaUtil(LoRa):
         print("\non_FhssChangeChannel")
         print(self.get_irq_flags())
 
-    def send(self, pkt):
-	self.write_payload(pkt)
-	self.set_mode(MODE.TX)
-        print('[LoRa] Payload written: %s' % str(pkt))
+    def set_link(self, sf, power_reduction):
+        """ Switch to spreading factor sf, sending power_reduction dB below the power set at start,
+            once the frames already queued have been sent
+        """
+        while True:
+            self.check_tx()
+            with self.radio_lock:
+                request = self.tx_queue[-1] if self.tx_queue else self.tx_current
+                if request is None:
+                    base = self.base_profile
+                    self.set_mode(MODE.STDBY)
+                    self.set_spreading_factor(sf)
+                    self.set_low_data_rate_optim(needs_low_data_rate_optim(sf, base.bw))
+                    self.set_pa_config(output_power=max(self.base_output_power - power_reduction, 0))
+                    self.profile = RadioProfile(sf, base.bw, base.coding_rate, base.preamble,
+                                                base.implicit_header, base.crc)
+                    self.receive_mode()
+                    return
+            request.wait(self.airtime(len(request.payload)) + TX_TIMEOUT_MARGIN)
 
-    def recv(self):
-        self.set_mode(MODE.RXCONT)
-        end = time.time() + self.recv_timeout
-	while(len(self.rx_buffer) == 0):
-	  time.sleep(0.1)
-          if time.time() >= end:
-              return False
-	item = self.rx_buffer[0]
-	self.rx_buffer = self.rx_buffer[1:]
-	return item
+    def airtime(self, payload_len):
+        """ Time on air in seconds of a frame of payload_len bytes with the current settings """
+        return self.profile.airtime(payload_len)
+
+    def send(self, pkt, deadline=None):
+        """ Queue a frame for sending. Returns a TxRequest that completes on its TxDone.
+            :param deadline: utils.clock.monotonic() time after which the frame is dropped rather than started
+        """
+        self.check_tx()
+        # spidev transfers take a list of ints
+        request = TxRequest(list(pkt), deadline)
+        with self.radio_lock:
+            self.tx_queue.append(request)
+            if self.tx_current is None:
+                self.start_tx()
+        print('[LoRa] Payload queued: %s' % str(pkt))
+        return request
+
+    def listen(self):
+        """ Put the radio into continuous receive, unless a frame is being sent """
+        with self.radio_lock:
+            if self.listening():
+                self.reset_ptr_rx()
+                self.set_mode(MODE.RXCONT)
+
+    def recv(self, timeout=None):
+        self.check_tx()
+        with self.radio_lock:
+            # the radio returns to RXCONT by itself once everything queued is sent
+            if self.listening():
+                self.set_mode(MODE.RXCONT)
+        if timeout is None:
+            timeout = self.recv_timeout
+        end = time.time() + timeout
+        with self.rx_ready:
+            while not self.rx_queue:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self.rx_ready.wait(remaining)
+            return self.rx_queue.popleft()
   
     def start(self):
-        self.reset_ptr_rx()
-        self.set_mode(MODE.RXCONT)
-        
-	try: 
-	  while 1:
-	      time.sleep(.1)
-	except KeyboardInterrupt:
-	  print('[LoRa] Keyboard interrupt')
-	finally:
-	  self.set_mode(MODE.SLEEP)
-	  BOARD.teardown()
+        self.listen()
+
+        try:
+            while 1:
+                time.sleep(.1)
+                # a lost TxDone or CadDone would otherwise keep the radio out of
+                # receive until the next send
+                self.check_tx()
+        except KeyboardInterrupt:
+            print('[LoRa] Keyboard interrupt')
+        finally:
+            self.set_mode(MODE.SLEEP)
+            BOARD.teardown()
@@ -1,10 +1,9 @@
 import sys
 sys.path.append('/home/pi/lora-sensor-network/')
-import binascii
+import struct
 import time
 import os
 import threading
-import math
 from gps import *
 from bluepy import btle, thingy52
 from utils import Packet, MessageType, SensorType
@@ -13,73 +12,159 @@ from SX127x.LoRa import *
 from SX127x.LoRaArgumentParser import LoRaArgumentParser
 from SX127x.board_config import BOARD
 from lora import LoRaUtil
-
+from readingcache import LatestReadingCache
+from datalog import SegmentedLog, parseRow
+from backlog import Backlog, CONTACT_TIMEOUT
+from aggregate import WindowAggregator
+from logwriter import LogWriter
+from ingeststats import IngestStats
+from thingyscan import loadAddresses, saveAddresses, scanFor
+from thingydecode import decodeReading
+from deadband import ReportFilter, ABSOLUTE, RELATIVE
+from utils.utils import HEADER, BYTE, JOIN_ACK, SENSOR_NAMES, MAX_DEVICES
+from utils.rtt import RttEstimator
+from utils.tdma import SLOT_GUARD
+from utils.clock import monotonic
+from utils.adr import ADR_LEASE, ADR_UNCONFIRMED_LEASE, MIN_SF
+from utils.sink import BUFFERED
+
+# each sensor's readings are logged to DATA_FOLDER/<SENSOR>/ for the first
+# Thingy and DATA_FOLDER/thingy<n>/<SENSOR>/ for the others
 DATA_FOLDER = "../data"
-TEMP_DATA_FILE = "../data/TEMP.csv"
-PRESSURE_DATA_FILE = "../data/PRESS.csv"
-GAS_DATA_FILE = "../data/AIR_QUAL.csv"
-HUMIDITY_DATA_FILE = "../data/HUMID.csv"
+# positions are logged in signed micro-degrees
+POSITION_HEADER = 'timestamp,latitude,longitude'
+DATA_HEADERS = {
+    SensorType.TEMP: POSITION_HEADER + ',temp_units,temp_float',
+    SensorType.HUMID: POSITION_HEADER + ',humidity',
+    SensorType.AIR_QUAL: POSITION_HEADER + ',eCO2,TVOC',
+    SensorType.PRESS: POSITION_HEADER + ',pressure_units,pressure_float',
+}
 
 PRINT_BTLE_DEVICES = False
 PRINT_BT_SERVICES = False
 
-# the enum for a bluetooth device's "short local name"
-SHORT_NAME_ADTYPE = 8
 # the short name that should be assigned to the Thingys
 THINGY_SHORT_NAME = "LoRaSens"
-# time between sensor polling
+# number of Thingys the node serves, each with its own sub-address (at most MAX_DEVICES)
+THINGY_COUNT = 1
+# time between scans for missing Thingys while at least one is connected
+RESCAN_INTERVAL = 60
+# the MAC address of each sub-address, so Thingys can be reconnected without a scan
+THINGY_FILE = os.path.join(DATA_FOLDER, 'thingys')
+# longest wait for a BTLE notification before checking whether to stop
 POLL_TIME = 5.0
+# ms between readings of each environment sensor, and the gas sensor mode
+# (1: every second, 2: every 10 seconds, 3: every minute)
+SENSOR_INTERVAL = 1000
+GAS_MODE = 1
+# how often the ingest counters are printed, in seconds
+INGEST_REPORT_INTERVAL = 60
+# send the minimum, maximum and mean of the readings since the last uplink
+# instead of the latest reading alone
+AGGREGATE_READINGS = True
+# report by exception: only send a sensor once a value has moved by more than
+# its deadband since it was last sent, or it has been silent for MAX_SILENCE
+# seconds. Deadbands are (ABSOLUTE, wire units) or (RELATIVE, fraction)
+REPORT_BY_EXCEPTION = False
+DEADBANDS = {
+    SensorType.TEMP: (ABSOLUTE, 20),        # 0.2 C
+    SensorType.HUMID: (ABSOLUTE, 2),        # 2 %
+    SensorType.AIR_QUAL: (RELATIVE, 0.1),   # 10 %
+    SensorType.PRESS: (ABSOLUTE, 50),       # 0.5 hPa
+}
+MAX_SILENCE = 600
+# readings are written to the data logs in batches of up to WRITE_BATCH_ROWS,
+# at most WRITE_BATCH_AGE seconds apart, with WRITE_DURABILITY from utils.sink
+WRITE_QUEUE_SIZE = 1024
+WRITE_BATCH_ROWS = 32
+WRITE_BATCH_AGE = 5.0
+WRITE_DURABILITY = BUFFERED
+# longest a notification waits for room in a full write queue before its row is dropped
+WRITE_BACKPRESSURE = 0.5
+# listen before talk: check the channel with CAD before each frame, and back
+# off for a random, growing time while it is busy
+LISTEN_BEFORE_TALK = False
+# slotted uplinks are not acknowledged, so the basestation is only heard from
+# now and then; contact is lost after this many slot periods without a frame
+CONTACT_SLOTS = 3
+
+# requests the node answers once it has joined the network
+REQUEST_TYPES = (MessageType.SENSOR_REQUEST, MessageType.MULTI_SENSOR_REQUEST, MessageType.BACKLOG_REQUEST,
+                 MessageType.LINK_ADR)
 
 MAX_LORA_JOIN_ATTEMPTS = 10
-
-# Identifiers for sensor events
-e_temperature_handle = None
-e_pressure_handle = None
-e_humidity_handle = None
-e_gas_hande = None
-
-handles = {}
+# join again once nothing has been heard from the basestation for this long (or
+# twice the contact timeout, if longer), in case it restarted or lost the JOIN_ACK
+REJOIN_TIMEOUT = 120
 
 gpsp = None
 
+def dataDirectory(device, sensorType):
+    if device == 0:
+        return os.path.join(DATA_FOLDER, SENSOR_NAMES[sensorType])
+    return os.path.join(DATA_FOLDER, 'thingy%d' % device, SENSOR_NAMES[sensorType])
+
 class Node(threading.Thread):
     # default thingy's MAC address
     MAC_ADDR = 'DE:AA:A8:87:82:CA'
 
-    def __init__(self, id, desired_data):
+    def __init__(self, id, desired_data, thingy_count=THINGY_COUNT):
         threading.Thread.__init__(self)
         self.id = id
-        self.dev = None
+        # connected Thingys and the MAC address given each sub-address. The BTLE
+        # listener threads change them too, so they are only used under devices_lock
+        self.devices = {}
+        self.addresses = {}
+        self.devices_lock = threading.Lock()
+        self.thingy_count = min(thingy_count, MAX_DEVICES)
+        self.next_scan = 0
         self.desired_data = desired_data
         self.gps = None
         self.joined_lora = False
+        # when the last frame from the basestation arrived
+        self.last_downlink = 0
+        # start of the next uplink slot on utils.clock, and the slot period, when slotted
+        self.next_slot = None
+        self.slot_period = None
+        # slotted uplinks carry each Thingy's readings in turn
+        self.next_device = 0
         self.running = True
-        self.btleThread = None
+        # latest reading of each sensor of each Thingy, keyed by (sub-address, sensor
+        # type), so requests do not have to read the data files
+        self.cache = LatestReadingCache()
+        # statistics of the readings taken since the last uplink
+        self.aggregator = WindowAggregator()
+        self.ingest = IngestStats(INGEST_REPORT_INTERVAL)
+        # values last sent, when reporting by exception
+        self.reports = ReportFilter(DEADBANDS, MAX_SILENCE) if REPORT_BY_EXCEPTION else None
 
         self.init_lora()
+        # join timeouts follow the measured round trip time to the basestation
+        self.rtt = RttEstimator.forFrames(self.lora.profile, HEADER.size + BYTE.size, HEADER.size + JOIN_ACK.size)
+        # spreading factor and TX power reduction ordered by the basestation, kept
+        # for link_lease seconds after the last LINK_ADR
+        self.base_link = (self.lora.base_profile.sf, 0)
+        self.link = self.base_link
+        self.link_renewed = 0
+        self.link_lease = ADR_LEASE
         self.init_files()
+        self.addresses = dict([(d, addr) for d, addr in loadAddresses(THINGY_FILE).items() if d < self.thingy_count])
+        # readings logged while the basestation could not be reached
+        self.backlog = Backlog(self.id, self.logs, self.lora.profile)
         self.init_gps()
 
     def init_files(self):
-        print('[NODE] Initialising files...')
-        if not os.path.exists(DATA_FOLDER):
-            os.makedirs(DATA_FOLDER)
-        if not os.path.isfile(TEMP_DATA_FILE):
-            with open(TEMP_DATA_FILE, 'w') as f:
-                f.write('timestamp,lat_deg,lat_min,lat_sec,lon_deg,lon_min,lon_sec,temp_units,temp_float\n')
-        if not os.path.isfile(PRESSURE_DATA_FILE):
-            with open(PRESSURE_DATA_FILE, 'w') as f:
-                f.write('timestamp,lat_deg,lat_min,lat_sec,lon_deg,lon_min,lon_sec,pressure_units,pressure_float\n')
-        if not os.path.isfile(GAS_DATA_FILE):
-            with open(GAS_DATA_FILE, 'w') as f:
-                f.write('timestamp,lat_deg,lat_min,lat_sec,lon_deg,lon_min,lon_sec,eCO2,TVOC\n')
-        if not os.path.isfile(HUMIDITY_DATA_FILE):
-            with open(HUMIDITY_DATA_FILE, 'w') as f:
-                f.write('timestamp,lat_deg,lat_min,lat_sec,lon_deg,lon_min,lon_sec,humidity\n')
+        print('[NODE] Initialising data logs...')
+        self.logs = {}
+        for device in range(self.thingy_count):
+            for sensorType, header in DATA_HEADERS.items():
+                self.logs[(device, sensorType)] = SegmentedLog(dataDirectory(device, sensorType), header)
+        self.writer = LogWriter(self.logs, WRITE_QUEUE_SIZE, WRITE_BATCH_ROWS, WRITE_BATCH_AGE, WRITE_DURABILITY)
+        self.writer.start()
 
     def init_lora(self):
         BOARD.setup()
-        self.lora = LoRaUtil(verbose=False)
+        self.lora = LoRaUtil(verbose=False, listen_before_talk=LISTEN_BEFORE_TALK)
         self.lora_thread = threading.Thread(target=self.lora.start)
         self.lora_thread.start()
 
@@ -88,153 +173,234 @@ class Node(threading.Thread):
         self.gps = GpsInterface()
         self.gps.start()
 
-    def enable_sensors(self):
+    def enable_sensors(self, dev):
         # enable environmental interface
-        self.dev.environment.enable()
+        dev.environment.enable()
         # enable each sensor
         if SensorType.TEMP in self.desired_data:
-            self.dev.environment.configure(temp_int=1000)
-            self.dev.environment.set_temperature_notification(True)
+            dev.environment.configure(temp_int=SENSOR_INTERVAL)
+            dev.environment.set_temperature_notification(True)
         if SensorType.PRESS in self.desired_data:
-            self.dev.environment.configure(press_int=1000)
-            self.dev.environment.set_pressure_notification(True)
+            dev.environment.configure(press_int=SENSOR_INTERVAL)
+            dev.environment.set_pressure_notification(True)
         if SensorType.HUMID in self.desired_data:
-            self.dev.environment.configure(humid_int=1000)
-            self.dev.environment.set_humidity_notification(True)
+            dev.environment.configure(humid_int=SENSOR_INTERVAL)
+            dev.environment.set_humidity_notification(True)
         if SensorType.AIR_QUAL in self.desired_data:
-            self.dev.environment.configure(gas_mode_int=1)
-            self.dev.environment.set_gas_notification(True)
-
-        global e_temperature_handle
-        global e_pressure_handle
-        global e_humidity_handle
-        global e_gas_handle
-        global handles
-
-        e_temperature_handle = self.dev.environment.temperature_char.getHandle()
-        e_pressure_handle = self.dev.environment.pressure_char.getHandle()
-        e_humidity_handle = self.dev.environment.humidity_char.getHandle()
-        e_gas_handle = self.dev.environment.gas_char.getHandle()
-
-        handles = {e_temperature_handle: SensorType.TEMP, e_pressure_handle: SensorType.PRESS,
-                e_humidity_handle: SensorType.HUMID, e_gas_handle: SensorType.AIR_QUAL}
-
-    def scan_for_thingy(self):
+            dev.environment.configure(gas_mode_int=GAS_MODE)
+            dev.environment.set_gas_notification(True)
+
+        # the sensor type of each notification handle
+        return {dev.environment.temperature_char.getHandle(): SensorType.TEMP,
+                dev.environment.pressure_char.getHandle(): SensorType.PRESS,
+                dev.environment.humidity_char.getHandle(): SensorType.HUMID,
+                dev.environment.gas_char.getHandle(): SensorType.AIR_QUAL}
+
+    def connected_devices(self):
+        # a snapshot of the connected Thingys by sub-address
+        with self.devices_lock:
+            return dict(self.devices)
+
+    def known_addresses(self):
+        with self.devices_lock:
+            return dict(self.addresses)
+
+    def free_sub_address(self, mac_addr):
+        # a Thingy keeps its sub-address when it reconnects
+        addresses = self.known_addresses()
+        for device, addr in addresses.items():
+            if addr == mac_addr:
+                return device
+        for device in range(self.thingy_count):
+            if device not in addresses:
+                return device
+        return None
+
+    def find_thingys(self):
+        # Thingys seen before are connected to directly, the rest scanned for
+        devices = self.connected_devices()
+        for device, mac_addr in sorted(self.known_addresses().items()):
+            if device in devices:
+                continue
+            try:
+                self.connect_thingy(device, mac_addr)
+            except btle.BTLEException as e:
+                print('[NODE] Failed to reconnect to Thingy %s: %s' % (mac_addr, e))
+        if len(self.connected_devices()) < self.thingy_count:
+            self.scan_for_thingys()
+
+    def scan_for_thingys(self):
         print("[NODE] Scanning for BTLE devices")
 
-        # scan for 8 seconds
-        scanner = btle.Scanner()
-        devices = scanner.scan(8)
-
-        # try and find device named 'LoraSense'
-        mac_addr = None
-        for dev in devices:
-            name = dev.getValueText(SHORT_NAME_ADTYPE)
-            if PRINT_BTLE_DEVICES:
-                print("[NODE] Device %s %s (%s), RSSI=%d dB" % (name, dev.addr, dev.addrType, dev.rssi))
-            if name == THINGY_SHORT_NAME:
-                print('[NODE] Found LoraSense Thingy')
-                mac_addr = dev.addr
-                break
-
-        if mac_addr is None:
+        # stop scanning as soon as every missing Thingy is seen
+        devices = self.connected_devices()
+        addresses = self.known_addresses()
+        connected = [addresses[d] for d in devices]
+        found = scanFor(THINGY_SHORT_NAME, self.thingy_count - len(devices), connected,
+                        verbose=PRINT_BTLE_DEVICES)
+
+        connections = 0
+        for mac_addr in found:
+            device = self.free_sub_address(mac_addr)
+            if device is None:
+                print('[NODE] Ignoring LoraSense Thingy %s, all %d sub-addresses are in use' % (mac_addr, self.thingy_count))
+                continue
+            print('[NODE] Found LoraSense Thingy %s' % mac_addr)
+            try:
+                self.connect_thingy(device, mac_addr)
+            except btle.BTLEException as e:
+                print('[NODE] Failed to connect to Thingy %s: %s' % (mac_addr, e))
+                continue
+            connections += 1
+
+        if connections == 0:
             print("[NODE] Failed to find Thingy via BTLE")
             return False
+        return True
 
-        print("[NODE] Connecting to Thingy...")
-        self.dev = thingy52.Thingy52(mac_addr)
+    def open_thingy(self, device, mac_addr):
+        print("[NODE] Connecting to Thingy %s as device %d..." % (mac_addr, device))
+        dev = thingy52.Thingy52(mac_addr)
 
         print("[NODE] Connected.")
 
         if PRINT_BT_SERVICES:
             print('[NODE] Bluetooth services:')
-            services = self.dev.discoverServices()
+            services = dev.discoverServices()
             for service in services.values():
                 descs = service.getDescriptors()
                 for desc in descs:
                     print(desc)
 
-        self.enable_sensors()
+        handles = self.enable_sensors(dev)
 
         print("[NODE] Enabled sensors.")
 
-        self.dev.setDelegate(LoRaSenseDelegate(self.gps))
+        dev.setDelegate(LoRaSenseDelegate(device, handles, self.gps, self.cache, self.writer, self.aggregator,
+                                          self.ingest))
+        with self.devices_lock:
+            self.devices[device] = dev
+            if self.addresses.get(device) != mac_addr:
+                self.addresses[device] = mac_addr
+                saveAddresses(THINGY_FILE, self.addresses)
+        return dev
+
+    def connect_thingy(self, device, mac_addr):
+        dev = self.open_thingy(device, mac_addr)
 
         print("[NODE] Starting BTLE listener thread...")
         
-        self.btleThread = threading.Thread(target=self.btleListenLoop)
-        self.btleThread.start()
+        thread = threading.Thread(target=self.btleListenLoop, args=(device, dev))
+        thread.start()
     
         print("[NODE] BTLE listener started")
 
-        return True
-
-    def btleListenLoop(self):
-        while True:
-            self.dev.waitForNotifications(POLL_TIME)
-            time.sleep(1)
+    def btleListenLoop(self, device, dev):
+        # waitForNotifications returns as soon as a notification has been
+        # handled, so notifications are dispatched as they arrive
+        while self.running:
+            try:
+                dev.waitForNotifications(POLL_TIME)
+            except btle.BTLEException as e:
+                print('[NODE] Lost connection to Thingy %d: %s' % (device, e))
+                # a Thingy that only dropped the link can be connected to again
+                # straight away. It stays in self.devices meanwhile, so the main
+                # loop does not connect to it as well
+                try:
+                    dev = self.open_thingy(device, self.known_addresses()[device])
+                except btle.BTLEException as e:
+                    # the main loop scans for it
+                    print('[NODE] Failed to reconnect to Thingy %d: %s' % (device, e))
+                    with self.devices_lock:
+                        if self.devices.get(device) is dev:
+                            del self.devices[device]
+                    self.next_scan = 0
+                    return
+                continue
+            report = self.ingest.report()
+            if report is not None:
+                print('[NODE] Ingest: %.2f notifications/s from %d Thingys, handler latency mean %.1f ms, '
+                      'max %.1f ms, write queue %d, %d rows dropped' % (report[0], len(self.connected_devices()),
+                      report[1] * 1000, report[2] * 1000, self.writer.depth(), self.writer.dropped))
 
     def waitForPacket(self, src_id, msg_type, timeout=30):
+        # msg_type may be a single type or a tuple of accepted types
+        msg_types = msg_type if isinstance(msg_type, tuple) else (msg_type,)
         end = time.time() + timeout
         while time.time() < end:
-                resp = self.lora.recv()
+                resp = self.lora.recv(max(end - time.time(), 0))
                 print('[NODE] Received: %s' % str(resp))
                 if resp:
                         pkt = Packet.decode_packet(resp)
-                        if pkt.src_id == src_id and pkt.dest_id == self.id and pkt.type == msg_type:
+                        if pkt and pkt.src_id == src_id and pkt.dest_id == self.id and pkt.type in msg_types:
+                                self.last_downlink = time.time()
+                                self.backlog.onContact(self.last_downlink)
                                 return pkt
         return False
 
     def join_lora_network(self):
         print('[NODE] Attempting to join LoRa network...') 
+        # joins are always sent with the base settings
+        self.setLink(self.base_link)
         attempts = 0
         while not self.joined_lora and attempts < MAX_LORA_JOIN_ATTEMPTS:
             # send over LoRa and wait for response
-            pkt = Packet.createJoinRequestPacket(self.id, self.desired_data) 
-            pkt_str = Packet.encode_packet(pkt)
-            self.lora.send(pkt_str)
+            pkt = Packet.createJoinRequestPacket(self.id, self.desired_data, self.backlog.pending(time.time()),
+                                                 self.thingy_count, MAX_SILENCE if REPORT_BY_EXCEPTION else 0)
+            frame = Packet.encode_packet(pkt)
+            sent_at = time.time()
+            self.lora.send(frame)
             attempts = attempts + 1
-            pkt = self.waitForPacket(0, MessageType.JOIN_ACK)
+            pkt = self.waitForPacket(0, MessageType.JOIN_ACK, self.rtt.timeout())
             if pkt:  
+                # a retried request's ack cannot be matched to its send time
+                if attempts == 1:
+                    self.rtt.sample(time.time() - sent_at)
                 self.joined_lora = True
                 print('[NODE] LoRa network joined successfully')        
+                slot = Packet.decode_join_response(pkt.payload)
+                if slot is not None:
+                    offset, self.slot_period = slot
+                    self.next_slot = monotonic() + offset
+                    self.backlog.contact_timeout = max(CONTACT_TIMEOUT, CONTACT_SLOTS * self.slot_period)
+                    print('[NODE] Assigned uplink slot in %.2fs, every %.2fs' % slot)
             else:
-                print('[NODE] Failed to join LoRa network, retrying...')
-
-    def readLastLineInFile(self, name):
-        with open(name, 'r') as f:
-            lines = f.read().splitlines()
-            if len(lines) < 2:
-                return None
-            line = lines[-1]
-            tokens = line.split(',')
-            tokens[1:] = [int(t) for t in tokens[1:]]
-            return tokens
-
-    def getLatestData(self, sensorType):
-        data = []
-        fileName = None
-        if sensorType == SensorType.TEMP:
-            fileName = TEMP_DATA_FILE
-        elif sensorType == SensorType.HUMID:
-            fileName = HUMIDITY_DATA_FILE
-        elif sensorType == SensorType.AIR_QUAL:
-            fileName = GAS_DATA_FILE
-        elif sensorType == SensorType.PRESS:
-            fileName = PRESSURE_DATA_FILE
-
-        if fileName is not None:
-            return self.readLastLineInFile(fileName)
-        else:
+                self.rtt.onTimeout()
+                print('[NODE] Failed to join LoRa network, retrying with a %.2fs timeout...' % self.rtt.timeout())
+
+    def getLatestData(self, sensorType, device=0):
+        key = (device, sensorType)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+
+        # nothing received since a restart, fall back to the data log
+        log = self.logs.get(key)
+        if log is None:
+            return None
+        row = log.latest()
+        if row is None:
             return None
+        data = parseRow(row)
+        self.cache.put(key, data)
+        return data
     
     def handleSensorRequest(self, pkt):
-        if len(pkt.payload) != 1:
+        if pkt.type != MessageType.LINK_ADR:
+            # any other frame on the current settings shows the basestation uses them
+            self.link_lease = ADR_LEASE
+        if pkt.type == MessageType.MULTI_SENSOR_REQUEST:
+            return self.handleMultiSensorRequest(pkt)
+        if pkt.type == MessageType.BACKLOG_REQUEST:
+            return self.handleBacklogRequest(pkt)
+        if pkt.type == MessageType.LINK_ADR:
+            return self.handleLinkAdr(pkt)
+
+        sensorType = Packet.decode_sensor_request(pkt.payload)
+        if sensorType is None:
             print('[NODE] Received a sensor request with no payload, ignoring')
             return False
 
-        sensorType = pkt.payload[0]
-
         # check sensor type is compatible
         if sensorType in self.desired_data:
             data = self.getLatestData(sensorType)
@@ -244,17 +410,172 @@ class Node(threading.Thread):
             pkt = Packet.createSensorResponse(self.id, sensorType, data)
             print(pkt)
             print('[NODE] Sending sensor response for sensor type %d' % sensorType)
-            rawpkt = Packet.encode_packet(pkt)
-            print('Raw packet: ', rawpkt)
-            self.lora.send(rawpkt)
+            frame = Packet.encode_packet(pkt)
+            print('[NODE] Frame is %d bytes' % len(frame))
+            self.lora.send(frame)
+
+    def handleMultiSensorRequest(self, pkt):
+        sensorTypes = Packet.decode_multi_sensor_request(pkt.payload)
+        if sensorTypes is None:
+            print('[NODE] Received a multi sensor request with no payload, ignoring')
+            return False
+        device = Packet.decodeSubAddress(pkt.payload)
+        if device >= self.thingy_count:
+            print('[NODE] Received a request for unknown device %d, ignoring' % device)
+            return False
+
+        return self.sendReadings(sensorTypes, device)
+
+    def handleBacklogRequest(self, pkt):
+        request = Packet.decode_backlog_request(pkt.payload)
+        if request is None:
+            print('[NODE] Received a malformed backlog request, ignoring')
+            return False
+
+        ack, max_size = request
+        self.backlog.onAck(ack)
+        offset = Packet.decode_slot_sync(pkt.payload)
+        if offset is not None and self.slot_period is not None:
+            # follow the basestation's slot grid, whatever our clock has done
+            self.next_slot = monotonic() + offset
+        if max_size == 0:
+            return True
+        frame = self.backlog.nextFrame(time.time(), max_size)
+        if frame is None:
+            print('[NODE] No backlog frame to send')
+            return False
+        print('[NODE] Sending backlog frame of %d bytes' % len(frame))
+        self.lora.send(frame)
+        return True
+
+    def handleLinkAdr(self, pkt):
+        # the quality of the request itself, before another frame can arrive
+        snr, rssi = self.lora.pkt_snr, self.lora.pkt_rssi
+        command = Packet.decode_link_adr(pkt.payload)
+        if command is None:
+            print('[NODE] Received a malformed link ADR request, ignoring')
+            return False
+        sf, power_reduction = command[:2]
+        if not MIN_SF <= sf <= self.base_link[0]:
+            print('[NODE] Received a link ADR request for unsupported SF%d, ignoring' % sf)
+            return False
+
+        if (sf, power_reduction) != self.link:
+            # kept only briefly unless the basestation turns out to have got the answer
+            self.link_lease = ADR_UNCONFIRMED_LEASE
+            if self.slot_period is not None:
+                self.link_lease = max(ADR_UNCONFIRMED_LEASE, CONTACT_SLOTS * self.slot_period)
+        self.setLink((sf, power_reduction))
+        self.link_renewed = time.time()
+        # answering with the new settings shows the basestation they work
+        pkt = Packet.create_link_adr_answer(self.id, sf, power_reduction, snr, rssi)
+        self.lora.send(Packet.encode_packet(pkt))
+        return True
+
+    def setLink(self, link):
+        if link == self.link:
+            return
+        print('[NODE] Switching to SF%d, TX power -%d dB' % link)
+        self.lora.set_link(*link)
+        self.link = link
+
+    def checkLinkLease(self):
+        # adapted settings lapse when the basestation stops renewing them
+        if self.link != self.base_link and time.time() - self.link_renewed > self.link_lease:
+            print('[NODE] No link ADR request for %ds, returning to the base settings' % self.link_lease)
+            self.setLink(self.base_link)
+
+    def checkDownlink(self):
+        # a node reporting by exception may stay silent, and so unanswered, for MAX_SILENCE
+        timeout = max(REJOIN_TIMEOUT, 2 * self.backlog.contact_timeout,
+                      2 * MAX_SILENCE if REPORT_BY_EXCEPTION else 0)
+        if self.joined_lora and time.time() - self.last_downlink > timeout:
+            print('[NODE] Nothing heard from the basestation for %ds, joining again' % timeout)
+            self.joined_lora = False
+            self.next_slot = None
+            self.slot_period = None
+            self.backlog.contact_timeout = CONTACT_TIMEOUT
+
+    def sendReadings(self, sensorTypes, device=0, polled=True, deadline=None):
+        # send every requested reading of a device that is available in one frame,
+        # dropping it if it cannot start by deadline
+        readings = {}
+        for sensorType in sensorTypes:
+            if sensorType not in self.desired_data:
+                continue
+            data = self.getLatestData(sensorType, device)
+            if data is None:
+                print('[NODE] Failed to find data of type %d' % sensorType)
+                continue
+            readings[sensorType] = data
+
+        if not readings:
+            return False
+
+        now = time.time()
+        backlog = self.backlog.pending(now)
+        position = max(readings.values(), key=lambda data: float(data[0]))
+        if self.reports is not None:
+            values = dict([(s, Packet.encodeSensorValues(s, data[3:])) for s, data in readings.items()])
+            readings = dict([(s, data) for s, data in readings.items()
+                             if self.reports.changed((device, s), values[s], now)])
+            # a poll is answered even if nothing has changed, so it does not time out
+            if not readings and not polled and not backlog:
+                print('[NODE] No readings of device %d have changed, skipping the uplink' % device)
+                return False
+            for sensorType in readings:
+                self.reports.onSent((device, sensorType), values[sensorType], now)
+        windows = {}
+        if AGGREGATE_READINGS:
+            stats, window = self.aggregator.take([(device, s) for s in readings], now)
+            windows = dict([(sensorType, w) for (_, sensorType), w in stats.items()])
+        if windows:
+            # sensors with no readings since the last uplink report their latest one
+            for sensorType, data in readings.items():
+                if sensorType not in windows:
+                    latest = Packet.encodeSensorValues(sensorType, data[3:])
+                    windows[sensorType] = (1, latest, latest, latest)
+            pkt = Packet.createMultiSensorSummary(self.id, position, windows, window, backlog, device)
+            print('[NODE] Sending %.1fs summary of device %d for sensor types %s' % (window, device, sorted(windows.keys())))
+        else:
+            # no readings since the last uplink, so send the latest ones
+            pkt = Packet.createMultiSensorResponse(self.id, readings, backlog, device, position)
+            print('[NODE] Sending multi sensor response of device %d for sensor types %s' % (device, sorted(readings.keys())))
+        print(pkt)
+        frame = Packet.encode_packet(pkt)
+        print('[NODE] Frame is %d bytes' % len(frame))
+        self.lora.send(frame, deadline)
+        return True
+
+    def runSlot(self):
+        # listen for requests until our slot starts, then push all readings
+        now = monotonic()
+        if now < self.next_slot:
+            pkt = self.waitForPacket(0, REQUEST_TYPES, self.next_slot - now)
+            if pkt:
+                self.handleSensorRequest(pkt)
+            return
+
+        # the slot leaves SLOT_GUARD for a late start, half of it kept for clock error
+        self.sendReadings(self.desired_data, self.next_device, polled=False,
+                          deadline=self.next_slot + SLOT_GUARD / 2)
+        self.next_device = (self.next_device + 1) % self.thingy_count
+        while self.next_slot <= monotonic():
+            self.next_slot += self.slot_period
 
     def run(self):
         while self.running:
-            if self.dev is None:
-                self.scan_for_thingy()
-
-            if self.joined_lora:
-                pkt = self.waitForPacket(0, MessageType.SENSOR_REQUEST)
+            if len(self.connected_devices()) < self.thingy_count and time.time() >= self.next_scan:
+                self.find_thingys()
+                if self.connected_devices():
+                    self.next_scan = time.time() + RESCAN_INTERVAL
+            self.checkLinkLease()
+            self.checkDownlink()
+
+            if self.joined_lora and self.next_slot is not None:
+                self.runSlot()
+            elif self.joined_lora:
+                pkt = self.waitForPacket(0, REQUEST_TYPES)
                 if pkt:
                     self.handleSensorRequest(pkt)
             else:
@@ -262,91 +583,80 @@ class Node(threading.Thread):
         #self.disconnect()
 
     def disconnect(self):
-        if self.dev is not None:
+        for dev in self.connected_devices().values():
             print('Disconnecting from Thingy...')
-            self.dev.disconnect()
+            dev.disconnect()
         if self.gps is not None:
             print("Killing GPS thread...")
             self.gps.stop()
             #self.gps.join() # wait for thread to finish
+        print('[NODE] Writing out queued readings (%d written, %d dropped, queue peaked at %d)...' %
+              (self.writer.written, self.writer.dropped, self.writer.max_depth))
+        self.writer.stop()
+        for log in self.logs.values():
+            log.close()
+        print('[NODE] Register shadow saved %d SPI transactions' % self.lora.spi_saved)
+        print('[NODE] LoRa receive queue peaked at %d frames, %d dropped' % (self.lora.rx_high_water, self.lora.rx_dropped))
+        print('[NODE] LoRa sent %d frames (%d failed), %.1f s on air, longest wait to send %.1f ms' %
+              (self.lora.tx_sent, self.lora.tx_failed, self.lora.tx_time, self.lora.tx_max_queue_delay * 1000))
+        if self.lora.lbt is not None:
+            print('[NODE] Listen before talk: ' + self.lora.lbt.summary())
 
     def stop(self):
         self.running = False
 
 class LoRaSenseDelegate(thingy52.DefaultDelegate):
 
-    def __init__(self, gps):
+    def __init__(self, device, handles, gps, cache, writer, aggregator, stats):
+        self.device = device
+        self.handles = handles
         self.gps = gps
+        self.cache = cache
+        self.writer = writer
+        self.aggregator = aggregator
+        self.stats = stats
 
     def handleNotification(self, hnd, data):
         t = time.time()
-        msg = None
-        vals = []
-        if hnd == e_temperature_handle:
-            temp = binascii.b2a_hex(data)
-            msg = '{}.{}'.format(
-                        self._str_to_int(temp[:-2]), int(temp[-2:],16))
-            print('[BTLEDelegate] Temp (C) received: %s' % msg)
-            vals = self.splitFloatToStr(msg)
-        elif hnd == e_pressure_handle:
-            (press_int, press_dec) = self._extract_pressure_data(data)
-            msg = '{}.{}'.format(press_int, press_dec)
-            print('[BTLEDelegate] Pressure (hPa) received: %s %s' % (msg,'hPa'))
-            vals = self.splitFloatToStr(msg)
-        elif hnd == e_humidity_handle:
-            hum = binascii.b2a_hex(data)
-            msg = '{}'.format(self._str_to_int(hum))
-            print('[BTLEDelegate] Humidity (percent) received: %s' % msg)
-            vals = [msg]
-        elif hnd == e_gas_handle:
-            eco2, tvoc = self._extract_gas_data(data)
-            msg = '{}, {}'.format(eco2, tvoc)
-            print('[BTLEDelegate] AQ received: eCO2 %s, TVOC ppb: %s' % (eco2, tvoc))
-            vals = [eco2, tvoc]
-        else:
+        self.handleReading(hnd, data, t)
+        self.stats.onNotification(time.time() - t)
+
+    def handleReading(self, hnd, data, t):
+        sensorType = self.handles.get(hnd)
+        if sensorType is None:
             return
+        try:
+            vals = decodeReading(sensorType, data)
+        except struct.error:
+            print('[BTLEDelegate] Dropped a short notification of sensor %d' % sensorType)
+            return
+
+        if sensorType == SensorType.TEMP:
+            print('[BTLEDelegate] Temp (C) received: %d.%02d' % (vals[0], abs(vals[1])))
+        elif sensorType == SensorType.PRESS:
+            print('[BTLEDelegate] Pressure (hPa) received: %d.%02d hPa' % vals)
+        elif sensorType == SensorType.HUMID:
+            print('[BTLEDelegate] Humidity (percent) received: %d' % vals)
+        elif sensorType == SensorType.AIR_QUAL:
+            print('[BTLEDelegate] AQ received: eCO2 %d, TVOC ppb: %d' % vals)
 
         lat, lon = self.getGPSData()
-        lat_str = [str(n) for n in lat]
-        lon_str = [str(n) for n in lon]
-        gps_msg = ",".join(lat_str) + ',' + ",".join(lon_str) 
-        if msg is not None:
-            filename = [TEMP_DATA_FILE, HUMIDITY_DATA_FILE, GAS_DATA_FILE, PRESSURE_DATA_FILE][handles[hnd]]
-            with open(filename, 'a') as f:
-                f.write(str(t) + ',' + gps_msg + ',' + ",".join(vals) + '\n')
-
-    def splitFloatToStr(self, value):
-        value = float(value)
-        frac, whole = math.modf(value)
-        frac = frac * 100
-        return [str(int(whole)), str(int(frac))]
-
-    def _str_to_int(self, s):
-        i = int(s, 16)
-        if i >= 2**7:
-            i -= 2**8
-        return i
-
-    def _extract_pressure_data(self, data):
-        val = binascii.b2a_hex(data)
-        pressure_int = 0
-        for i in range(0,4):
-            pressure_int += (int(val[i*2:(i*2)+2], 16) << 8*i)
-        pressure_dec = int(val[-2:], 16)
-        return (pressure_int, pressure_dec)
-
-    def _extract_gas_data(self, data):
-        val = binascii.b2a_hex(data)
-        eco2 = int(val[:2], 16) + (int(val[2:4], 16) << 8)
-        tvoc = int(val[4:6], 16) + (int(val[6:8], 16) << 8)
-        return eco2, tvoc
+        gps_msg = '%d,%d' % (lat, lon)
+        key = (self.device, sensorType)
+        self.cache.put(key, [str(t), lat, lon] + list(vals))
+        self.aggregator.add(key, t, Packet.encodeSensorValues(sensorType, vals))
+        # wait for the writer to catch up rather than dropping the row straight away
+        self.writer.submit(key, t, str(t) + ',' + gps_msg + ',' + ",".join([str(v) for v in vals]), WRITE_BACKPRESSURE)
 
     def getGPSData(self):
+        # the position in signed micro-degrees, converted once here from the
+        # GPS strings so the decimal minutes keep their leading zeros
         data = self.gps.getCurrent()
-        if data is None:
-            return (0,0,0), (0,0,0)
+        if not data:
+            return 0, 0
 
-        return self.gpsCoordFromString(data['lat']), self.gpsCoordFromString(data['lon'])
+        return (Packet.encodeGps(self.gpsCoordFromString(data['lat']), data['lat_dir']),
+                Packet.encodeGps(self.gpsCoordFromString(data['lon']), data['lon_dir']))
 
     def gpsCoordFromString(self, value): 
         tokens = value.split(' ')
@@ -0,0 +1,20 @@
+import threading
+
+class LatestReadingCache(object):
+    ''' The most recent reading of each sensor, in the same form as a row of
+        the sensor's data file: [timestamp, latitude, longitude, values...],
+        with the position in micro-degrees. Written by the BTLE delegate
+        and read by the LoRa side, so access is locked.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.readings = {}
+
+    def put(self, sensorType, reading):
+        with self.lock:
+            self.readings[sensorType] = reading
+
+    def get(self, sensorType):
+        with self.lock:
+            return self.readings.get(sensorType)
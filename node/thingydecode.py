@@ -0,0 +1,41 @@
+''' Decoding of Thingy:52 environment characteristic payloads.
+
+    Each payload is unpacked with a precompiled struct straight into the
+    values the node stores for a reading: whole units and hundredths for
+    temperature and pressure, and plain integers otherwise.
+'''
+import struct
+
+from utils.utils import SensorType
+
+TEMPERATURE = struct.Struct('<bB')   # int8 degrees C | uint8 hundredths
+PRESSURE = struct.Struct('<iB')      # int32 hPa | uint8 hundredths
+HUMIDITY = struct.Struct('<B')       # uint8 percent
+GAS = struct.Struct('<HH')           # uint16 eCO2 (ppm) | uint16 TVOC (ppb)
+
+def decodeTemperature(data):
+    whole, hundredths = TEMPERATURE.unpack_from(data)
+    # the hundredths take the sign of the whole degrees
+    if whole < 0:
+        hundredths = -hundredths
+    return (whole, hundredths)
+
+def decodePressure(data):
+    return PRESSURE.unpack_from(data)
+
+def decodeHumidity(data):
+    return HUMIDITY.unpack_from(data)
+
+def decodeGas(data):
+    return GAS.unpack_from(data)
+
+DECODERS = {
+    SensorType.TEMP: decodeTemperature,
+    SensorType.PRESS: decodePressure,
+    SensorType.HUMID: decodeHumidity,
+    SensorType.AIR_QUAL: decodeGas,
+}
+
+def decodeReading(sensorType, data):
+    ''' The stored values of a notification payload, as a tuple of ints '''
+    return DECODERS[sensorType](data)
@@ -0,0 +1,70 @@
+''' Finding the node's Thingys quickly.
+
+    The MAC address given each sub-address is saved, so that on startup and
+    after a dropped connection the node can connect to its Thingys directly,
+    without scanning. Only Thingys that cannot be reached that way are
+    scanned for, and the scan stops as soon as enough of them are seen
+    instead of running for its full length.
+'''
+import os
+import time
+
+from bluepy import btle
+
+# the enum for a bluetooth device's "short local name"
+SHORT_NAME_ADTYPE = 8
+# longest scan, and how often a running scan checks what it has found
+SCAN_TIME = 8.0
+SCAN_STEP = 0.2
+
+def loadAddresses(name):
+    ''' The saved sub-address -> MAC address map, empty if there is none '''
+    addresses = {}
+    try:
+        with open(name, 'r') as f:
+            for line in f.read().splitlines():
+                device, addr = line.split(',')
+                addresses[int(device)] = addr
+    except (IOError, ValueError):
+        pass
+    return addresses
+
+def saveAddresses(name, addresses):
+    lines = ['%d,%s' % (device, addr) for device, addr in sorted(addresses.items())]
+    with open(name + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(name + '.tmp', name)
+
+class ThingyScanDelegate(btle.DefaultDelegate):
+    ''' Collects the advertisers with a given short name as they are seen
+    '''
+
+    def __init__(self, short_name, ignore=(), verbose=False):
+        btle.DefaultDelegate.__init__(self)
+        self.short_name = short_name
+        self.ignore = ignore
+        self.verbose = verbose
+        self.found = []
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        name = dev.getValueText(SHORT_NAME_ADTYPE)
+        if self.verbose and isNewDev:
+            print("[NODE] Device %s %s (%s), RSSI=%d dB" % (name, dev.addr, dev.addrType, dev.rssi))
+        if name == self.short_name and dev.addr not in self.ignore and dev.addr not in self.found:
+            self.found.append(dev.addr)
+
+def scanFor(short_name, wanted, ignore=(), timeout=SCAN_TIME, verbose=False):
+    ''' Scan until wanted devices named short_name, other than those in
+        ignore, have been seen or timeout seconds have passed. Returns the
+        MAC addresses found, in the order they were seen.
+    '''
+    delegate = ThingyScanDelegate(short_name, ignore, verbose)
+    scanner = btle.Scanner().withDelegate(delegate)
+    end = time.time() + timeout
+    scanner.start()
+    try:
+        while len(delegate.found) < wanted and time.time() < end:
+            scanner.process(min(SCAN_STEP, max(end - time.time(), 0.01)))
+    finally:
+        scanner.stop()
+    return delegate.found
@@ -1 +1 @@
-from utils import Packet, MessageType, SensorType
+from .utils import Packet, MessageType, SensorType
@@ -0,0 +1,187 @@
+''' Adaptive data rate. The basestation measures the SNR of each node's
+    uplinks, works out how far the link is above the demodulation floor of
+    the node's spreading factor, and orders the node down to a lower
+    spreading factor and TX power while the margin allows, or back up when
+    it shrinks. Nodes never go above the network's base spreading factor,
+    the one they join with and that uplink slots are sized for.
+
+    SNR is much the same at every spreading factor, so a measurement at one
+    predicts the margin at another. The SX127x's SNR saturates on strong
+    links, where the RSSI above the noise floor is used instead.
+
+    Adapted settings are a lease: a node returns to the base settings when
+    no LINK_ADR has reached it for ADR_LEASE seconds, and the basestation
+    repeats the command well within that. The basestation returns a node to
+    the base settings once ADR_LOST of its uplinks in a row are missed, and
+    stops renewing, so both sides end up on the base settings after a loss.
+
+    An unanswered command is sent again on the new settings, in case only
+    the answer was lost, then on the old ones, in case the node never got
+    it, before the basestation goes back to the old settings. A node keeps
+    new settings for only ADR_UNCONFIRMED_LEASE seconds until some other
+    frame from the basestation arrives on them, so a node stranded by a
+    lost answer soon returns to the base settings.
+'''
+import math
+
+from utils.airtime import BW_HZ, RadioProfile
+
+# SNR below which the SX127x cannot demodulate, for each spreading factor, in dB
+REQUIRED_SNR = {6: -5., 7: -7.5, 8: -10., 9: -12.5, 10: -15., 11: -17.5, 12: -20.}
+# lowest spreading factor a node is moved to (SF6 needs an implicit header)
+MIN_SF = 7
+# largest TX power reduction a node is ordered to, and the step between settings, in dB
+MAX_POWER_REDUCTION = 12
+POWER_STEP = 3
+# margin kept above the floor for fading, in dB
+LINK_MARGIN = 10.
+# margin one step of spreading factor or power is taken to be worth, in dB
+STEP_MARGIN = 3.
+# margin needed beyond that before stepping down, so that settings do not flap
+HYSTERESIS = 3.
+# uplinks averaged before each decision, all at the node's current settings
+ADR_WINDOW = 8
+# receiver noise figure, for the noise floor, in dB
+NOISE_FIGURE = 6.
+# seconds a node keeps adapted settings without receiving a LINK_ADR
+ADR_LEASE = 300
+# seconds a node keeps new settings before any other frame has arrived on them
+ADR_UNCONFIRMED_LEASE = 30
+# missed uplinks in a row after which the basestation gives up on the adapted settings
+ADR_LOST = 3
+
+def noise_floor(bw):
+  ''' Noise power in dBm across a bandwidth register value '''
+  return -174 + 10 * math.log10(BW_HZ[bw]) + NOISE_FIGURE
+
+def link_snr(snr, rssi, bw):
+  ''' SNR of a packet in dB, taken from its RSSI where the reported SNR saturates '''
+  if snr > 0:
+    return max(snr, rssi - noise_floor(bw))
+  return snr
+
+class LinkAdr():
+  ''' The spreading factor and TX power reduction a node has been given, and
+      the margin of its link
+  '''
+  def __init__(self, base_sf, window=ADR_WINDOW):
+    self.base_sf = base_sf
+    self.sf = base_sf
+    self.power_reduction = 0
+    self.window = window
+    self.uplink = []        # link SNR of recent uplinks at the current settings
+    self.downlink = None    # link SNR of the last command, as measured by the node
+    self.previous = None    # settings to go back to if the last command is not answered
+    self.retries = 0        # times the last command has been sent again
+    self.renewed = 0.
+    self.missed = 0
+    self.changes = 0
+    self.fallbacks = 0
+
+  def __str__(self):
+    return 'SF%d, TX power -%d dB' % (self.sf, self.power_reduction)
+
+  def settings(self):
+    return (self.sf, self.power_reduction)
+
+  def atBase(self):
+    return self.sf == self.base_sf and self.power_reduction == 0
+
+  def profile(self, base):
+    ''' base with the node's spreading factor '''
+    return RadioProfile(self.sf, base.bw, base.coding_rate, base.preamble, base.implicit_header, base.crc)
+
+  def onUplink(self, snr):
+    self.missed = 0
+    self.uplink.append(snr)
+    if len(self.uplink) > self.window:
+      self.uplink.pop(0)
+
+  def margin(self):
+    ''' Margin in dB above LINK_MARGIN, or None until the window is full '''
+    if len(self.uplink) < self.window:
+      return None
+    snr = sum(self.uplink) / len(self.uplink)
+    if self.downlink is not None:
+      snr = min(snr, self.downlink)
+    return snr - REQUIRED_SNR[self.sf] - LINK_MARGIN
+
+  def decide(self):
+    ''' New (spreading factor, power reduction) for the node, or None to keep
+        its settings
+    '''
+    margin = self.margin()
+    if margin is None or self.previous is not None:
+      return None
+    sf, reduction = self.sf, self.power_reduction
+    if margin > HYSTERESIS:
+      steps = int((margin - HYSTERESIS) / STEP_MARGIN)
+      # a lower spreading factor saves airtime, so the margin goes on that first
+      while steps > 0 and sf > MIN_SF:
+        sf -= 1
+        steps -= 1
+      while steps > 0 and reduction + POWER_STEP <= MAX_POWER_REDUCTION:
+        reduction += POWER_STEP
+        steps -= 1
+    elif margin < 0:
+      steps = int(math.ceil(-margin / STEP_MARGIN))
+      # power is restored before the spreading factor goes up
+      while steps > 0 and reduction > 0:
+        reduction = max(reduction - POWER_STEP, 0)
+        steps -= 1
+      while steps > 0 and sf < self.base_sf:
+        sf += 1
+        steps -= 1
+    if (sf, reduction) == self.settings():
+      return None
+    return (sf, reduction)
+
+  def renewalDue(self, now):
+    return not self.atBase() and self.previous is None and now - self.renewed >= ADR_LEASE / 3.
+
+  def command(self, settings):
+    ''' The node has been ordered to settings, which are listened on from now '''
+    self.previous = self.settings()
+    self.retries = 0
+    self.sf, self.power_reduction = settings
+    if settings != self.previous:
+      self.uplink = []
+
+  def onAnswer(self, downlink_snr, now):
+    if self.previous is not None and self.previous != self.settings():
+      self.changes += 1
+    self.previous = None
+    self.downlink = downlink_snr
+    self.renewed = now
+
+  def onUnanswered(self):
+    ''' The node did not answer the last command. Returns the settings to
+        send it again on, the new ones and then the old ones, or None once
+        it has been tried on both and the node is taken to have missed it
+    '''
+    if self.previous is None:
+      return None
+    self.retries += 1
+    if self.retries == 1:
+      return self.settings()
+    if self.retries == 2 and self.previous != self.settings():
+      return self.previous
+    if self.previous != self.settings():
+      self.uplink = []
+    self.sf, self.power_reduction = self.previous
+    self.previous = None
+    return None
+
+  def onMissed(self):
+    ''' An uplink the node should have sent did not arrive. Returns True if
+        the node was put back on the base settings.
+    '''
+    self.missed += 1
+    if self.missed < ADR_LOST or self.atBase():
+      return False
+    self.sf, self.power_reduction = self.base_sf, 0
+    self.previous = None
+    self.uplink = []
+    self.downlink = None
+    self.fallbacks += 1
+    return True
@@ -0,0 +1,72 @@
+''' LoRa time-on-air, following the Semtech SX1276 datasheet (section 4.1.1.7)
+'''
+import math
+
+# bandwidth in Hz for each value of the SX127x BW register field (constants.BW)
+BW_HZ = [7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000, 500000]
+
+# the same names LoRaArgumentParser accepts on the command line
+BW_LOOKUP = dict(BW7_8=0, BW10_4=1, BW15_6=2, BW20_8=3, BW31_25=4, BW41_7=5, BW62_5=6, BW125=7, BW250=8, BW500=9)
+CR_LOOKUP = dict(CR4_5=1, CR4_6=2, CR4_7=3, CR4_8=4)
+
+# symbols longer than this require the low data rate optimisation
+LOW_DATA_RATE_SYMBOL_TIME = 0.016
+
+def symbol_time(sf, bw):
+  ''' Duration of one symbol in seconds
+  :param sf: Spreading factor 6..12
+  :param bw: Bandwidth register value 0..9
+  '''
+  return (1 << sf) / float(BW_HZ[bw])
+
+def needs_low_data_rate_optim(sf, bw):
+  return symbol_time(sf, bw) > LOW_DATA_RATE_SYMBOL_TIME
+
+def time_on_air(payload_len, sf=7, bw=7, coding_rate=1, preamble=8, implicit_header=False, crc=True,
+                low_data_rate_optim=None):
+  ''' Time on air of a single frame in seconds
+  :param payload_len: Bytes written to the FIFO (the whole frame, header included)
+  :param sf: Spreading factor 6..12
+  :param bw: Bandwidth register value 0..9
+  :param coding_rate: Coding rate register value 1..4 (4/5 .. 4/8)
+  :param preamble: Programmed preamble length in symbols
+  :param implicit_header: True if the LoRa header is not sent
+  :param crc: True if the payload CRC is sent
+  :param low_data_rate_optim: Force the optimisation on/off, None to use it when required
+  '''
+  t_sym = symbol_time(sf, bw)
+  if low_data_rate_optim is None:
+    low_data_rate_optim = t_sym > LOW_DATA_RATE_SYMBOL_TIME
+  de = 1 if low_data_rate_optim else 0
+  ih = 1 if implicit_header else 0
+  crc = 1 if crc else 0
+
+  t_preamble = (preamble + 4.25) * t_sym
+  num = 8 * payload_len - 4 * sf + 28 + 16 * crc - 20 * ih
+  den = 4 * (sf - 2 * de)
+  n_payload = 8 + max(int(math.ceil(num / float(den))) * (coding_rate + 4), 0)
+  return t_preamble + n_payload * t_sym
+
+class RadioProfile():
+  ''' The modem settings that decide how long a frame spends on air
+  '''
+  def __init__(self, sf=7, bw=7, coding_rate=1, preamble=8, implicit_header=False, crc=True):
+    self.sf = sf
+    self.bw = bw
+    self.coding_rate = coding_rate
+    self.preamble = preamble
+    self.implicit_header = implicit_header
+    self.crc = crc
+
+  def __str__(self):
+    return 'SF%d BW%g kHz CR4/%d preamble=%d' % (self.sf, BW_HZ[self.bw] / 1000., self.coding_rate + 4, self.preamble)
+
+  @staticmethod
+  def fromArgs(args):
+    ''' Build a profile from the args returned by LoRaArgumentParser.parse_args,
+        where bw and coding_rate have already been turned into register values
+    '''
+    return RadioProfile(args.sf, args.bw, args.coding_rate, args.preamble)
+
+  def airtime(self, payload_len):
+    return time_on_air(payload_len, self.sf, self.bw, self.coding_rate, self.preamble, self.implicit_header, self.crc)
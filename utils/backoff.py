@@ -0,0 +1,75 @@
+''' Listen-before-talk: before each frame is sent the channel is checked, and
+    while it is busy the sender waits a random time from a window that
+    doubles with each busy check. Senders that find each other on the
+    channel spread out instead of retrying in lockstep, so goodput falls off
+    gradually as more nodes share the channel.
+'''
+try:
+  from random import random
+except ImportError:
+  # MicroPython on the LoPy has no random module
+  import os
+  def random():
+    return (os.urandom(1)[0] << 8 | os.urandom(1)[0]) / 65536.
+
+# channel checks before a frame is given up on
+MAX_ATTEMPTS = 6
+# backoff window after the first busy check, and the largest window, in seconds
+MIN_BACKOFF = 0.05
+MAX_BACKOFF = 3.2
+
+class ListenBeforeTalk():
+  ''' Backoff delays and channel access statistics of one radio
+  '''
+  def __init__(self, min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF, max_attempts=MAX_ATTEMPTS):
+    self.min_backoff = min_backoff
+    self.max_backoff = max_backoff
+    self.max_attempts = max_attempts
+    self.clear = 0          # frames sent after their first channel check
+    self.deferred = 0       # frames sent after backing off at least once
+    self.dropped = 0        # frames given up on with the channel still busy
+    self.busy = 0           # channel checks that found activity, each a collision avoided
+    self.backoff_time = 0.  # total time spent backing off, in seconds
+
+  @staticmethod
+  def forProfile(profile, frame_size, max_attempts=MAX_ATTEMPTS):
+    ''' Start with a window of one frame_size frame's airtime, which is about
+        how long whoever holds the channel will keep it
+    '''
+    min_backoff = max(profile.airtime(frame_size), MIN_BACKOFF)
+    max_backoff = max(MAX_BACKOFF, min_backoff * 2 ** (max_attempts - 2))
+    return ListenBeforeTalk(min_backoff, max_backoff, max_attempts)
+
+  def window(self, attempt):
+    return min(self.min_backoff * 2 ** attempt, self.max_backoff)
+
+  def onBusy(self, attempt):
+    ''' The channel was busy on check number attempt (from 0). Returns how
+        long to wait before checking again, or None to give up on the frame.
+    '''
+    self.busy += 1
+    if attempt + 1 >= self.max_attempts:
+      self.dropped += 1
+      return None
+    delay = random() * self.window(attempt)
+    self.backoff_time += delay
+    return delay
+
+  def onDeadline(self, delay):
+    ''' The frame was given up on instead of waiting delay, as returned by
+        onBusy, because it would then have missed its deadline
+    '''
+    self.backoff_time -= delay
+    self.dropped += 1
+
+  def onClear(self, attempt):
+    ''' The channel was free on check number attempt, and the frame goes out '''
+    if attempt:
+      self.deferred += 1
+    else:
+      self.clear += 1
+
+  def summary(self):
+    return ('%d frames sent on a clear channel, %d after backing off, %d dropped; '
+            '%d busy channel checks, %.1f s backing off' %
+            (self.clear, self.deferred, self.dropped, self.busy, self.backoff_time))
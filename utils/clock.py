@@ -0,0 +1,32 @@
+''' A monotonic clock with millisecond resolution for timing exchanges and
+    deadlines. time.time() on the LoPy counts whole seconds, too coarse for
+    round trip times and slot boundaries, so MicroPython's ticks_ms() is used
+    where it exists. CPython uses time.monotonic(), or time.time() on Python 2,
+    whose steps the slot sync in downlinks corrects.
+
+    ticks_ms() wraps around, so the elapsed ticks are accumulated between
+    calls. The clock must be read more often than half the ticks period
+    (several days), which any listening loop does.
+'''
+import time
+
+try:
+  ticks_ms = time.ticks_ms
+  ticks_diff = time.ticks_diff
+except AttributeError:
+  ticks_ms = None
+system_clock = getattr(time, 'monotonic', time.time)
+
+_last = None
+_elapsed = 0
+
+def monotonic():
+  ''' Seconds since an arbitrary point, for measuring intervals only '''
+  global _last, _elapsed
+  if ticks_ms is None:
+    return system_clock()
+  now = ticks_ms()
+  if _last is not None:
+    _elapsed += ticks_diff(now, _last)
+  _last = now
+  return _elapsed / 1000.
@@ -0,0 +1,79 @@
+''' Measures the size and speed of the binary wire codec against the original
+    one-byte-per-digit format. Run from the repository root with:
+
+        python -m utils.codec_bench
+'''
+import timeit
+
+from utils.utils import Packet, SensorType, ALL_SENSORS
+
+# a stored reading as returned by Node.getLatestData:
+# timestamp, lat, lon (micro-degrees), values
+GPS = ['1543499245.2', 50939200, 1391017]
+VALUES = {
+    SensorType.TEMP: [21, 37],
+    SensorType.HUMID: [48],
+    SensorType.AIR_QUAL: [412, 27],
+    SensorType.PRESS: [1013, 25],
+}
+READINGS = dict([(s, GPS + v) for s, v in VALUES.items()])
+# the same position as version 0 had it: lat and lon as (deg, min, decimal min)
+LEGACY_GPS = ['1543499245.2', 50, 56, 3520, 1, 23, 4610]
+LEGACY_READINGS = dict([(s, LEGACY_GPS + v) for s, v in VALUES.items()])
+NAMES = {SensorType.TEMP: 'TEMP', SensorType.HUMID: 'HUMID', SensorType.AIR_QUAL: 'AIR_QUAL', SensorType.PRESS: 'PRESS'}
+
+def legacy_encode(id, sensor_type, data):
+    ''' The version 0 SENSOR_RESPONSE encoder, kept here for comparison '''
+    def fixed_length_int(val, length):
+        val_str = str(val)
+        while len(val_str) < length:
+            val_str = ['0'] + list(val_str)
+        return [int(c) for c in val_str]
+
+    def encode_gps(val):
+        sec_str = str(val[2])
+        if val[2] == 0:
+            sec1 = sec2 = 0
+        else:
+            sec1 = int(sec_str[0:2])
+            sec2 = int(sec_str[2:4])
+        return [val[0], val[1], sec1, sec2]
+
+    payload = [sensor_type]
+    payload.extend(encode_gps(data[1:4]) + encode_gps(data[4:7]))
+    if sensor_type is SensorType.PRESS:
+        payload.extend(fixed_length_int(data[7], 4))
+    elif sensor_type is SensorType.AIR_QUAL:
+        val = fixed_length_int(data[7], 3)
+        val.extend(fixed_length_int(data[8], 3))
+        payload.extend(val)
+    else:
+        payload.extend(data[7:])
+    return list(bytearray([id, 0, 2]) + bytearray(payload))
+
+def rate(stmt, number):
+    return number / min(timeit.repeat(stmt, repeat=3, number=number))
+
+def main(number=20000):
+    print('%-9s %8s %8s %12s %12s %12s' % ('sensor', 'v0 B', 'v1 B', 'v0 enc/s', 'v1 enc/s', 'v1 dec/s'))
+    for sensor_type in ALL_SENSORS:
+        data = READINGS[sensor_type]
+        legacy_data = LEGACY_READINGS[sensor_type]
+        frame = Packet.encode_packet(Packet.createSensorResponse(1, sensor_type, data))
+        legacy = legacy_encode(1, sensor_type, legacy_data)
+
+        legacy_enc = rate(lambda: legacy_encode(1, sensor_type, legacy_data), number)
+        enc = rate(lambda: Packet.encode_packet(Packet.createSensorResponse(1, sensor_type, data)), number)
+        dec = rate(lambda: Packet.decode_sensor_data(Packet.decode_packet(frame).payload), number)
+        print('%-9s %8d %8d %12d %12d %12d' % (NAMES[sensor_type], len(legacy), len(frame), legacy_enc, enc, dec))
+
+    # one poll of every sensor: four version 0 frames against one multi sensor frame
+    frame = Packet.encode_packet(Packet.createMultiSensorResponse(1, READINGS))
+    legacy = sum([len(legacy_encode(1, s, LEGACY_READINGS[s])) for s in ALL_SENSORS])
+    legacy_enc = rate(lambda: [legacy_encode(1, s, LEGACY_READINGS[s]) for s in ALL_SENSORS], number)
+    enc = rate(lambda: Packet.encode_packet(Packet.createMultiSensorResponse(1, READINGS)), number)
+    dec = rate(lambda: Packet.decode_multi_sensor_data(Packet.decode_packet(frame).payload), number)
+    print('%-9s %8d %8d %12d %12d %12d' % ('ALL', legacy, len(frame), legacy_enc, enc, dec))
+
+if __name__ == '__main__':
+    main()
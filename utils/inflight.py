@@ -0,0 +1,58 @@
+''' Tracking of requests that are waiting for a response, so that several can
+    be outstanding at once and answers can arrive in any order.
+'''
+
+class Request():
+  ''' A request that has been sent and the response it is waiting for
+  '''
+  def __init__(self, node_id, msg_type, sent_at, deadline, context=None):
+    self.node_id = node_id
+    self.msg_type = msg_type
+    self.sent_at = sent_at
+    self.deadline = deadline
+    self.context = context
+
+class InFlightTable():
+  ''' Outstanding requests keyed by (node id, expected response type)
+  '''
+  def __init__(self):
+    self.requests = {}
+
+  def __len__(self):
+    return len(self.requests)
+
+  def __contains__(self, key):
+    return key in self.requests
+
+  def add(self, node_id, msg_type, sent_at, deadline, context=None):
+    ''' Record a request. A newer request for the same response replaces the
+        older one.
+    '''
+    request = Request(node_id, msg_type, sent_at, deadline, context)
+    self.requests[(node_id, msg_type)] = request
+    return request
+
+  def match(self, node_id, msg_type):
+    ''' Remove and return the request a response from node_id answers, or None
+        if nothing was waiting for it
+    '''
+    return self.requests.pop((node_id, msg_type), None)
+
+  def expire(self, now):
+    ''' Remove and return every request whose deadline has passed
+    '''
+    expired = [r for r in self.requests.values() if r.deadline <= now]
+    for r in expired:
+      del self.requests[(r.node_id, r.msg_type)]
+    return expired
+
+  def oldest(self):
+    ''' The earliest sent request still waiting, or None '''
+    if not self.requests:
+      return None
+    return min(self.requests.values(), key=lambda r: r.sent_at)
+
+  def nextDeadline(self):
+    if not self.requests:
+      return None
+    return min([r.deadline for r in self.requests.values()])
@@ -0,0 +1,99 @@
+''' Capacity planner for the polled network. Run from the repository root with:
+
+        python -m utils.planner --nodes 7 --sf 9 --sensors TEMP,PRESS
+'''
+import argparse
+
+from utils.airtime import RadioProfile, BW_LOOKUP, CR_LOOKUP
+from utils.utils import HEADER, BYTE, SensorType, multiSensorResponseSize, multiSensorSummarySize
+
+SENSOR_LOOKUP = dict(TEMP=SensorType.TEMP, HUMID=SensorType.HUMID, AIR_QUAL=SensorType.AIR_QUAL, PRESS=SensorType.PRESS)
+
+def request_size():
+  ''' Bytes in a MULTI_SENSOR_REQUEST frame '''
+  return HEADER.size + BYTE.size
+
+def response_size(sensors, summary=False):
+  ''' Bytes in a MULTI_SENSOR_RESPONSE, or MULTI_SENSOR_SUMMARY, frame carrying the given sensors '''
+  if summary:
+    return multiSensorSummarySize(sensors)
+  return multiSensorResponseSize(sensors)
+
+def plan(profile, nodes, sensors, guard=0.1, duty_limit=0.01, summary=False):
+  ''' Work out the fastest sustainable poll rate for the network.
+  :param profile: RadioProfile of every node and the basestation
+  :param nodes: Number of nodes polled each cycle
+  :param sensors: Sensor types each node reports
+  :param guard: Turnaround time in seconds allowed around each frame
+  :param duty_limit: Maximum fraction of time any one transmitter may be on air
+  :param summary: Nodes answer with window summaries rather than the latest readings
+  :return: dict of airtimes (s), the limiting rates (polls/s) and duty cycle use at the maximum rate
+  '''
+  t_req = profile.airtime(request_size())
+  t_resp = profile.airtime(response_size(sensors, summary))
+
+  # the channel carries every request and response of the cycle back to back
+  cycle = nodes * (t_req + t_resp + 2 * guard)
+  channel_rate = 1. / cycle
+  # each node sends one response per poll, the basestation one request per node per poll
+  node_rate = duty_limit / t_resp
+  base_rate = duty_limit / (nodes * t_req)
+  rate = min(channel_rate, node_rate, base_rate)
+
+  return dict(
+      request_airtime=t_req,
+      response_airtime=t_resp,
+      cycle_time=cycle,
+      channel_rate=channel_rate,
+      node_duty_rate=node_rate,
+      base_duty_rate=base_rate,
+      max_rate=rate,
+      channel_use=rate * cycle,
+      node_duty=rate * t_resp,
+      base_duty=rate * nodes * t_req,
+  )
+
+def main():
+  parser = argparse.ArgumentParser(description='LoRa sensor network capacity planner')
+  parser.add_argument('--nodes', '-n', dest='nodes', default=7, type=int, help="Number of nodes. Default is 7.")
+  parser.add_argument('--sensors', dest='sensors', default='TEMP,HUMID,AIR_QUAL,PRESS', type=str,
+                      help="Comma separated sensors each node reports. Default is all of them.")
+  parser.add_argument('--sf', '-s', dest='sf', default=7, type=int, help="Spreading factor (6...12). Default is 7.")
+  parser.add_argument('--bw', '-b', dest='bw', default='BW125', type=str,
+                      help="Bandwidth (one of %s). Default is BW125." % ' '.join(sorted(BW_LOOKUP, key=BW_LOOKUP.get)))
+  parser.add_argument('--cr', '-r', dest='coding_rate', default='CR4_5', type=str,
+                      help="Coding rate (one of CR4_5 CR4_6 CR4_7 CR4_8). Default is CR4_5.")
+  parser.add_argument('--preamble', '-p', dest='preamble', default=8, type=int, help="Preamble length. Default is 8.")
+  parser.add_argument('--implicit-header', dest='implicit_header', action='store_true', help="Do not send the LoRa header.")
+  parser.add_argument('--no-crc', dest='crc', action='store_false', help="Do not send the payload CRC.")
+  parser.add_argument('--guard', '-g', dest='guard', default=0.1, type=float,
+                      help="Turnaround time in seconds around each frame. Default is 0.1.")
+  parser.add_argument('--duty-cycle', '-d', dest='duty_cycle', default=1.0, type=float,
+                      help="Duty cycle limit in percent for every transmitter. Default is 1.")
+  parser.add_argument('--summary', dest='summary', action='store_true',
+                      help="Nodes answer with window summaries (min/max/mean) rather than the latest readings.")
+  args = parser.parse_args()
+
+  bw = BW_LOOKUP.get(args.bw, None)
+  coding_rate = CR_LOOKUP.get(args.coding_rate, None)
+  sensors = [SENSOR_LOOKUP.get(s.strip().upper(), None) for s in args.sensors.split(',')]
+  if bw is None or coding_rate is None or None in sensors or not 6 <= args.sf <= 12:
+    parser.error('invalid radio profile or sensor list')
+
+  profile = RadioProfile(args.sf, bw, coding_rate, args.preamble, args.implicit_header, args.crc)
+  result = plan(profile, args.nodes, sensors, args.guard, args.duty_cycle / 100., args.summary)
+
+  print('Radio profile:      %s' % profile)
+  print('Request frame:      %d bytes, %.1f ms on air' % (request_size(), result['request_airtime'] * 1000))
+  print('Response frame:     %d bytes, %.1f ms on air' % (response_size(sensors, args.summary), result['response_airtime'] * 1000))
+  print('Poll cycle:         %.3f s for %d nodes' % (result['cycle_time'], args.nodes))
+  print('Limit (channel):    %.4f polls/s' % result['channel_rate'])
+  print('Limit (node duty):  %.4f polls/s' % result['node_duty_rate'])
+  print('Limit (base duty):  %.4f polls/s' % result['base_duty_rate'])
+  print('Max poll rate:      %.4f polls/s (one poll every %.1f s)' % (result['max_rate'], 1. / result['max_rate']))
+  print('Channel use:        %.1f %%' % (result['channel_use'] * 100))
+  print('Node duty cycle:    %.3f %%' % (result['node_duty'] * 100))
+  print('Base duty cycle:    %.3f %%' % (result['base_duty'] * 100))
+
+if __name__ == '__main__':
+  main()
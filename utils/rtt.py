@@ -0,0 +1,56 @@
+''' Round trip time estimation for adaptive response timeouts, using the same
+    smoothed mean and variance as TCP's retransmission timer (RFC 6298).
+'''
+
+# gains of the smoothed round trip time and its variance
+ALPHA = 0.125
+BETA = 0.25
+# how many variances to allow above the smoothed round trip time
+K = 4
+# bounds on the timeout in seconds
+MIN_TIMEOUT = 0.2
+MAX_TIMEOUT = 30.
+# time a peer takes to turn a request into a response, before any samples
+PROCESSING_TIME = 0.3
+
+class RttEstimator():
+  ''' Smoothed round trip time and timeout for one peer
+  '''
+  def __init__(self, initial_rtt, min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT):
+    ''' :param initial_rtt: Expected round trip time in seconds before the first sample,
+            normally the airtime of the request and response plus processing time
+    '''
+    self.min_timeout = min_timeout
+    self.max_timeout = max_timeout
+    self.srtt = initial_rtt
+    self.rttvar = initial_rtt / 2.
+    self.backoff = 1
+    self.samples = 0
+
+  @staticmethod
+  def forFrames(profile, request_size, response_size):
+    ''' Seed an estimator from the airtime of a request and its response '''
+    return RttEstimator(profile.airtime(request_size) + profile.airtime(response_size) + PROCESSING_TIME)
+
+  def sample(self, rtt):
+    ''' Add a measured round trip time. Only measure requests that were sent
+        once, since a response to a retry cannot be matched to a send time.
+    '''
+    if self.samples == 0:
+      self.srtt = rtt
+      self.rttvar = rtt / 2.
+    else:
+      self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+      self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+    self.samples += 1
+    self.backoff = 1
+
+  def timeout(self):
+    ''' Time to wait for a response before giving up on it '''
+    rto = (self.srtt + K * self.rttvar) * self.backoff
+    return min(max(rto, self.min_timeout), self.max_timeout)
+
+  def onTimeout(self):
+    ''' Double the timeout after a lost response, until the next sample '''
+    if self.timeout() < self.max_timeout:
+      self.backoff *= 2
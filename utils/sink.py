@@ -0,0 +1,101 @@
+''' Buffered, append-only writing of rows to many files with a bounded number
+    of open handles, for storage where an open/close per row is too costly.
+'''
+import os
+import time
+
+# Durability levels
+BUFFERED = 0        # rows are held in memory and written out on a size/time threshold
+SYNC = 1            # as BUFFERED, and each write out is also synced to storage
+WRITE_THROUGH = 2   # every row is written and flushed as soon as it arrives
+
+class FileSink():
+  ''' Appends rows to files, keeping up to open_files handles open in append
+      mode and buffering rows until max_rows are held or the oldest is
+      max_age seconds old
+  '''
+  def __init__(self, open_files=8, max_rows=64, max_age=30., durability=BUFFERED):
+    if durability == SYNC and not (hasattr(os, 'fsync') or hasattr(os, 'sync')):
+      raise ValueError('SYNC durability needs os.fsync or os.sync')
+    self.open_files = open_files
+    self.max_rows = max_rows
+    self.max_age = max_age
+    self.durability = durability
+    self.handles = {}     # path -> open file
+    self.lru = []         # paths of open files, least recently used first
+    self.buffers = {}     # path -> rows waiting to be written
+    self.headers = {}     # path -> header line for a new file
+    self.rows = 0
+    self.oldest = None
+
+  def setHeader(self, path, header):
+    ''' Header written as the first line when the file is created '''
+    self.headers[path] = header
+
+  def write(self, path, row, now=None):
+    now = time.time() if now is None else now
+    self.buffers.setdefault(path, []).append(row + '\n')
+    self.rows += 1
+    if self.oldest is None:
+      self.oldest = now
+    if self.durability == WRITE_THROUGH:
+      self.flush()
+    else:
+      self.tick(now)
+
+  def tick(self, now=None):
+    ''' Flush if a threshold has been reached. Call periodically so rows do
+        not wait longer than max_age when no more arrive.
+    '''
+    now = time.time() if now is None else now
+    if self.rows >= self.max_rows or (self.oldest is not None and now - self.oldest >= self.max_age):
+      self.flush()
+
+  def flush(self):
+    for path, rows in self.buffers.items():
+      if not rows:
+        continue
+      f = self.handle(path)
+      f.write(''.join(rows))
+      f.flush()
+      if self.durability == SYNC and hasattr(os, 'fsync'):
+        os.fsync(f.fileno())
+    # the LoPy has no fsync, but os.sync writes out every file at once
+    if self.durability == SYNC and self.rows and not hasattr(os, 'fsync'):
+      os.sync()
+    self.buffers = {}
+    self.rows = 0
+    self.oldest = None
+
+  def close(self):
+    self.flush()
+    for f in self.handles.values():
+      f.close()
+    self.handles = {}
+    self.lru = []
+
+  def handle(self, path):
+    f = self.handles.get(path)
+    if f is not None:
+      self.lru.remove(path)
+      self.lru.append(path)
+      return f
+
+    if len(self.handles) >= self.open_files:
+      self.handles.pop(self.lru.pop(0)).close()
+
+    header = self.headers.get(path)
+    if header is not None and self.isEmpty(path):
+      f = open(path, 'w')
+      f.write(header + '\n')
+    else:
+      f = open(path, 'a')
+    self.handles[path] = f
+    self.lru.append(path)
+    return f
+
+  def isEmpty(self, path):
+    try:
+      return os.stat(path)[6] == 0
+    except OSError:
+      return True
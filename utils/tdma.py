@@ -0,0 +1,134 @@
+''' Uplink slot scheduling for the slotted (TDMA) mode of the network.
+
+    The basestation divides time into a repeating period of equally sized
+    slots and hands each node one slot when it joins. Nodes then send their
+    readings at the start of their slot without being polled.
+
+    Times are seconds on utils.clock.monotonic(), which has the millisecond
+    resolution that slot boundaries and JOIN_ACK offsets are given in.
+'''
+import math
+
+from utils.clock import monotonic
+
+# the network protocol has room for up to 7 nodes
+MAX_NODES = 7
+# time allowed around each uplink for turnaround and clock error, in seconds
+SLOT_GUARD = 0.5
+# maximum fraction of time a node may spend transmitting
+DUTY_CYCLE_LIMIT = 0.01
+# share of that a node may spend uploading readings the basestation missed
+BACKLOG_DUTY_CYCLE = DUTY_CYCLE_LIMIT / 2
+
+class SlotSchedule():
+  ''' Assigns slots to nodes and tracks which expected uplinks arrived
+  '''
+  def __init__(self, slot_length, period, slot_count=MAX_NODES, epoch=None):
+    assert period >= slot_length * slot_count
+    self.slot_length = slot_length
+    self.period = period
+    self.slot_count = slot_count
+    # slots are counted from when the schedule is made, unless told otherwise
+    self.epoch = monotonic() if epoch is None else epoch
+    self.slots = {}       # node id -> slot index
+    self.expected = {}    # node id -> start of the next slot we expect a frame in
+    self.received = {}    # node id -> True if a frame arrived in that slot
+    self.missed = {}      # node id -> consecutive missed slots
+
+  @staticmethod
+  def forProfile(profile, frame_size, slot_count=MAX_NODES, guard=SLOT_GUARD, duty_limit=DUTY_CYCLE_LIMIT, epoch=None):
+    ''' Size the slots to fit one uplink of frame_size bytes, and stretch the
+        period if needed so that no node exceeds the duty cycle limit
+    '''
+    airtime = profile.airtime(frame_size)
+    # whole milliseconds, as sent in the JOIN_ACK, so nodes do not drift off the grid
+    slot_length = math.ceil((airtime + guard) * 1000) / 1000.
+    period = max(slot_length * slot_count, math.ceil(airtime / duty_limit * 1000) / 1000.)
+    return SlotSchedule(slot_length, period, slot_count, epoch)
+
+  def slotStart(self, slot, now):
+    ''' Start time of the first occurrence of a slot that is after now '''
+    cycles = int((now - self.epoch) // self.period)
+    start = self.epoch + cycles * self.period + slot * self.slot_length
+    while start <= now:
+      start += self.period
+    return start
+
+  def assign(self, node_id, now):
+    ''' Give a node a free slot, returning the time until its first slot
+        starts, or None if every slot is taken
+    '''
+    if node_id not in self.slots:
+      used = self.slots.values()
+      free = [i for i in range(self.slot_count) if i not in used]
+      if not free:
+        return None
+      self.slots[node_id] = free[0]
+    start = self.slotStart(self.slots[node_id], now + self.slot_length)
+    self.expected[node_id] = start
+    self.received[node_id] = False
+    self.missed[node_id] = 0
+    return start - now
+
+  def nextFreeSlot(self, now):
+    ''' Start of the next slot that no node has been given, including any
+        slot sized gap at the end of the period, or None if there is none
+    '''
+    used = self.slots.values()
+    free = [i for i in range(self.slot_count) if i not in used]
+    if self.period - self.slot_count * self.slot_length >= self.slot_length:
+      free.append(self.slot_count)
+    if not free:
+      return None
+    return min([self.slotStart(i, now) for i in free])
+
+  def slotAt(self, now):
+    ''' The node whose slot is open at now, or None, and when that slot ends '''
+    cycles = int((now - self.epoch) // self.period)
+    cycle_start = self.epoch + cycles * self.period
+    slot = int((now - cycle_start) // self.slot_length)
+    end = min(cycle_start + (slot + 1) * self.slot_length, cycle_start + self.period)
+    for node_id, index in self.slots.items():
+      if index == slot:
+        return node_id, end
+    return None, end
+
+  def release(self, node_id):
+    for d in (self.slots, self.expected, self.received, self.missed):
+      d.pop(node_id, None)
+
+  def onReceive(self, node_id, now):
+    ''' Record an uplink from a node. Returns False if it arrived outside the
+        node's slot
+    '''
+    start = self.expected.get(node_id)
+    if start is None:
+      return False
+    if start - self.slot_length <= now <= start + self.slot_length:
+      self.received[node_id] = True
+      self.missed[node_id] = 0
+      return True
+    return False
+
+  def check(self, now):
+    ''' Close every slot that has ended, returning the ids of the nodes that
+        did not send in theirs
+    '''
+    missed = []
+    for node_id, start in list(self.expected.items()):
+      if now < start + self.slot_length:
+        continue
+      if not self.received[node_id]:
+        self.missed[node_id] += 1
+        missed.append(node_id)
+      self.received[node_id] = False
+      while start + self.slot_length <= now:
+        start += self.period
+      self.expected[node_id] = start
+    return missed
+
+  def nextDeadline(self, now):
+    ''' Time at which the next open slot ends '''
+    if not self.expected:
+      return now + self.period
+    return min([start + self.slot_length for start in self.expected.values()])
@@ -0,0 +1,287 @@
+''' Columnar binary time-series store for sensor readings.
+
+    Readings are kept per node and sensor, split into segments of at most
+    SEGMENT_RECORDS readings. Each segment holds one file per column of
+    fixed-width little-endian values, so a column can be memory-mapped and
+    used as an array without parsing:
+
+        <root>/node_<id>/<SENSOR>/index             one entry per segment
+        <root>/node_<id>/<SENSOR>/<segment>.<column>
+
+    where the id of a node's first Thingy is the node id, and that of any
+    further Thingy is <node id>_<sub-address>.
+
+    The columns are timestamp (float64 seconds), latitude and longitude
+    (int32 micro-degrees) and the sensor's fields in the fixed point units
+    used on the wire (see SENSOR_SCALES). Readings are expected in time
+    order, as a node or the basestation produces them.
+
+    The index is a sparse time index: one (first timestamp, last timestamp,
+    count) entry per segment, so a range query only touches the segments
+    that overlap it and finds its rows in them by binary search on the
+    timestamp column.
+
+    Appending works anywhere the struct module does. Queries memory-map the
+    columns, which needs a little-endian host with Python 3.
+
+    Import the data logs written by a node with:
+
+        python -m utils.tsstore import <root> <node id> <node data dir>
+        python -m utils.tsstore import <root> <node id>_<n> <node data dir>/thingy<n>
+'''
+import os
+import time
+
+from utils.utils import Struct, ALL_SENSORS, SENSOR_NAMES, SENSOR_FIELDS, SENSOR_FORMATS, SENSOR_SCALES, Packet
+from utils.utils import LEGACY_ROW_FIELDS
+
+try:
+  import mmap
+except ImportError:
+  mmap = None
+
+# readings per segment before a new one is started
+SEGMENT_RECORDS = 65536
+# readings buffered in memory before they are written out
+MAX_BUFFERED_ROWS = 256
+MAX_BUFFERED_AGE = 60
+
+INDEX_ENTRY = Struct('<ddI')    # first timestamp | last timestamp | readings in segment
+
+POSITION_COLUMNS = (('timestamp', 'd'), ('latitude', 'i'), ('longitude', 'i'))
+
+def columns(sensor):
+  ''' (name, struct format) of every column stored for a sensor '''
+  fields = SENSOR_FIELDS[sensor]
+  return POSITION_COLUMNS + tuple(zip(fields, SENSOR_FORMATS[sensor]))
+
+class TimeSeriesStore():
+  ''' Appends readings to, and queries time ranges from, a store directory
+  '''
+  def __init__(self, root, segment_records=SEGMENT_RECORDS, max_rows=MAX_BUFFERED_ROWS, max_age=MAX_BUFFERED_AGE):
+    self.root = root
+    self.segment_records = segment_records
+    self.max_rows = max_rows
+    self.max_age = max_age
+    self.pending = {}     # (node id, sensor) -> rows waiting to be written
+    self.rows = 0
+    self.oldest = None
+
+  def path(self, node_id, sensor, name=''):
+    return '/'.join([self.root, 'node_' + str(node_id), SENSOR_NAMES[sensor], name]).rstrip('/')
+
+  def append(self, node_id, sensor, timestamp, latitude, longitude, values, now=None):
+    ''' Add one reading. Position is in micro-degrees and values in the wire's
+        fixed point units, as produced by Packet.encodeGps/encodeSensorValues.
+    '''
+    now = time.time() if now is None else now
+    row = (timestamp, latitude, longitude) + tuple(values)
+    self.pending.setdefault((node_id, sensor), []).append(row)
+    self.rows += 1
+    if self.oldest is None:
+      self.oldest = now
+    self.tick(now)
+
+  def appendReading(self, node_id, sensor, timestamp, data):
+    ''' Add one reading from a dict decoded by Packet.decode_multi_sensor_data '''
+    latitude = int(round(data['latitude'] * 1000000))
+    longitude = int(round(data['longitude'] * 1000000))
+    scale = SENSOR_SCALES[sensor]
+    values = [int(round(data[field] * scale)) for field in SENSOR_FIELDS[sensor]]
+    self.append(node_id, sensor, timestamp, latitude, longitude, values)
+
+  def tick(self, now=None):
+    now = time.time() if now is None else now
+    if self.rows >= self.max_rows or (self.oldest is not None and now - self.oldest >= self.max_age):
+      self.flush()
+
+  def flush(self):
+    for (node_id, sensor), rows in self.pending.items():
+      if rows:
+        self.write(node_id, sensor, rows)
+    self.pending = {}
+    self.rows = 0
+    self.oldest = None
+
+  def close(self):
+    self.flush()
+
+  def segments(self, node_id, sensor):
+    ''' The index of a sensor: a list of (first timestamp, last timestamp, count),
+        where the position in the list is the segment number
+    '''
+    try:
+      with open(self.path(node_id, sensor, 'index'), 'rb') as f:
+        data = f.read()
+    except (IOError, OSError):
+      return []
+    n = len(data) // INDEX_ENTRY.size
+    return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(n)]
+
+  def write(self, node_id, sensor, rows):
+    directory = self.path(node_id, sensor)
+    self.makedirs(directory)
+    index = self.segments(node_id, sensor)
+    cols = columns(sensor)
+    while rows:
+      if not index or index[-1][2] >= self.segment_records:
+        index.append((rows[0][0], rows[0][0], 0))
+      segment = len(index) - 1
+      first, last, count = index[-1]
+      batch = rows[:self.segment_records - count]
+      rows = rows[len(batch):]
+
+      for i, (name, fmt) in enumerate(cols):
+        filename = '%s/%06d.%s' % (directory, segment, name)
+        # drop whatever a write cut short left past the indexed values
+        truncateColumn(filename, count * Struct('<' + fmt).size)
+        column = Struct('<%d%s' % (len(batch), fmt))
+        with open(filename, 'ab') as f:
+          f.write(column.pack(*[row[i] for row in batch]))
+
+      index[-1] = (first, max(last, batch[-1][0]), count + len(batch))
+      with open(directory + '/index', 'r+b' if segment or count else 'wb') as f:
+        f.seek(segment * INDEX_ENTRY.size)
+        f.write(INDEX_ENTRY.pack(*index[-1]))
+
+  def makedirs(self, directory):
+    path = ''
+    for part in directory.split('/'):
+      path = part if not path else path + '/' + part
+      if not path:
+        continue
+      try:
+        os.mkdir(path)
+      except OSError:
+        # already exists
+        pass
+
+  def mapSegment(self, node_id, sensor, segment):
+    ''' Memory-map every column of a segment, returning a dict of name ->
+        memoryview cast to the column's type. Nothing is read until used.
+    '''
+    if mmap is None:
+      raise RuntimeError('memory mapped queries need the mmap module')
+    directory = self.path(node_id, sensor)
+    result = {}
+    for name, fmt in columns(sensor):
+      with open('%s/%06d.%s' % (directory, segment, name), 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+          result[name] = memoryview(b'').cast(fmt)
+          continue
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      result[name] = memoryview(m).cast(fmt)
+    return result
+
+  def querySegments(self, node_id, sensor, start, end):
+    ''' Yield a dict of zero-copy column slices for each segment overlapping
+        [start, end), in time order
+    '''
+    for segment, (first, last, count) in enumerate(self.segments(node_id, sensor)):
+      if last < start or first >= end:
+        continue
+      cols = self.mapSegment(node_id, sensor, segment)
+      ts = cols['timestamp']
+      lo = bisect(ts, start, 0, count)
+      hi = bisect(ts, end, lo, count)
+      if lo < hi:
+        yield dict([(name, col[lo:hi]) for name, col in cols.items()])
+
+  def query(self, node_id, sensor, start, end):
+    ''' Readings in [start, end) as a dict of column name -> list '''
+    result = dict([(name, []) for name, _ in columns(sensor)])
+    for cols in self.querySegments(node_id, sensor, start, end):
+      for name, col in cols.items():
+        result[name].extend(col.tolist())
+    return result
+
+def truncateColumn(filename, size):
+  ''' Cut a column file down to size bytes, if it is longer '''
+  try:
+    length = os.stat(filename)[6]
+  except OSError:
+    return
+  if length <= size:
+    return
+  with open(filename, 'r+b') as f:
+    if hasattr(f, 'truncate'):
+      f.truncate(size)
+      return
+    # MicroPython files cannot be truncated, so the kept part is written again
+    data = f.read(size)
+  with open(filename, 'wb') as f:
+    f.write(data)
+
+def bisect(column, value, lo, hi):
+  ''' First position in column[lo:hi] whose value is not below value '''
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if column[mid] < value:
+      lo = mid + 1
+    else:
+      hi = mid
+  return lo
+
+def import_csv(store, node_id, sensor, filename):
+  ''' Append the readings in a node CSV file (TEMP.csv etc.) to the store.
+      Returns the number of readings imported.
+  '''
+  imported = 0
+  with open(filename, 'r') as f:
+    for line in f:
+      tokens = [t.strip() for t in line.split(',')]
+      try:
+        if len(tokens) >= LEGACY_ROW_FIELDS:
+          # logged before positions were kept in micro-degrees
+          tokens[1:7] = [Packet.encodeGps(tokens[1:4]), Packet.encodeGps(tokens[4:7])]
+        timestamp = float(tokens[0])
+        latitude = int(tokens[1])
+        longitude = int(tokens[2])
+        values = Packet.encodeSensorValues(sensor, [int(t) for t in tokens[3:]])
+      except (ValueError, IndexError):
+        # the header, or a line cut short by a power loss
+        continue
+      store.append(node_id, sensor, timestamp, latitude, longitude, values)
+      imported += 1
+  store.flush()
+  return imported
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description='LoRa sensor network time-series store')
+  commands = parser.add_subparsers(dest='command')
+  imp = commands.add_parser('import', help='import the CSV files of a node')
+  imp.add_argument('root')
+  imp.add_argument('node_id', help='node id, or <node id>_<sub-address> for a node\'s further Thingys')
+  imp.add_argument('data_dir', help='directory holding the TEMP, HUMID, AIR_QUAL and PRESS data logs')
+  query = commands.add_parser('query', help='print the readings in a time range')
+  query.add_argument('root')
+  query.add_argument('node_id')
+  query.add_argument('sensor', choices=sorted(SENSOR_NAMES.values()))
+  query.add_argument('--start', type=float, default=0)
+  query.add_argument('--end', type=float, default=float('inf'))
+  args = parser.parse_args()
+
+  store = TimeSeriesStore(args.root)
+  if args.command == 'import':
+    for sensor in ALL_SENSORS:
+      # a segmented data log, or a single CSV file from before the logs were segmented
+      log = os.path.join(args.data_dir, SENSOR_NAMES[sensor])
+      if os.path.isdir(log):
+        filenames = [os.path.join(log, name) for name in sorted(os.listdir(log)) if name.endswith('.csv')]
+      else:
+        filenames = [log + '.csv'] if os.path.isfile(log + '.csv') else []
+      for filename in filenames:
+        print('Imported %d readings from %s' % (import_csv(store, args.node_id, sensor, filename), filename))
+  elif args.command == 'query':
+    sensor = [s for s in ALL_SENSORS if SENSOR_NAMES[s] == args.sensor][0]
+    names = [name for name, _ in columns(sensor)]
+    print(','.join(names))
+    for cols in store.querySegments(args.node_id, sensor, args.start, args.end):
+      for row in zip(*[cols[name].tolist() for name in names]):
+        print(','.join([str(v) for v in row]))
+  else:
+    parser.print_help()
+
+if __name__ == '__main__':
+  main()
@@ -1,3 +1,30 @@
+import struct
+
+try:
+  Struct = struct.Struct
+except AttributeError:
+  ''' MicroPython's struct module has no precompiled Struct, so wrap the
+      module level functions behind the same interface
+  '''
+  class Struct():
+    def __init__(self, fmt):
+      self.format = fmt
+      self.size = struct.calcsize(fmt)
+
+    def pack(self, *vals):
+      return struct.pack(self.format, *vals)
+
+    def pack_into(self, buf, offset, *vals):
+      struct.pack_into(self.format, buf, offset, *vals)
+
+    def unpack_from(self, buf, offset=0):
+      return struct.unpack_from(self.format, buf, offset)
+
+''' Version of the wire format, carried in the top nibble of the message type
+    byte. Version 0 was the original one-byte-per-decimal-digit format.
+'''
+CODEC_VERSION = 1
+
 ''' Enum for the types of message that are produced
 '''
 class MessageType():
@@ -5,6 +32,12 @@ class MessageType():
   JOIN_ACK = 1
   SENSOR_RESPONSE = 2
   SENSOR_REQUEST = 3
+  MULTI_SENSOR_REQUEST = 4
+  MULTI_SENSOR_RESPONSE = 5
+  BACKLOG_REQUEST = 6
+  BACKLOG_DATA = 7
+  MULTI_SENSOR_SUMMARY = 8
+  LINK_ADR = 9
 
 ''' Enum for the types of sensor available to the network
 '''
@@ -15,171 +48,561 @@ class SensorType():
     PRESS = 3
 
 ALL_SENSORS = [SensorType.TEMP, SensorType.HUMID, SensorType.AIR_QUAL, SensorType.PRESS]
+SENSOR_NAMES = {SensorType.TEMP: 'TEMP', SensorType.HUMID: 'HUMID', SensorType.AIR_QUAL: 'AIR_QUAL', SensorType.PRESS: 'PRESS'}
+
+# Precompiled wire layouts, all little endian with no padding
+HEADER = Struct('<BBB')           # src id | dest id | version << 4 | msg type
+BYTE = Struct('<B')               # single byte payloads (sensor type, sensor mask, ack status)
+SENSOR_HEADER = Struct('<Bii')    # sensor type | latitude | longitude (micro-degrees)
+MULTI_SENSOR_HEADER = Struct('<Bii')  # sensor mask | latitude | longitude (micro-degrees)
+JOIN_ACK = Struct('<BII')         # uplink mode | ms until first slot | slot period in ms
+JOIN_HEARTBEAT = Struct('<H')     # longest silence of a node reporting by exception, in s
+BACKLOG_REQUEST = Struct('<HB')   # sequence of the last backlog frame received | max frame size
+SLOT_SYNC = Struct('<I')          # ms from the end of the frame to the start of the node's next slot
+SUMMARY_WINDOW = Struct('<I')     # length of the window summarised, in ms
+BACKLOG_HEADER = Struct('<HBd')   # sequence | more pending << 7 | sub-address << 4 | sensor type | timestamp of the first reading
+LINK_ADR = Struct('<BB')          # spreading factor | TX power reduction (dB)
+LINK_QUALITY = Struct('<bh')      # SNR (quarter dB) | RSSI (dBm) of the LINK_ADR being answered
+
+# Uplink modes a node can be given in its JOIN_ACK
+POLLED = 0
+SLOTTED = 1
+
+# Sensor bits of a sensor mask. The top bit of the mask in a JOIN_REQUEST or
+# MULTI_SENSOR_RESPONSE is set while the node has readings waiting to be uploaded.
+SENSOR_MASK = 0x0F
+BACKLOG_PENDING = 0x80
+# A node may serve several Thingys, told apart by a sub-address in bits 4-6 of
+# the sensor mask of requests and responses
+SUB_ADDRESS_SHIFT = 4
+SUB_ADDRESS_MASK = 0x70
+MAX_DEVICES = 8
+# Acknowledges no backlog frame
+NO_SEQUENCE = 0xFFFF
+# Node log rows written before positions were kept in micro-degrees hold each as
+# degrees, minutes and decimal minutes, so have at least this many fields
+LEGACY_ROW_FIELDS = 8
+# Largest BACKLOG_DATA frame a node sends
+BACKLOG_FRAME_SIZE = 128
+
+# Format of the reading carried for each sensor type
+SENSOR_FORMATS = {
+    SensorType.TEMP: 'h',         # centi-degrees C
+    SensorType.HUMID: 'B',        # percent
+    SensorType.AIR_QUAL: 'HH',    # eCO2 (ppm), TVOC (ppb)
+    SensorType.PRESS: 'I',        # centi-hPa
+}
+SENSOR_LAYOUTS = dict([(s, Struct('<' + f)) for s, f in SENSOR_FORMATS.items()])
+
+# Layouts of the readings in a MULTI_SENSOR_RESPONSE, compiled once per sensor mask
+MULTI_SENSOR_LAYOUTS = {}
+# Layouts of the window statistics in a MULTI_SENSOR_SUMMARY, compiled once per sensor mask:
+# readings in the window | minimum | maximum | mean, for each sensor
+SUMMARY_LAYOUTS = {}
+# Layout of each reading in a BACKLOG_DATA frame:
+# ms after the first reading | latitude | longitude | reading
+BACKLOG_RECORDS = dict([(s, Struct('<Iii' + f)) for s, f in SENSOR_FORMATS.items()])
+
+# Names of the decoded fields and the fixed point scale they are sent with
+SENSOR_FIELDS = {
+    SensorType.TEMP: ('temp',),
+    SensorType.HUMID: ('humid',),
+    SensorType.AIR_QUAL: ('co2', 'tvoc'),
+    SensorType.PRESS: ('press',),
+}
+SENSOR_SCALES = {SensorType.TEMP: 100, SensorType.HUMID: 1, SensorType.AIR_QUAL: 1, SensorType.PRESS: 100}
+
+def multiSensorLayout(mask):
+  ''' Layout of the readings for a sensor mask, in ascending sensor type order
+  '''
+  layout = MULTI_SENSOR_LAYOUTS.get(mask)
+  if layout is None:
+    fmt = ''.join([SENSOR_FORMATS[s] for s in ALL_SENSORS if mask & (1 << s)])
+    layout = MULTI_SENSOR_LAYOUTS[mask] = Struct('<' + fmt)
+  return layout
+
+def summaryLayout(mask):
+  ''' Layout of the window statistics for a sensor mask, in ascending sensor type order
+  '''
+  layout = SUMMARY_LAYOUTS.get(mask)
+  if layout is None:
+    fmt = ''.join(['H' + SENSOR_FORMATS[s] * 3 for s in ALL_SENSORS if mask & (1 << s)])
+    layout = SUMMARY_LAYOUTS[mask] = Struct('<' + fmt)
+  return layout
+
+def multiSensorSummarySize(sensors):
+  ''' Bytes in a MULTI_SENSOR_SUMMARY frame carrying the given sensors
+  '''
+  mask = Packet.encodeAvailableSensors(sensors)
+  return HEADER.size + MULTI_SENSOR_HEADER.size + SUMMARY_WINDOW.size + summaryLayout(mask).size
+
+def backlogFrameRecords(sensor_type, frame_size):
+  ''' Number of readings of a sensor that fit in a BACKLOG_DATA frame of frame_size bytes
+  '''
+  return max(frame_size - HEADER.size - BACKLOG_HEADER.size, 0) // BACKLOG_RECORDS[sensor_type].size
+
+def multiSensorResponseSize(sensors):
+  ''' Bytes in a MULTI_SENSOR_RESPONSE frame carrying the given sensors
+  '''
+  mask = Packet.encodeAvailableSensors(sensors)
+  return HEADER.size + MULTI_SENSOR_HEADER.size + multiSensorLayout(mask).size
 
 class Packet():
   ''' Network packet utilities
   '''
-  def __init__(self, src_id, dest_id, msg_type, payload):
+  def __init__(self, src_id, dest_id, msg_type, payload, version=CODEC_VERSION):
     self.src_id = src_id
     self.dest_id = dest_id
     self.type = msg_type
     self.payload = payload
+    self.version = version
 
   def __str__(self):
-    return ('Packet: src_id=%d | dest_id=%d | msg_type=%d | payload=' % (self.src_id, self.dest_id, self.type)) + str(self.payload)
+    return ('Packet: src_id=%d | dest_id=%d | msg_type=%d | payload=' % (self.src_id, self.dest_id, self.type)) + str(list(bytearray(self.payload)))
 
   @staticmethod
-  def createJoinRequestPacket(id, available_sensors=[]):
+  def createJoinRequestPacket(id, available_sensors=[], backlog=False, devices=1, heartbeat=0):
+    ''' available_sensors are the sensors of each of the node's devices. The
+        device count is only sent when there is more than one, or before the
+        heartbeat: the longest, in seconds, that a node reporting by
+        exception stays silent.
+    '''
     src_id = id
     dest_id = 0
     msg_type = MessageType.JOIN_REQUEST
-    payload = Packet.encodeAvailableSensors(available_sensors)
+    mask = Packet.encodeAvailableSensors(available_sensors)
+    if backlog:
+      mask |= BACKLOG_PENDING
+    payload = BYTE.pack(mask)
+    if devices > 1 or heartbeat:
+      payload += BYTE.pack(devices)
+    if heartbeat:
+      payload += JOIN_HEARTBEAT.pack(min(int(heartbeat), 0xFFFF))
 
     return Packet(src_id, dest_id, msg_type, payload)
 
   @staticmethod
-  def createJoinResponsePacket(id):
+  def createJoinResponsePacket(id, slot_offset=None, slot_period=None):
+    ''' Accept a node. If a slot is given (in seconds) the node pushes its
+        readings in that slot, otherwise it waits to be polled.
+    '''
     src_id = 0
     dest_id = id
     msg_type = MessageType.JOIN_ACK
-    payload = 0
+    if slot_offset is None:
+      payload = JOIN_ACK.pack(POLLED, 0, 0)
+    else:
+      payload = JOIN_ACK.pack(SLOTTED, int(round(slot_offset * 1000)), int(round(slot_period * 1000)))
     return Packet(src_id, dest_id, msg_type, payload)
 
   @staticmethod
-  def decode_packet(data):
-    # first byte is ID
-    src = data[0]
-    dest = data[1]
-    msg_type = data[2]
-    payload = data[3:]
-    return Packet(src, dest, msg_type, payload)
+  def decode_join_response(data):
+    ''' Returns the (offset, period) of the node's slot in seconds, or None if
+        the node is polled
+    '''
+    if len(data) < JOIN_ACK.size:
+      return None
+    mode, offset, period = JOIN_ACK.unpack_from(data)
+    if mode != SLOTTED:
+      return None
+    return (offset / 1000., period / 1000.)
 
+  @staticmethod
+  def decode_packet(data):
+    ''' Decode a received frame. The payload is left as a memoryview onto the
+        frame so that it can be unpacked without copying. Returns None for
+        frames that are truncated or use another codec version.
+    '''
+    if isinstance(data, list):
+      data = bytearray(data)
+    frame = memoryview(data)
+    if len(frame) < HEADER.size:
+      return None
+    src, dest, type_byte = HEADER.unpack_from(frame)
+    version = type_byte >> 4
+    if version != CODEC_VERSION:
+      return None
+    return Packet(src, dest, type_byte & 0x0F, frame[HEADER.size:], version)
 
   @staticmethod
   def decode_sensor_data(data):
+      ''' Decode a SENSOR_RESPONSE payload into a dict of readings, or None if
+          the payload does not match the layout of its sensor type
+      '''
+      if len(data) < SENSOR_HEADER.size:
+          return None
+      sensor_type, lat, lon = SENSOR_HEADER.unpack_from(data)
+      layout = SENSOR_LAYOUTS.get(sensor_type)
+      if layout is None or len(data) < SENSOR_HEADER.size + layout.size:
+          return None
+
+      sensor_data = {}
+      sensor_data['sensor'] = sensor_type
+      sensor_data['latitude'] = lat / 1000000.
+      sensor_data['longitude'] = lon / 1000000.
+
+      values = layout.unpack_from(data, SENSOR_HEADER.size)
+      Packet.decodeSensorValues(sensor_type, values, sensor_data)
+
+      return sensor_data
+
+  @staticmethod
+  def decode_multi_sensor_data(data):
+      ''' Decode a MULTI_SENSOR_RESPONSE payload into a dict holding the shared
+          position and the fields of every sensor in it, or None if malformed
+      '''
+      if len(data) < MULTI_SENSOR_HEADER.size:
+          return None
+      mask, lat, lon = MULTI_SENSOR_HEADER.unpack_from(data)
+      layout = multiSensorLayout(mask & SENSOR_MASK)
+      if len(data) < MULTI_SENSOR_HEADER.size + layout.size:
+          return None
+
+      sensors = [s for s in ALL_SENSORS if mask & (1 << s)]
       sensor_data = {}
+      sensor_data['sensors'] = sensors
+      sensor_data['device'] = (mask & SUB_ADDRESS_MASK) >> SUB_ADDRESS_SHIFT
+      sensor_data['backlog'] = bool(mask & BACKLOG_PENDING)
+      sensor_data['latitude'] = lat / 1000000.
+      sensor_data['longitude'] = lon / 1000000.
 
-      #SensorType1 | Lat4 | Long4 | Temp2
-      sensor_type = data[0]
-
-      lat_data = data[1:5]
-      lat = [chr(c) for c in lat_data]
-      lat = str(lat)
-      sensor_data['latitude'] = lat
-
-
-      long_data = data[5:9]
-      long = [chr(c) for c in long_data]
-      long = str(long)
-      sensor_data['longitude'] = long
-
-      if sensor_type == SensorType.TEMP:
-          temp = data[9:]
-          print(temp[0])
-          print(len(temp))
-          temp = Packet.join_float(temp[0], temp[1])
-          sensor_data['temp'] = temp
-          print(temp)
-      elif sensor_type == SensorType.PRESS:
-          press_list = data[9:]
-          press = [chr(c) for c in press_list]
-          press = int(str(press))
-          sensor_data['press'] = press
-          print(press)
-      elif sensor_type == SensorType.HUMID:
-          humid = data[9:]
-          sensor_data['humid'] = humid[0]
-          print(humid)
-      elif sensor_type == SensorType.AIR_QUAL:
-
-          co2 = data[9:12]
-
-          print(str(co2))
-          co2 = int(str(co2))
-          sensor_data['co2'] = co2
-          tvoc_list = data[12:15]
-          tvoc = [chr(c) for c in tvoc_list]
-          tvoc = int(str(tvoc))
-          sensor_data['tvoc'] = tvoc
-          print(co2)
-          print(tvoc)
+      values = layout.unpack_from(data, MULTI_SENSOR_HEADER.size)
+      i = 0
+      for sensor_type in sensors:
+          n = len(SENSOR_FIELDS[sensor_type])
+          Packet.decodeSensorValues(sensor_type, values[i:i + n], sensor_data)
+          i += n
 
       return sensor_data
+
+  @staticmethod
+  def decode_multi_sensor_summary(data):
+      ''' Decode a MULTI_SENSOR_SUMMARY payload into a dict laid out as for
+          decode_multi_sensor_data, holding the mean of each field, with the
+          minimum and maximum under <field>_min and <field>_max. 'window' is
+          the length of the window in seconds and 'counts' the number of
+          readings of each sensor in it. Returns None if malformed.
+      '''
+      offset = MULTI_SENSOR_HEADER.size + SUMMARY_WINDOW.size
+      if len(data) < offset:
+          return None
+      mask, lat, lon = MULTI_SENSOR_HEADER.unpack_from(data)
+      layout = summaryLayout(mask & SENSOR_MASK)
+      if len(data) < offset + layout.size:
+          return None
+
+      sensors = [s for s in ALL_SENSORS if mask & (1 << s)]
+      sensor_data = {}
+      sensor_data['sensors'] = sensors
+      sensor_data['device'] = (mask & SUB_ADDRESS_MASK) >> SUB_ADDRESS_SHIFT
+      sensor_data['backlog'] = bool(mask & BACKLOG_PENDING)
+      sensor_data['latitude'] = lat / 1000000.
+      sensor_data['longitude'] = lon / 1000000.
+      sensor_data['window'] = SUMMARY_WINDOW.unpack_from(data, MULTI_SENSOR_HEADER.size)[0] / 1000.
+      sensor_data['counts'] = {}
+
+      values = layout.unpack_from(data, offset)
+      i = 0
+      for sensor_type in sensors:
+          n = len(SENSOR_FIELDS[sensor_type])
+          sensor_data['counts'][sensor_type] = values[i]
+          stats = {}
+          Packet.decodeSensorValues(sensor_type, values[i + 1:i + 1 + n], stats)
+          sensor_data.update([(field + '_min', v) for field, v in stats.items()])
+          Packet.decodeSensorValues(sensor_type, values[i + 1 + n:i + 1 + 2 * n], stats)
+          sensor_data.update([(field + '_max', v) for field, v in stats.items()])
+          Packet.decodeSensorValues(sensor_type, values[i + 1 + 2 * n:i + 1 + 3 * n], sensor_data)
+          i += 1 + 3 * n
+
+      return sensor_data
+
+  @staticmethod
+  def decodeSensorValues(sensor_type, values, sensor_data):
+      scale = SENSOR_SCALES[sensor_type]
+      for field, value in zip(SENSOR_FIELDS[sensor_type], values):
+          sensor_data[field] = value / float(scale) if scale != 1 else value
+
   @staticmethod
   def create_sensor_request(id, sensor_type):
     src_id = 0
     dest_id = id
     msg_type = MessageType.SENSOR_REQUEST
-    payload = [sensor_type]
+    payload = BYTE.pack(sensor_type)
     return Packet(src_id, dest_id, msg_type, payload)
 
   @staticmethod
-  def bigIntToDigits(n):
-    if n < 256:
-        return n
-    n_str = str(n)
-    return [int(i) for i in n_str] 
+  def decode_sensor_request(data):
+    if len(data) != BYTE.size:
+      return None
+    return BYTE.unpack_from(data)[0]
 
   @staticmethod
-  def getFixedLengthInt(val, length):
-    val_str = str(val)
-    while len(val_str) < length:
-        val_str = ['0'] + list(val_str)
-    return [int(c) for c in val_str]
+  def create_multi_sensor_request(id, sensor_types, device=0):
+    src_id = 0
+    dest_id = id
+    msg_type = MessageType.MULTI_SENSOR_REQUEST
+    payload = BYTE.pack(Packet.encodeAvailableSensors(sensor_types) | (device << SUB_ADDRESS_SHIFT))
+    return Packet(src_id, dest_id, msg_type, payload)
 
   @staticmethod
-  def encodeGps(val):
-    deg = val[0]
-    mins = val[1]
-    sec_str = str(val[2])
-    if val[2] == 0:
-        sec1 = sec2 = 0
-    else:
-        sec1 = int(sec_str[0:2])
-        sec2 = int(sec_str[2:4])
-    return [deg, mins, sec1, sec2]
+  def decode_multi_sensor_request(data):
+    return Packet.decodeAvailableSensors(data)
+
+  @staticmethod
+  def create_backlog_request(id, ack=NO_SEQUENCE, max_size=0, slot_offset=None):
+    ''' Ask a node for its next backlog frame of at most max_size bytes,
+        acknowledging the last frame received from it. A max_size of 0 only
+        acknowledges. A slotted node is also given the time in seconds from
+        the end of the frame to its next slot, to keep it on the slot grid.
+    '''
+    src_id = 0
+    dest_id = id
+    msg_type = MessageType.BACKLOG_REQUEST
+    payload = BACKLOG_REQUEST.pack(ack, max_size)
+    if slot_offset is not None:
+      payload += SLOT_SYNC.pack(int(round(slot_offset * 1000)))
+    return Packet(src_id, dest_id, msg_type, payload)
+
+  @staticmethod
+  def decode_backlog_request(data):
+    ''' Returns (acknowledged sequence, max frame size), or None if malformed '''
+    if len(data) < BACKLOG_REQUEST.size:
+      return None
+    return BACKLOG_REQUEST.unpack_from(data)
+
+  @staticmethod
+  def decode_slot_sync(data):
+    ''' Seconds until the node's next slot given in a BACKLOG_REQUEST, or None '''
+    if len(data) < BACKLOG_REQUEST.size + SLOT_SYNC.size:
+      return None
+    return SLOT_SYNC.unpack_from(data, BACKLOG_REQUEST.size)[0] / 1000.
+
+  @staticmethod
+  def create_link_adr_request(id, sf, power_reduction):
+    ''' Order a node to a spreading factor, and to send with power_reduction
+        dB less than the power it joined with
+    '''
+    src_id = 0
+    dest_id = id
+    msg_type = MessageType.LINK_ADR
+    payload = LINK_ADR.pack(sf, power_reduction)
+    return Packet(src_id, dest_id, msg_type, payload)
+
+  @staticmethod
+  def create_link_adr_answer(id, sf, power_reduction, snr, rssi):
+    ''' Confirm a LINK_ADR, sent with the new settings. snr and rssi are those
+        of the request as the node received it.
+    '''
+    src_id = id
+    dest_id = 0
+    msg_type = MessageType.LINK_ADR
+    payload = LINK_ADR.pack(sf, power_reduction)
+    payload += LINK_QUALITY.pack(max(min(int(round(snr * 4)), 127), -128), int(round(rssi)))
+    return Packet(src_id, dest_id, msg_type, payload)
+
+  @staticmethod
+  def decode_link_adr(data):
+    ''' Returns (spreading factor, power reduction, snr, rssi), where snr and
+        rssi are None in a request, or None if malformed
+    '''
+    if len(data) < LINK_ADR.size:
+      return None
+    sf, power_reduction = LINK_ADR.unpack_from(data)
+    if len(data) < LINK_ADR.size + LINK_QUALITY.size:
+      return (sf, power_reduction, None, None)
+    snr, rssi = LINK_QUALITY.unpack_from(data, LINK_ADR.size)
+    return (sf, power_reduction, snr / 4., rssi)
+
+  @staticmethod
+  def createBacklogPacket(id, sequence, sensor_type, rows, more=False, device=0):
+    ''' Build a BACKLOG_DATA frame from stored readings of one sensor of a
+        device, oldest first. more is set if the node has further readings to upload.
+    '''
+    src_id = id
+    dest_id = 0
+    msg_type = MessageType.BACKLOG_DATA
+    record = BACKLOG_RECORDS[sensor_type]
+    first = float(rows[0][0])
+    payload = bytearray(BACKLOG_HEADER.size + record.size * len(rows))
+    sensor_byte = sensor_type | (device << SUB_ADDRESS_SHIFT) | (BACKLOG_PENDING if more else 0)
+    BACKLOG_HEADER.pack_into(payload, 0, sequence, sensor_byte, first)
+    offset = BACKLOG_HEADER.size
+    for data in rows:
+      delay = int(round((float(data[0]) - first) * 1000))
+      record.pack_into(payload, offset, delay, int(data[1]), int(data[2]),
+                       *Packet.encodeSensorValues(sensor_type, data[3:]))
+      offset += record.size
+
+    return Packet(src_id, dest_id, msg_type, payload)
+
+  @staticmethod
+  def decode_backlog_data(data):
+      ''' Decode a BACKLOG_DATA payload into a dict holding its sequence,
+          sensor type, device, whether more follows and a list of readings,
+          or None if malformed
+      '''
+      if len(data) < BACKLOG_HEADER.size:
+          return None
+      sequence, sensor_byte, first = BACKLOG_HEADER.unpack_from(data)
+      sensor_type = sensor_byte & SENSOR_MASK
+      record = BACKLOG_RECORDS.get(sensor_type)
+      if record is None or (len(data) - BACKLOG_HEADER.size) % record.size:
+          return None
+
+      readings = []
+      for offset in range(BACKLOG_HEADER.size, len(data), record.size):
+          values = record.unpack_from(data, offset)
+          reading = {}
+          reading['timestamp'] = first + values[0] / 1000.
+          reading['latitude'] = values[1] / 1000000.
+          reading['longitude'] = values[2] / 1000000.
+          Packet.decodeSensorValues(sensor_type, values[3:], reading)
+          readings.append(reading)
+
+      return {'sequence': sequence, 'sensor': sensor_type, 'more': bool(sensor_byte & BACKLOG_PENDING),
+              'device': (sensor_byte & SUB_ADDRESS_MASK) >> SUB_ADDRESS_SHIFT, 'readings': readings}
+
+  @staticmethod
+  def encodeGps(val, hemisphere='N'):
+    ''' Convert a (degrees, minutes, decimal minutes) coordinate, as the
+        strings produced by the GPS interface, into signed micro-degrees.
+        The decimal minutes must keep their leading zeros. Coordinates in
+        the S and W hemispheres are negative.
+    '''
+    deg = int(val[0])
+    minutes = float('%s.%s' % (val[1], val[2]))
+    microdegrees = int(round((deg + minutes / 60.) * 1000000))
+    if hemisphere in ('S', 'W'):
+      return -microdegrees
+    return microdegrees
+
+  @staticmethod
+  def encodeSensorValues(sensor_type, vals):
+    ''' Convert the stored values of a reading into the fixed point integers
+        sent on the wire. Scaled values are stored as (units, hundredths).
+    '''
+    if SENSOR_SCALES[sensor_type] == 100:
+      return (int(vals[0]) * 100 + int(vals[1]),)
+    return tuple([int(v) for v in vals[:len(SENSOR_FIELDS[sensor_type])]])
 
   @staticmethod
   def createSensorResponse(id, sensor_type, data):
-    print('Data: ', data)
     src_id = id
     dest_id = 0
     msg_type = MessageType.SENSOR_RESPONSE
-    payload = [sensor_type]    
-    fixedLenGps = Packet.encodeGps(data[1:4]) + Packet.encodeGps(data[4:7])
-    payload.extend(fixedLenGps)
-    if sensor_type is SensorType.PRESS:
-        payload.extend(Packet.getFixedLengthInt(data[7], 4))
-    elif sensor_type is SensorType.AIR_QUAL:
-        val = Packet.getFixedLengthInt(data[7], 3)
-        val.extend(Packet.getFixedLengthInt(data[8], 3))
-        payload.extend(val)
-    else:
-        payload.extend(data[7:])
+    layout = SENSOR_LAYOUTS[sensor_type]
+    payload = bytearray(SENSOR_HEADER.size + layout.size)
+    SENSOR_HEADER.pack_into(payload, 0, sensor_type, int(data[1]), int(data[2]))
+    layout.pack_into(payload, SENSOR_HEADER.size, *Packet.encodeSensorValues(sensor_type, data[3:]))
+
+    return Packet(src_id, dest_id, msg_type, payload)
+
+  @staticmethod
+  def createMultiSensorResponse(id, readings, backlog=False, device=0, position=None):
+    ''' Build a single response from a dict of sensor type -> stored reading.
+        All readings share the position of the most recent one, or of the
+        stored reading given as position. A response with no readings tells
+        the basestation that none have changed.
+    '''
+    src_id = id
+    dest_id = 0
+    msg_type = MessageType.MULTI_SENSOR_RESPONSE
+    mask = Packet.encodeAvailableSensors(readings.keys())
+    layout = multiSensorLayout(mask)
+    mask |= device << SUB_ADDRESS_SHIFT
+    if backlog:
+      mask |= BACKLOG_PENDING
+    latest = position
+    if latest is None:
+      latest = max(readings.values(), key=lambda data: float(data[0]))
+    values = []
+    for sensor_type in ALL_SENSORS:
+      if sensor_type in readings:
+        values.extend(Packet.encodeSensorValues(sensor_type, readings[sensor_type][3:]))
+    payload = bytearray(MULTI_SENSOR_HEADER.size + layout.size)
+    MULTI_SENSOR_HEADER.pack_into(payload, 0, mask, int(latest[1]), int(latest[2]))
+    layout.pack_into(payload, MULTI_SENSOR_HEADER.size, *values)
+
+    return Packet(src_id, dest_id, msg_type, payload)
 
-    print('Temp payload:', payload)
+  @staticmethod
+  def createMultiSensorSummary(id, position, windows, window, backlog=False, device=0):
+    ''' Build a summary response from a dict of sensor type -> (count, minimum,
+        maximum, mean), each statistic a tuple of the sensor's values in wire
+        units. position is the stored reading whose position is sent, and
+        window the length of the window in seconds.
+    '''
+    src_id = id
+    dest_id = 0
+    msg_type = MessageType.MULTI_SENSOR_SUMMARY
+    mask = Packet.encodeAvailableSensors(windows.keys())
+    layout = summaryLayout(mask)
+    values = []
+    for sensor_type in ALL_SENSORS:
+      if sensor_type in windows:
+        count, minimum, maximum, mean = windows[sensor_type]
+        values.append(min(count, 0xFFFF))
+        values.extend(minimum)
+        values.extend(maximum)
+        values.extend(mean)
+    mask |= device << SUB_ADDRESS_SHIFT
+    if backlog:
+      mask |= BACKLOG_PENDING
+    offset = MULTI_SENSOR_HEADER.size + SUMMARY_WINDOW.size
+    payload = bytearray(offset + layout.size)
+    MULTI_SENSOR_HEADER.pack_into(payload, 0, mask, int(position[1]), int(position[2]))
+    SUMMARY_WINDOW.pack_into(payload, MULTI_SENSOR_HEADER.size, int(round(window * 1000)))
+    layout.pack_into(payload, offset, *values)
 
     return Packet(src_id, dest_id, msg_type, payload)
- 
+
   @staticmethod
   def encode_packet(packet):
-    return list(bytearray([packet.src_id, packet.dest_id, packet.type]) + bytearray(packet.payload))
+    frame = bytearray(HEADER.size + len(packet.payload))
+    HEADER.pack_into(frame, 0, packet.src_id, packet.dest_id, (packet.version << 4) | packet.type)
+    frame[HEADER.size:] = packet.payload
+    return frame
 
   @staticmethod
-  def join_float(int, dec):
-      decimal = dec /100
-      return int + decimal
+  def encodeAvailableSensors(sensors):
+    mask = 0
+    for sensor in sensors:
+      mask |= 1 << sensor
+    return mask
 
+  @staticmethod
+  def decodeBacklogPending(data):
+    ''' True if the sensor mask at the start of a JOIN_REQUEST or
+        MULTI_SENSOR_RESPONSE payload says the node has a backlog
+    '''
+    return len(data) >= BYTE.size and bool(BYTE.unpack_from(data)[0] & BACKLOG_PENDING)
 
   @staticmethod
-  def encodeAvailableSensors(sensors):
-    output = [0, 0, 0, 0]
-    if SensorType.TEMP in sensors:
-      output[0] = 1
-    if SensorType.HUMID in sensors:
-      output[1] = 1
-    if SensorType.AIR_QUAL in sensors:
-      output[2] = 1
-    if SensorType.PRESS in sensors:
-      output[3] = 1
-    return output
+  def decodeSubAddress(data):
+    ''' The device addressed by the sensor mask at the start of a payload '''
+    if len(data) < BYTE.size:
+      return 0
+    return (BYTE.unpack_from(data)[0] & SUB_ADDRESS_MASK) >> SUB_ADDRESS_SHIFT
+
+  @staticmethod
+  def decodeDeviceCount(data):
+    ''' The number of devices announced in a JOIN_REQUEST payload '''
+    if len(data) < 2 * BYTE.size:
+      return 1
+    return max(BYTE.unpack_from(data, BYTE.size)[0], 1)
+
+  @staticmethod
+  def decodeHeartbeat(data):
+    ''' The heartbeat announced in a JOIN_REQUEST payload, 0 if the node
+        always reports
+    '''
+    if len(data) < 2 * BYTE.size + JOIN_HEARTBEAT.size:
+      return 0
+    return JOIN_HEARTBEAT.unpack_from(data, 2 * BYTE.size)[0]
+
+  @staticmethod
+  def decodeAvailableSensors(data):
+    if len(data) < BYTE.size:
+      return None
+    mask = BYTE.unpack_from(data)[0]
+    return [s for s in ALL_SENSORS if mask & (1 << s)]